@@ -0,0 +1,147 @@
+import contextlib
+import hashlib
+import json
+import threading
+import time
+
+import metrics
+
+
+def structure_key(workflow, batch_inputs):
+    """
+    Return the key of a workflow with the values of the batchable inputs left out.
+
+    Workflows with the same key only differ in batchable inputs such as the seed
+    or the prompt text. Links to other nodes are part of the structure even when
+    their input is batchable.
+
+    Args:
+        workflow (dict): The workflow in the ComfyUI API format.
+        batch_inputs (set): Names of the inputs whose values may differ.
+
+    Returns:
+        str: The hex encoded SHA-256 digest.
+    """
+    structure = {}
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict):
+            structure[node_id] = node
+            continue
+        inputs = {
+            name: (None if name in batch_inputs and not isinstance(value, list) else value)
+            for name, value in (node.get("inputs") or {}).items()
+        }
+        structure[node_id] = {"class_type": node.get("class_type"), "inputs": inputs}
+    return hashlib.sha256(json.dumps(structure, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class Batch:
+    """
+    Prompts with the same structure that are submitted together.
+    """
+
+    def __init__(self, key, deadline):
+        self.key = key
+        self.deadline = deadline
+        self.members = []
+        self.full = threading.Event()
+        self.submitted = threading.Event()
+
+
+class BatchScheduler:
+    """
+    Groups the prompts of concurrent jobs whose workflows only differ in batchable
+    inputs and queues each group on ComfyUI back-to-back.
+
+    The first prompt of a group waits up to window seconds for others to join,
+    then submits all of them in the order they arrived. It does not wait when no
+    other job is in flight (see job()), and a group is submitted as soon as it
+    holds max_size prompts. Consecutive prompts with the same structure keep
+    ComfyUI from switching models between them and let it reuse the outputs of
+    every node whose inputs did not change, e.g. the text encoding when only the
+    seed differs.
+
+    Batching only reorders the queue of ComfyUI: every prompt is still posted on
+    its own and keeps its own ComfyClient, so its events and outputs go to the
+    job that sent it. Prompts are not merged into one prompt with a larger
+    batch_size, which would change their results.
+    """
+
+    def __init__(self, window, max_size, batch_inputs):
+        self.window = window
+        self.max_size = max_size
+        self.batch_inputs = set(batch_inputs)
+        self.lock = threading.Lock()
+        self.batches = {}
+        self.jobs = 0
+
+    @property
+    def enabled(self):
+        return self.window > 0 and self.max_size > 1
+
+    @contextlib.contextmanager
+    def job(self):
+        """
+        Count a job as in flight while the block runs. Prompts only wait for
+        others to join while another job is in flight.
+        """
+        with self.lock:
+            self.jobs += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.jobs -= 1
+
+    def submit(self, client, workflow, job_id=None, prompt_json=None):
+        """
+        Submit a prompt as part of a batch of structurally identical prompts.
+
+        Args:
+            client (ComfyClient): The client of the job that follows the prompt.
+            workflow (dict): The workflow to run.
+            job_id (str): The job the prompt belongs to, used for logging.
+            prompt_json (str): The JSON of the workflow if it is known already.
+
+        Returns:
+            str: The prompt id, or None if ComfyUI rejected the prompt.
+        """
+        if not self.enabled:
+            return client.submit(workflow, job_id, prompt_json)
+
+        key = structure_key(workflow, self.batch_inputs)
+        member = {
+            "client": client, "workflow": workflow, "job_id": job_id, "prompt_json": prompt_json, "prompt_id": None,
+        }
+        with self.lock:
+            batch = self.batches.get(key)
+            leader = batch is None
+            if leader:
+                # Waiting only adds latency when no other job could join
+                window = self.window if self.jobs > 1 else 0
+                batch = Batch(key, time.monotonic() + window)
+                if window > 0:
+                    self.batches[key] = batch
+            batch.members.append(member)
+            if len(batch.members) >= self.max_size:
+                # Later prompts start a new batch
+                self.batches.pop(key, None)
+                batch.full.set()
+
+        if not leader:
+            batch.submitted.wait()
+            return member["prompt_id"]
+
+        batch.full.wait(max(0, batch.deadline - time.monotonic()))
+        with self.lock:
+            if self.batches.get(key) is batch:
+                self.batches.pop(key)
+        metrics.BATCH_SIZE.observe(len(batch.members))
+        if len(batch.members) > 1:
+            print(f"runpod-worker-comfy - submitting a batch of {len(batch.members)} prompts")
+        try:
+            for entry in batch.members:
+                entry["prompt_id"] = entry["client"].submit(entry["workflow"], entry["job_id"], entry["prompt_json"])
+        finally:
+            batch.submitted.set()
+        return member["prompt_id"]
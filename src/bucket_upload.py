@@ -0,0 +1,265 @@
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import threading
+import time
+import uuid
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from runpod.serverless.utils.rp_upload import extract_region_from_url
+
+# Layout of the object keys, see BucketUploader.key_for for the placeholders
+DEFAULT_KEY_TEMPLATE = "{job_id}/{uuid}{ext}"
+# Layout of the keys of deduplicated uploads, named after the content of the image
+CONTENT_KEY_TEMPLATE = "{sha256}{ext}"
+# Seconds the returned presigned URLs are valid, the same as rp_upload uses
+PRESIGNED_URL_EXPIRY = 604800
+
+
+def content_digest(data=None, path=None):
+    """
+    Return the hex encoded SHA-256 digest of an image in memory or in a file.
+    """
+    hasher = hashlib.sha256()
+    if data is not None:
+        hasher.update(data)
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class UploadIndex:
+    """
+    The content digests of the images already uploaded, with the keys they were
+    uploaded under.
+
+    Entries are appended to the JSON lines file at path, so a restarted worker
+    keeps reusing the uploads of its predecessors. Without a path the index only
+    lives in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self._load()
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[(entry["bucket"], entry["sha256"])] = entry["key"]
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except OSError:
+            return
+        print(f"runpod-worker-comfy - loaded {len(self.entries)} uploaded image(s) from {self.path}")
+
+    def get(self, bucket, digest):
+        """
+        Return the key the image with the given digest was uploaded under, or None.
+        """
+        with self.lock:
+            return self.entries.get((bucket, digest))
+
+    def add(self, bucket, digest, key):
+        with self.lock:
+            self.entries[(bucket, digest)] = key
+            if not self.path:
+                return
+            try:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps({"bucket": bucket, "sha256": digest, "key": key}) + "\n")
+            except OSError as e:
+                print(f"runpod-worker-comfy - could not store the upload of {digest}: {e}")
+
+
+class BucketUploader:
+    """
+    Uploads output images to an S3 compatible bucket straight from memory or from
+    the ComfyUI output folder, without writing temporary files.
+
+    A single pooled client is shared by all jobs. Objects above multipart_threshold
+    are uploaded in parts of multipart_chunksize, and at most max_concurrency
+    objects are uploaded at the same time across all jobs of the worker.
+
+    With an index the images are deduplicated: they are uploaded under a key
+    derived from their content, and an image that was uploaded before is not
+    uploaded again.
+    """
+
+    def __init__(
+        self,
+        endpoint_url,
+        access_key_id,
+        secret_access_key,
+        bucket_name=None,
+        key_template=DEFAULT_KEY_TEMPLATE,
+        max_concurrency=8,
+        multipart_threshold=8 * 1024 * 1024,
+        multipart_chunksize=8 * 1024 * 1024,
+        index=None,
+    ):
+        self.endpoint_url = endpoint_url
+        self.access_key_id = access_key_id
+        self.secret_access_key = secret_access_key
+        self.bucket_name = bucket_name
+        self.key_template = key_template
+        self.max_concurrency = max_concurrency
+        self.index = index
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=4,
+            use_threads=True,
+        )
+        self.lock = threading.Lock()
+        self.client = None
+
+    @classmethod
+    def from_env(
+        cls, key_template=DEFAULT_KEY_TEMPLATE, max_concurrency=8, multipart_threshold=8 * 1024 * 1024, index=None
+    ):
+        """
+        Create an uploader for the bucket configured with the BUCKET_ENDPOINT_URL,
+        BUCKET_ACCESS_KEY_ID, BUCKET_SECRET_ACCESS_KEY and BUCKET_NAME environment variables.
+        """
+        return cls(
+            os.environ.get("BUCKET_ENDPOINT_URL"),
+            os.environ.get("BUCKET_ACCESS_KEY_ID"),
+            os.environ.get("BUCKET_SECRET_ACCESS_KEY"),
+            bucket_name=os.environ.get("BUCKET_NAME"),
+            key_template=key_template,
+            max_concurrency=max_concurrency,
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_threshold,
+            index=index,
+        )
+
+    @property
+    def configured(self):
+        return bool(self.endpoint_url and self.access_key_id and self.secret_access_key)
+
+    def _client(self):
+        with self.lock:
+            if self.client is None:
+                self.client = boto3.session.Session().client(
+                    "s3",
+                    endpoint_url=self.endpoint_url,
+                    aws_access_key_id=self.access_key_id,
+                    aws_secret_access_key=self.secret_access_key,
+                    region_name=extract_region_from_url(self.endpoint_url),
+                    config=Config(
+                        signature_version="s3v4",
+                        retries={"max_attempts": 3, "mode": "standard"},
+                        # Every upload may use several connections for its parts
+                        max_pool_connections=self.max_concurrency * self.transfer_config.max_request_concurrency,
+                    ),
+                )
+            return self.client
+
+    def bucket(self):
+        """
+        Return the bucket to upload to, by default named after the current month
+        like rp_upload does.
+        """
+        return self.bucket_name or time.strftime("%m-%y")
+
+    def key_for(self, job_id, filename):
+        """
+        Build the object key of an image from key_template.
+
+        The placeholders are {job_id}, {filename} (the name ComfyUI saved the
+        image as), {stem} and {ext} (its parts), {uuid} (8 random hex digits)
+        and {date} (YYYY-MM-DD).
+
+        Args:
+            job_id (str): The job the image belongs to.
+            filename (str): The filename of the image.
+
+        Returns:
+            str: The object key.
+        """
+        stem, ext = os.path.splitext(filename)
+        return self.key_template.format(
+            job_id=job_id,
+            filename=filename,
+            stem=stem,
+            ext=ext,
+            uuid=uuid.uuid4().hex[:8],
+            date=time.strftime("%Y-%m-%d"),
+        )
+
+    def presigned_url(self, key):
+        return self._client().generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket(), "Key": key}, ExpiresIn=PRESIGNED_URL_EXPIRY
+        )
+
+    def upload_image(self, job_id, filename, data=None, path=None):
+        """
+        Upload an output image under the key it belongs to and return a presigned URL to it.
+
+        Without an index the key is built from key_template. With an index the key
+        is derived from the content of the image, and an image that is in the index
+        already is not uploaded again.
+
+        Args:
+            job_id (str): The job the image belongs to.
+            filename (str): The filename of the image.
+            data (bytes): The image, if it is in memory.
+            path (str): The file to stream the image from otherwise.
+
+        Returns:
+            tuple: (url, uploaded) with the presigned URL and False if an earlier
+                   upload of the image was reused.
+        """
+        if self.index is None:
+            return self.upload(self.key_for(job_id, filename), data=data, path=path), True
+        digest = content_digest(data=data, path=path)
+        bucket = self.bucket()
+        key = self.index.get(bucket, digest)
+        if key is not None:
+            return self.presigned_url(key), False
+        key = CONTENT_KEY_TEMPLATE.format(sha256=digest, ext=os.path.splitext(filename)[1].lower())
+        url = self.upload(key, data=data, path=path)
+        self.index.add(bucket, digest, key)
+        return url, True
+
+    def upload(self, key, data=None, path=None):
+        """
+        Upload an image and return a presigned URL to it.
+
+        Args:
+            key (str): The object key, see key_for.
+            data (bytes): The image, if it is in memory.
+            path (str): The file to stream the image from otherwise.
+
+        Returns:
+            str: The presigned URL of the object.
+        """
+        client = self._client()
+        bucket = self.bucket()
+        content_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+        with self.slots:
+            if data is not None:
+                client.upload_fileobj(
+                    io.BytesIO(data), bucket, key,
+                    ExtraArgs={"ContentType": content_type}, Config=self.transfer_config,
+                )
+            else:
+                client.upload_file(
+                    path, bucket, key,
+                    ExtraArgs={"ContentType": content_type}, Config=self.transfer_config,
+                )
+        return self.presigned_url(key)
@@ -0,0 +1,175 @@
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+
+class Delivery:
+    """
+    A callback waiting to be sent. done is set once it was delivered or given up on.
+    """
+
+    def __init__(self, kind, url, payload, job_id=None):
+        self.kind = kind
+        self.url = url
+        self.payload = payload
+        self.job_id = job_id
+        self.done = threading.Event()
+        self.delivered = False
+
+
+class CallbackDispatcher:
+    """
+    Sends status and result callbacks from background threads, so a slow
+    callback endpoint never stalls a job.
+
+    Callbacks are posted over pooled connections with a timeout and retried with
+    exponential backoff. A status update replaces the status of the same job that
+    is still waiting to be sent, so receivers only get the latest one. The
+    callbacks of a job are sent one at a time in the order they were queued, so
+    an older status never overtakes a newer one or the result. Status updates
+    are dropped once max_queue callbacks are waiting; results are never
+    dropped, and flush() waits until they are delivered.
+    """
+
+    def __init__(self, workers=2, max_queue=1000, timeout=10, retries=3, backoff=0.5):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.pending_status = {}
+        self.in_flight = 0
+        self.busy_jobs = set()
+        self.threads = []
+
+    def start(self):
+        with self.condition:
+            if self.threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def send_status(self, job_id, url, status):
+        """
+        Queue a status update, replacing the one of the same job still waiting.
+
+        Args:
+            job_id (str): The job the status belongs to.
+            url (str): The status callback URL.
+            status (dict): The status to post.
+        """
+        self.start()
+        key = (job_id, url)
+        with self.condition:
+            delivery = self.pending_status.get(key)
+            if delivery is not None:
+                delivery.payload = status
+                return
+            if len(self.queue) >= self.max_queue:
+                print(f"runpod-worker-comfy - callback queue is full, dropping status for job {job_id}")
+                return
+            delivery = Delivery("status", url, status, job_id)
+            delivery.key = key
+            self.pending_status[key] = delivery
+            self.queue.append(delivery)
+            self.condition.notify()
+
+    def send_result(self, url, result, job_id=None):
+        """
+        Queue a result callback. Results are never coalesced or dropped.
+
+        Args:
+            url (str): The result callback URL.
+            result (dict): The result to post.
+            job_id (str): The job the result belongs to, sent after its statuses.
+
+        Returns:
+            Delivery: The queued callback, whose done event is set once it was sent.
+        """
+        self.start()
+        delivery = Delivery("result", url, result, job_id)
+        with self.condition:
+            self.queue.append(delivery)
+            self.condition.notify()
+        return delivery
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued callback was sent or given up on.
+
+        Args:
+            timeout (float): Seconds to wait at most, or None to wait forever.
+
+        Returns:
+            bool: True if nothing is left to send.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.queue or self.in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def _next(self):
+        """
+        Take the oldest queued callback whose job has no callback in flight, or
+        return None if there is none.
+        """
+        for delivery in self.queue:
+            if delivery.job_id is None or delivery.job_id not in self.busy_jobs:
+                self.queue.remove(delivery)
+                return delivery
+        return None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                delivery = self._next()
+                while delivery is None:
+                    self.condition.wait()
+                    delivery = self._next()
+                if delivery.kind == "status":
+                    self.pending_status.pop(delivery.key, None)
+                if delivery.job_id is not None:
+                    self.busy_jobs.add(delivery.job_id)
+                self.in_flight += 1
+            try:
+                self._deliver(delivery)
+            finally:
+                with self.condition:
+                    self.in_flight -= 1
+                    self.busy_jobs.discard(delivery.job_id)
+                    self.condition.notify_all()
+                delivery.done.set()
+
+    def _deliver(self, delivery):
+        for attempt in range(self.retries + 1):
+            start_time = time.perf_counter()
+            try:
+                response = self.session.post(delivery.url, json=delivery.payload, timeout=self.timeout)
+                metrics.CALLBACK_SECONDS.observe(time.perf_counter() - start_time, kind=delivery.kind)
+                if response.status_code < 500:
+                    print(f"runpod-worker-comfy - Callback response: {response.text}")
+                    delivery.delivered = True
+                    return
+                error = f"HTTP {response.status_code}"
+            except requests.RequestException as e:
+                error = str(e)
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        print(f"runpod-worker-comfy - giving up on {delivery.kind} callback to {delivery.url}: {error}")
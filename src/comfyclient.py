@@ -1,14 +1,276 @@
 import websocket
 import uuid
 import json
+import time
 import urllib.request
 import urllib.parse
 import threading
+import queue
+import struct
+from collections import OrderedDict
 
-class ComfyClient:
-    def __init__(self, server_address="127.0.0.1:8188", timeout=600):
+# Seconds to wait before reconnecting a dropped event stream
+EVENT_STREAM_RECONNECT_DELAY = 2
+# Seconds submit() waits for the event stream to connect before posting anyway
+EVENT_STREAM_CONNECT_TIMEOUT = 30
+# Number of unclaimed prompt ids whose events are buffered until a client subscribes
+EVENT_STREAM_MAX_PENDING_PROMPTS = 64
+# Binary websocket event carrying an encoded image (previews and SaveImageWebsocket)
+BINARY_EVENT_PREVIEW_IMAGE = 1
+# Image formats used in binary image events
+BINARY_IMAGE_FORMATS = {1: "jpeg", 2: "png"}
+# Node class whose images are sent over the websocket instead of saved to disk
+SAVE_IMAGE_WEBSOCKET_CLASS = "SaveImageWebsocket"
+# Statuses after which a prompt produces no more events
+FINISHED_STATUSES = ["completed", "error", "fail", "timed out"]
+
+
+class ComfyEventStream:
+    """
+    A long-lived websocket connection to ComfyUI that is shared by every
+    ComfyClient in the process.
+
+    Every prompt is submitted with the client_id of this stream, so ComfyUI sends
+    all of its events here. Messages are routed to the subscriber registered for
+    their prompt_id, events for prompts nobody has subscribed to yet are buffered
+    and replayed on subscribe, and the connection is re-established automatically
+    when it drops.
+
+    Binary image frames do not name their prompt; they are routed as "image"
+    messages to the prompt and node that is executing when they arrive.
+    """
+
+    def __init__(self, server_address="127.0.0.1:8188", client_id=None, reconnect_delay=EVENT_STREAM_RECONNECT_DELAY):
         self.server_address = server_address
+        self.client_id = client_id or str(uuid.uuid4())
+        self.reconnect_delay = reconnect_delay
+        # Held while dispatching so that replayed and live events stay in order
+        self.lock = threading.RLock()
+        self.connected = threading.Event()
+        self.subscribers = {}
+        self.pending = OrderedDict()
+        self.queue_remaining = 0
+        self.executing = None
+        # time.time() of the last message of any prompt, 0 before the first one
+        self.last_event_time = 0
+        self.reconnects = 0
         self.ws = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        """
+        Start the background connection thread if it is not running yet.
+        """
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Close the connection and stop reconnecting.
+        """
+        with self.lock:
+            self.running = False
+            ws = self.ws
+        if ws:
+            ws.close()
+
+    def wait_until_connected(self, timeout=None):
+        """
+        Block until the websocket is open.
+
+        Args:
+            timeout (float): Seconds to wait, or None to wait forever.
+
+        Returns:
+            bool: True if the stream is connected.
+        """
+        return self.connected.wait(timeout)
+
+    def subscribe(self, prompt_id, callback):
+        """
+        Route the events of a prompt to callback, replaying any events that
+        arrived before the subscription.
+
+        Args:
+            prompt_id (str): The prompt to follow.
+            callback (callable): Called with every decoded message for the prompt.
+        """
+        with self.lock:
+            self.subscribers[prompt_id] = callback
+            for msg in self.pending.pop(prompt_id, []):
+                callback(msg)
+
+    def unsubscribe(self, prompt_id):
+        """
+        Stop routing events for a prompt.
+        """
+        with self.lock:
+            self.subscribers.pop(prompt_id, None)
+
+    def _run(self):
+        url = f"ws://{self.server_address}/ws?clientId={self.client_id}"
+        while self.running:
+            ws = websocket.WebSocketApp(
+                url,
+                on_message=self._on_message,
+                on_error=self._on_error,
+                on_close=self._on_close,
+                on_open=self._on_open
+            )
+            with self.lock:
+                self.ws = ws
+            ws.run_forever()
+            self.connected.clear()
+            if not self.running:
+                break
+            self.reconnects += 1
+            print(f"Websocket - connection lost, reconnecting in {self.reconnect_delay}s")
+            time.sleep(self.reconnect_delay)
+
+    def _on_open(self, ws):
+        print("Websocket - connection opened")
+        self.connected.set()
+        with self.lock:
+            prompt_ids = list(self.subscribers)
+        if self.reconnects and prompt_ids:
+            # Events sent while we were disconnected are lost, so catch up from the history
+            threading.Thread(target=self._recover, args=(prompt_ids,), daemon=True).start()
+
+    def _on_close(self, ws, close_status_code, close_msg):
+        print("Websocket - closed")
+        self.connected.clear()
+
+    def _on_error(self, ws, error):
+        print(f"Websocket - error: {error}")
+
+    def _on_message(self, ws, message):
+        self.last_event_time = time.time()
+        if isinstance(message, bytes):
+            self._on_binary(message)
+            return
+        msg = json.loads(message)
+        data = msg.get('data') or {}
+        if msg['type'] == 'status':
+            self.queue_remaining = data.get('status', {}).get('exec_info', {}).get('queue_remaining', 0)
+            with self.lock:
+                for callback in list(self.subscribers.values()):
+                    callback(msg)
+            return
+        prompt_id = data.get('prompt_id')
+        if msg['type'] == 'executing':
+            self.executing = (prompt_id, data['node']) if data.get('node') is not None else None
+        if prompt_id is not None:
+            self._dispatch(prompt_id, msg)
+
+    def _on_binary(self, message):
+        executing = self.executing
+        if executing is None or len(message) < 8:
+            return
+        event, image_format = struct.unpack(">II", message[:8])
+        if event != BINARY_EVENT_PREVIEW_IMAGE:
+            return
+        prompt_id, node = executing
+        self._dispatch(prompt_id, {
+            "type": "image",
+            "data": {
+                "prompt_id": prompt_id,
+                "node": node,
+                "format": BINARY_IMAGE_FORMATS.get(image_format, "png"),
+                "image": message[8:],
+            },
+        })
+
+    def _dispatch(self, prompt_id, msg):
+        with self.lock:
+            callback = self.subscribers.get(prompt_id)
+            if callback is not None:
+                callback(msg)
+                return
+            self.pending.setdefault(prompt_id, []).append(msg)
+            while len(self.pending) > EVENT_STREAM_MAX_PENDING_PROMPTS:
+                self.pending.popitem(last=False)
+
+    def _get_json(self, path):
+        with urllib.request.urlopen(f"http://{self.server_address}{path}") as response:
+            return json.loads(response.read())
+
+    def _recover(self, prompt_ids):
+        """
+        Replay the outcome of prompts that finished while the stream was down.
+
+        Prompts that failed are replayed as their execution_error or
+        execution_interrupted event. Prompts that are neither queued nor in the
+        history were lost by ComfyUI and are reported as an execution_error.
+        """
+        try:
+            queue = self._get_json("/queue")
+            queued = {
+                task[1] for task in queue.get("queue_running", []) + queue.get("queue_pending", []) if len(task) > 1
+            }
+        except Exception as e:
+            print(f"Websocket - failed to read the queue while recovering: {e}")
+            queued = None
+        for prompt_id in prompt_ids:
+            try:
+                history = self._get_json(f"/history/{prompt_id}").get(prompt_id)
+            except Exception as e:
+                print(f"Websocket - failed to recover prompt {prompt_id}: {e}")
+                continue
+            if not history:
+                if queued is not None and prompt_id not in queued:
+                    self._dispatch(prompt_id, {"type": "execution_error", "data": {
+                        "prompt_id": prompt_id,
+                        "exception_message": "The prompt is neither queued nor in the history of ComfyUI",
+                    }})
+                continue
+            status = history.get('status') or {}
+            if status.get('completed'):
+                for node_id, output in history.get('outputs', {}).items():
+                    self._dispatch(prompt_id, {"type": "executed", "data": {"node": node_id, "output": output, "prompt_id": prompt_id}})
+                self._dispatch(prompt_id, {"type": "execution_success", "data": {"prompt_id": prompt_id}})
+                continue
+            # The history holds the events of the prompt, the last one says how it failed
+            failure = {"type": "execution_error", "data": {
+                "exception_message": f"The prompt finished with status '{status.get('status_str', 'unknown')}'",
+            }}
+            for message in status.get('messages', []):
+                if len(message) == 2 and message[0] in ('execution_error', 'execution_interrupted'):
+                    failure = {"type": message[0], "data": dict(message[1] or {})}
+            failure["data"]["prompt_id"] = prompt_id
+            self._dispatch(prompt_id, failure)
+
+_event_streams = {}
+_event_streams_lock = threading.Lock()
+
+
+def get_event_stream(server_address="127.0.0.1:8188"):
+    """
+    Return the process-wide event stream for a ComfyUI server, starting it on first use.
+
+    Args:
+        server_address (str): The host:port of the ComfyUI server.
+
+    Returns:
+        ComfyEventStream: The shared, connected-or-connecting stream.
+    """
+    with _event_streams_lock:
+        stream = _event_streams.get(server_address)
+        if stream is None:
+            stream = ComfyEventStream(server_address)
+            _event_streams[server_address] = stream
+    stream.start()
+    return stream
+
+
+class ComfyClient:
+    def __init__(self, server_address="127.0.0.1:8188", timeout=600, event_stream=None):
+        self.server_address = server_address
+        self.event_stream = event_stream
         self.status_event = threading.Event()
         self.current_status = {"status": "pending", "data": None}
         self.prompt_id = None
@@ -17,41 +279,74 @@ class ComfyClient:
         self.timeout = timeout
         self.last_event_time = None
         self.outputs = []
+        self.websocket_image_nodes = set()
+        self.websocket_images = {}
+        self.prompt = {}
+        self.node_timings = []
+        self.current_node = None
         self.status_change_callback = None
+        self.status_queue = queue.Queue()
 
-    def _on_message(self, ws, message):
-        msg = json.loads(message)
+    def _on_message(self, msg):
         with self.lock:
-            self.last_event_time = threading.Event()
+            self.last_event_time = time.time()
+        if msg['type'] == 'image':
+            # Only SaveImageWebsocket frames are outputs, the rest are sampler previews
+            node = msg['data']['node']
+            if node in self.websocket_image_nodes:
+                with self.lock:
+                    self.websocket_images.setdefault(node, []).append(
+                        {"format": msg['data']['format'], "image": msg['data']['image']}
+                    )
+            return
         # if msg['type'] is not status, executing, progress, or executed then ignore
-        if msg['type'] not in ['status', 'executing', 'progress', 'executed', 'execution_success']:
+        if msg['type'] not in ['status', 'executing', 'execution_cached', 'progress', 'executed', 'execution_success', 'execution_error', 'execution_interrupted']:
+            return
+        if self.is_finished():
             return
-        if msg['type'] == 'execution_success':
+        if msg['type'] == 'execution_cached':
+            with self.lock:
+                for node in msg['data'].get('nodes', []):
+                    self.node_timings.append({"node": node, "class_type": self._class_type(node), "ms": 0, "cached": True})
+            return
+        if msg['type'] == 'executing':
+            self._track_node(msg['data']['node'])
+        elif msg['type'] in ['execution_success', 'execution_error', 'execution_interrupted']:
+            self._track_node(None)
+        if msg['type'] in ['execution_error', 'execution_interrupted']:
+            data = msg['data']
+            error = {
+                "message": data.get('exception_message', "Execution interrupted"),
+                "details": {key: data.get(key) for key in ['node_id', 'node_type', 'exception_type', 'traceback']},
+            }
+            with self.lock:
+                self.current_status = {"status": "error", "data": {**msg, "error": error}}
+                self.status_event.set()
+                self._unsubscribe()
+                self.onStatusChanged(self.current_status)
+        elif msg['type'] == 'execution_success':
             with self.lock:
                 # trim out any empty outputs
                 self.outputs = [output for output in self.outputs if output]
                 self.current_status = {"status": "completed", "data": msg}
                 self.current_status["outputs"] = self.outputs
                 self.status_event.set()
-                self._close_ws()
+                self._unsubscribe()
                 self.onStatusChanged(self.current_status)
         elif msg['type'] == 'executing' and msg['data']['node'] is None:
-            queue_remaining = msg['data'].get('status', {}).get('exec_info', {}).get('queue_remaining', 0)
-            new_status = "queued" if queue_remaining > 0 else "completed"
             with self.lock:
-                self.current_status = {"status": new_status, "data": msg}
-                # if completed, add outputs to the self.current_status
-                if new_status == "completed":
-                    self.current_status["outputs"] = self.outputs
+                self.current_status = {"status": "completed", "data": msg}
+                self.current_status["outputs"] = self.outputs
                 self.status_event.set()
+                self._unsubscribe()
                 self.onStatusChanged(self.current_status)
-                if new_status == "completed":
-                    self._close_ws()
-        elif msg['type'] == 'status' and msg['data'].get('sid') == self.client_id:
+        elif msg['type'] == 'status':
+            # Queue updates are broadcast to every prompt, they only matter until ours starts
             queue_remaining = msg['data'].get('status', {}).get('exec_info', {}).get('queue_remaining', 0)
-            new_status = "queued" if queue_remaining > 0 else "completed"
             with self.lock:
-                self.current_status = {"status": new_status, "data": msg}
+                if self.current_status["status"] not in ["pending", "queued"] or queue_remaining == 0:
+                    return
+                self.current_status = {"status": "queued", "data": msg}
                 self.status_event.set()
                 self.onStatusChanged(self.current_status)
         else:
@@ -62,28 +357,32 @@ class ComfyClient:
                 self.status_event.set()
                 self.onStatusChanged(self.current_status)
 
-    def _on_error(self, ws, error):
-        print(f"Websocket - error: {error}")
+    def _class_type(self, node):
+        node_data = self.prompt.get(node)
+        return node_data.get("class_type", "unknown") if isinstance(node_data, dict) else "unknown"
+
+    def _track_node(self, node):
+        # A node runs from its "executing" event until the next one or the end of the prompt
+        now = time.perf_counter()
         with self.lock:
-            self.current_status = {"status": "error", "data": str(error)}
-            self.status_event.set()
-            self._close_ws()
-            self.onStatusChanged(self.current_status)
-    
+            if self.current_node is not None:
+                node_id, start_time = self.current_node
+                self.node_timings.append({
+                    "node": node_id,
+                    "class_type": self._class_type(node_id),
+                    "ms": round((now - start_time) * 1000, 2),
+                    "cached": False,
+                })
+            self.current_node = (node, now) if node is not None else None
+
     def onStatusChanged(self, status):
+        self.status_queue.put(status)
         if self.status_change_callback:
             self.status_change_callback(status)
 
-    def _on_close(self, ws, close_status_code, close_msg):
-        print("Websocket - closed")
-
-    def _on_open(self, ws):
-        print("Websocket - connection opened")
-
-    def _close_ws(self):
-        if self.ws:
-            self.ws.close()
-            self.ws = None
+    def _unsubscribe(self):
+        if self.event_stream and self.prompt_id:
+            self.event_stream.unsubscribe(self.prompt_id)
     
     def get_image(self, data={"filename": "", "subfolder": "", "type": ""}):
         """
@@ -103,34 +402,58 @@ class ComfyClient:
         with urllib.request.urlopen("http://{}/view?{}".format(self.server_address, url_values)) as response:
             return response.read()
 
-    def submit(self, prompt, client_id=None):
+    def submit(self, prompt, job_id=None, prompt_json=None):
+        """
+        Queue a prompt on ComfyUI and follow its events on the shared event stream.
+
+        Args:
+            prompt (dict): The workflow to run.
+            job_id (str): Optional id of the job the prompt belongs to, used for logging.
+            prompt_json (str): Optional JSON of prompt, e.g. from Template.serialize(),
+                so it is not serialized again.
+
+        Returns:
+            str: The prompt id, or None if ComfyUI rejected the prompt.
+        """
         self.outputs = []
-        if client_id is None:
-            self.client_id = str(uuid.uuid4())
-        else:
-            self.client_id = client_id
-        
-        prompt_payload = {"prompt": prompt, "client_id": self.client_id}
-        data = json.dumps(prompt_payload).encode('utf-8')
+        self.websocket_images = {}
+        self.prompt = prompt
+        self.node_timings = []
+        self.current_node = None
+        self.websocket_image_nodes = {
+            node_id for node_id, node in prompt.items()
+            if isinstance(node, dict) and node.get("class_type") == SAVE_IMAGE_WEBSOCKET_CLASS
+        }
+        if self.event_stream is None:
+            self.event_stream = get_event_stream(self.server_address)
+        if not self.event_stream.wait_until_connected(EVENT_STREAM_CONNECT_TIMEOUT):
+            print("Websocket - event stream is not connected yet, submitting anyway")
+        self.client_id = self.event_stream.client_id
+
+        # Subscribe before posting so that no event of this prompt can be missed.
+        # ComfyUI versions that ignore the requested prompt_id are handled below.
+        self.prompt_id = str(uuid.uuid4())
+        self.event_stream.subscribe(self.prompt_id, self._on_message)
+
+        if prompt_json is None:
+            prompt_json = json.dumps(prompt)
+        data = (
+            f'{{"prompt": {prompt_json}, "client_id": {json.dumps(self.client_id)}, '
+            f'"prompt_id": {json.dumps(self.prompt_id)}}}'
+        ).encode('utf-8')
         req = urllib.request.Request(f"http://{self.server_address}/prompt", data=data)
         try:
             response = json.loads(urllib.request.urlopen(req).read())
-            self.prompt_id = response["prompt_id"]
+            if response["prompt_id"] != self.prompt_id:
+                self.event_stream.unsubscribe(self.prompt_id)
+                self.prompt_id = response["prompt_id"]
+                self.event_stream.subscribe(self.prompt_id, self._on_message)
             with self.lock:
-                self.last_event_time = threading.Event()
-            
-            self.ws = websocket.WebSocketApp(
-                f"ws://{self.server_address}/ws?clientId={self.client_id}",
-                on_message=self._on_message,
-                on_error=self._on_error,
-                on_close=self._on_close,
-                on_open=self._on_open
-            )
-            ws_thread = threading.Thread(target=self.ws.run_forever, daemon=True)
-            ws_thread.start()
-            print(f"Websocket - Monitoring Prompt ID: {self.prompt_id}")
+                self.last_event_time = time.time()
+            print(f"Websocket - Monitoring Prompt ID: {self.prompt_id}" + (f" (job {job_id})" if job_id else ""))
             return self.prompt_id
         except Exception as e:
+            self._unsubscribe()
             with self.lock:
                 # get the message body from the error
                 try:
@@ -140,6 +463,7 @@ class ComfyClient:
                     message = str(e)
                 self.current_status = {"status": "fail", "data": message}
                 self.status_event.set()
+                self.onStatusChanged(self.current_status)
                 print(f"Failed to submit prompt: {e}")
             return None
     
@@ -159,11 +483,85 @@ class ComfyClient:
                 return self.current_status
             if start_time.wait(self.timeout):
                 self.current_status = {"status": "timed out", "data": None}
-                self._close_ws()
+                self._unsubscribe()
                 return self.current_status
-    
+
+    def iter_statuses(self):
+        """
+        Yield every status transition of the submitted prompt the moment it is
+        received, ending with the final status.
+
+        The iterator gives up with a "timed out" status when no event arrives for
+        self.timeout seconds, and removes the prompt from ComfyUI. While the prompt
+        waits in the queue of ComfyUI, the events of the prompts ahead of it count
+        as progress, so a long queue alone never times it out.
+
+        Yields:
+            dict: The status, with the same structure as getStatus().
+        """
+        last_progress = time.time()
+        while True:
+            try:
+                status = self.status_queue.get(timeout=max(last_progress + self.timeout - time.time(), 0))
+            except queue.Empty:
+                if self.current_status["status"] in ("pending", "queued") and self.event_stream is not None:
+                    activity = self.event_stream.last_event_time
+                    if activity + self.timeout > time.time():
+                        last_progress = max(last_progress, activity)
+                        continue
+                with self.lock:
+                    if self.is_finished():
+                        return
+                    self.current_status = {"status": "timed out", "data": None}
+                # The event stream calls _on_message holding its lock, so its lock must
+                # never be taken while holding ours
+                self._unsubscribe()
+                self.cancel()
+                yield self.current_status
+                return
+            last_progress = time.time()
+            yield status
+            if status["status"] in FINISHED_STATUSES:
+                return
+
+    def cancel(self):
+        """
+        Remove the prompt from the queue of ComfyUI, or interrupt it if it is running,
+        so a prompt that was given up on does not keep the GPU busy.
+        """
+        if not self.prompt_id:
+            return
+        try:
+            with urllib.request.urlopen(f"http://{self.server_address}/queue", timeout=10) as response:
+                running = [task[1] for task in json.loads(response.read()).get("queue_running", []) if len(task) > 1]
+            if self.prompt_id in running:
+                path, payload = "/interrupt", {"prompt_id": self.prompt_id}
+            else:
+                path, payload = "/queue", {"delete": [self.prompt_id]}
+            req = urllib.request.Request(
+                f"http://{self.server_address}{path}",
+                data=json.dumps(payload).encode("utf-8"),
+                headers={"Content-Type": "application/json"},
+            )
+            urllib.request.urlopen(req, timeout=10).close()
+            print(f"Websocket - cancelled prompt {self.prompt_id} via {path}")
+        except Exception as e:
+            print(f"Websocket - failed to cancel prompt {self.prompt_id}: {e}")
+
+    def wait_until_finished(self):
+        """
+        Block until the prompt reaches a final status.
+
+        Returns:
+            dict: The final status.
+        """
+        status = self.getStatus()
+        for status in self.iter_statuses():
+            pass
+        return status
+
     def is_finished(self):
-        return self.current_status["status"] in ["completed", "error", "fail", "timed out"]
+        return self.current_status["status"] in FINISHED_STATUSES
 
 if __name__ == "__main__":
     import random
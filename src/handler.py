@@ -0,0 +1,10 @@
+# Entry point of the worker.
+#
+# The transcoder spawns its worker processes, and spawned processes import the
+# main script of their parent again. The top level of this script has no side
+# effects, so they do not set up the caches, uploads and callbacks of a second
+# worker next to the real one.
+if __name__ == "__main__":
+    import rp_handler
+
+    rp_handler.start()
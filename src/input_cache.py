@@ -0,0 +1,450 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+# Prefix of the files the content-addressed cache owns inside the ComfyUI input folder
+CACHE_FILE_PREFIX = "rpcache_"
+# Prefix of the files the URL cache owns inside the ComfyUI input folder
+URL_CACHE_FILE_PREFIX = "rpurl_"
+# Suffix of the files next to cached images that keep their metadata, e.g. the ETag
+METADATA_SUFFIX = ".meta.json"
+# Size of the chunks downloads are streamed to disk in
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Inputs of the core nodes that load an image from the input folder, used while the
+# node definitions of ComfyUI are not loaded
+IMAGE_INPUTS = frozenset({("LoadImage", "image"), ("LoadImageMask", "image")})
+# Suffix ComfyUI accepts on filenames to say they are in the input folder
+INPUT_ANNOTATION = " [input]"
+
+
+def digest(image_data):
+    """
+    Return the content hash of a base64 encoded image.
+
+    The encoded string is hashed as-is, so a repeated image is recognised without
+    decoding it.
+
+    Args:
+        image_data (str): The base64 encoded image.
+
+    Returns:
+        str: The hex encoded SHA-256 digest.
+    """
+    if isinstance(image_data, str):
+        image_data = image_data.encode("utf-8")
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def url_key(url):
+    """
+    Return the cache key of an image URL.
+
+    Args:
+        url (str): The URL of the image.
+
+    Returns:
+        str: The hex encoded SHA-256 digest of the URL.
+    """
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def safe_filename(name):
+    """
+    Reduce the name a client gave an image to a filename inside the input folder.
+
+    Args:
+        name (str): The name the client gave the image.
+
+    Returns:
+        str: The last component of the name.
+
+    Raises:
+        ValueError: If the name is absolute, refers to a parent folder or is empty.
+    """
+    parts = name.replace("\\", "/").split("/")
+    if os.path.isabs(name) or name.startswith("\\") or ".." in parts:
+        raise ValueError(f"invalid image name {name!r}")
+    filename = parts[-1]
+    if not filename or filename == ".":
+        raise ValueError(f"invalid image name {name!r}")
+    return filename
+
+
+def download_image(session, cache, url, name, timeout=60, job_id=None):
+    """
+    Make the image behind a URL available in the ComfyUI input folder.
+
+    A cached copy is revalidated with its ETag or Last-Modified date and reused
+    when the server answers 304. Otherwise the response is streamed straight
+    into the input folder and recorded in the cache.
+
+    Args:
+        session (requests.Session): The session to download with.
+        cache (InputImageCache): The URL cache; when it is disabled the image is
+            stored under its name and not cached.
+        url (str): The URL of the image.
+        name (str): The name the client gave the image.
+        timeout (float): Seconds to wait for the server.
+        job_id (str): The job that uses the image, see InputImageCache.release().
+
+    Returns:
+        tuple: (filename, hit, size) with the filename in the input folder, whether
+               the cached copy was reused and the size of the image in bytes.
+
+    Raises:
+        ValueError: If the name would place the image outside the input folder.
+    """
+    name = safe_filename(name)
+    key = url_key(url)
+    entry = cache.entry(key) if cache.enabled else None
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304 and entry is not None:
+            filename = cache.lookup(key, job_id)
+            if filename is not None:
+                return filename, True, entry["size"]
+            # The cached file vanished while revalidating, download it without validators
+            return download_image(session, cache, url, name, timeout, job_id)
+        response.raise_for_status()
+
+        filename = cache.filename_for(key, name) if cache.enabled else name
+        path = os.path.join(cache.input_path, filename)
+        partial_path = f"{path}.{uuid.uuid4().hex}.part"
+        size = 0
+        try:
+            with open(partial_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(partial_path, path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    cache.add(
+        key, filename, size, job_id,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
+    return filename, False, size
+
+
+def rewrite_workflow(workflow, renamed, image_inputs=IMAGE_INPUTS):
+    """
+    Point the image inputs of a workflow at the cached filenames of its images.
+
+    Only the inputs that load an image from the input folder are rewritten, other
+    inputs that happen to equal an image name (e.g. a filename_prefix) are kept.
+
+    Args:
+        workflow (dict): The workflow as sent by the client.
+        renamed (dict): Maps the image names used by the client to cached filenames.
+        image_inputs (set): The (class_type, input name) pairs that load an image.
+
+    Returns:
+        dict: The workflow itself if nothing was renamed, otherwise a copy with every
+              image input naming an original image, also in the "name.png [input]"
+              form, replaced by its cached filename.
+    """
+    if not renamed:
+        return workflow
+    rewritten = {}
+    for node_id, node in workflow.items():
+        inputs = node.get("inputs") if isinstance(node, dict) else None
+        if not isinstance(inputs, dict):
+            rewritten[node_id] = node
+            continue
+        class_type = node.get("class_type")
+        rewritten[node_id] = {
+            **node,
+            "inputs": {
+                key: _renamed(value, renamed) if (class_type, key) in image_inputs else value
+                for key, value in inputs.items()
+            },
+        }
+    return rewritten
+
+
+def _renamed(value, renamed):
+    if not isinstance(value, str):
+        return value
+    if value.endswith(INPUT_ANNOTATION):
+        name = value[:-len(INPUT_ANNOTATION)]
+        return renamed[name] + INPUT_ANNOTATION if name in renamed else value
+    return renamed.get(value, value)
+
+
+class InputImageCache:
+    """
+    Worker-local index of the input images already present in the ComfyUI input
+    folder, keyed by content hash or by URL.
+
+    Cached images are stored under filenames derived from their key, so two jobs
+    never overwrite each other's inputs. Metadata given to add() and the names the
+    image is linked under are kept in a JSON file next to the image, so a restarted
+    worker can still revalidate and clean it up. The least recently used files are
+    deleted together with their links once the cache grows beyond max_bytes or
+    max_entries, except for the ones jobs in flight use.
+    """
+
+    def __init__(self, input_path, max_bytes, max_entries=1000, prefix=CACHE_FILE_PREFIX):
+        self.input_path = input_path
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.pins = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _load(self):
+        # Files left behind by an earlier process of this worker are still valid
+        if not self.enabled or not os.path.isdir(self.input_path):
+            return
+        files = []
+        filenames = set(os.listdir(self.input_path))
+        for filename in filenames:
+            if not filename.startswith(self.prefix) or filename.endswith(".part"):
+                continue
+            if filename.endswith(METADATA_SUFFIX):
+                if filename[:-len(METADATA_SUFFIX)] not in filenames:
+                    self._remove(filename)
+                continue
+            stat = os.stat(os.path.join(self.input_path, filename))
+            files.append((stat.st_atime, filename, stat.st_size))
+        for _, filename, size in sorted(files):
+            key = os.path.splitext(filename[len(self.prefix):])[0]
+            entry = self.entries[key] = {**self._read_metadata(filename), "filename": filename, "size": size}
+            self.total_bytes += _entry_bytes(entry)
+        self._evict()
+
+    def _read_metadata(self, filename):
+        try:
+            with open(os.path.join(self.input_path, filename + METADATA_SUFFIX)) as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"runpod-worker-comfy - ignoring the metadata of {filename}: {e}")
+            return {}
+        return metadata if isinstance(metadata, dict) else {}
+
+    def _write_metadata(self, entry):
+        filename = entry["filename"]
+        metadata = {name: value for name, value in entry.items() if name not in ("filename", "size")}
+        path = os.path.join(self.input_path, filename + METADATA_SUFFIX)
+        if not metadata:
+            self._remove(filename + METADATA_SUFFIX)
+            return
+        partial_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            with open(partial_path, "w") as f:
+                json.dump(metadata, f)
+            os.replace(partial_path, path)
+        except OSError as e:
+            print(f"runpod-worker-comfy - could not keep the metadata of {filename}: {e}")
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    def _remove(self, filename):
+        try:
+            os.remove(os.path.join(self.input_path, filename))
+        except OSError:
+            pass
+
+    def _drop(self, key):
+        # Remove an entry with its links, unless the link name was taken by another file since
+        entry = self.entries.pop(key)
+        self.total_bytes -= _entry_bytes(entry)
+        for name, (inode, _) in entry.get("links", {}).items():
+            path = os.path.join(self.input_path, name)
+            try:
+                if os.stat(path).st_ino == inode:
+                    os.remove(path)
+            except OSError:
+                pass
+        return entry
+
+    def filename_for(self, key, name):
+        """
+        Return the content-addressed filename for an image.
+
+        Args:
+            key (str): The digest of the image.
+            name (str): The name the client gave the image, used for its extension.
+
+        Returns:
+            str: The filename to upload the image as.
+        """
+        extension = os.path.splitext(name)[1] or ".png"
+        return f"{self.prefix}{key}{extension}"
+
+    def link_original(self, filename, name):
+        """
+        Make a cached image also available under the name the client gave it, so
+        workflows that refer to it in a way rewrite_workflow does not rewrite still
+        find it. The file is hard linked, or copied where linking is not possible.
+
+        Args:
+            filename (str): The cached filename of the image.
+            name (str): The name the client gave the image.
+        """
+        try:
+            original = safe_filename(name)
+        except ValueError as e:
+            print(f"runpod-worker-comfy - not keeping the original name of {filename}: {e}")
+            return
+        if original == filename:
+            return
+        path = os.path.join(self.input_path, original)
+        partial_path = f"{path}.{uuid.uuid4().hex}.part"
+        copied = 0
+        try:
+            try:
+                os.link(os.path.join(self.input_path, filename), partial_path)
+            except OSError:
+                shutil.copyfile(os.path.join(self.input_path, filename), partial_path)
+                copied = os.path.getsize(partial_path)
+            inode = os.stat(partial_path).st_ino
+            os.replace(partial_path, path)
+        except OSError as e:
+            print(f"runpod-worker-comfy - could not keep the original name {original}: {e}")
+            return
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+        if not self.enabled:
+            return
+        # The link is removed with the entry, copies count towards the budget
+        key = os.path.splitext(filename[len(self.prefix):])[0]
+        with self.lock:
+            for other_key, other in self.entries.items():
+                if other_key != key and original in other.get("links", {}):
+                    self.total_bytes -= other["links"].pop(original)[1]
+                    self._write_metadata(other)
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            links = entry.setdefault("links", {})
+            self.total_bytes += copied - (links[original][1] if original in links else 0)
+            links[original] = [inode, copied]
+            self._write_metadata(entry)
+            self._evict()
+
+    def entry(self, key):
+        """
+        Return the metadata of a cached image without counting it as a hit.
+
+        Args:
+            key (str): The cache key of the image.
+
+        Returns:
+            dict: The entry with "filename", "size" and any metadata given to add(),
+                  or None if the image is not cached.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            return dict(entry) if entry is not None else None
+
+    def lookup(self, key, job_id=None):
+        """
+        Return the cached filename of an image if the input folder still holds it.
+
+        Args:
+            key (str): The digest of the image.
+            job_id (str): The job that uses the image on a hit, see release().
+
+        Returns:
+            str: The cached filename, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                path = os.path.join(self.input_path, entry["filename"])
+                if os.path.exists(path) and os.path.getsize(path) == entry["size"]:
+                    self.entries.move_to_end(key)
+                    self._pin(key, job_id)
+                    self.hits += 1
+                    return entry["filename"]
+                # The file was removed or replaced behind our back
+                self._drop(key)
+            self.misses += 1
+            return None
+
+    def add(self, key, filename, size, job_id=None, **metadata):
+        """
+        Record an image that was stored in the input folder.
+
+        Args:
+            key (str): The cache key of the image.
+            filename (str): The filename it was stored as.
+            size (int): The size of the decoded image in bytes.
+            job_id (str): The job that uses the image, see release().
+            **metadata: Additional values kept with the entry, e.g. the ETag of a download.
+        """
+        if not self.enabled:
+            return
+        metadata = {name: value for name, value in metadata.items() if value is not None}
+        entry = {"filename": filename, "size": size, **metadata}
+        with self.lock:
+            if key in self.entries:
+                # The links of the previous entry still point at the replaced file
+                self._drop(key)
+            self._write_metadata(entry)
+            self.entries[key] = entry
+            self.total_bytes += size
+            self._pin(key, job_id)
+            self._evict()
+
+    def _pin(self, key, job_id):
+        if job_id is not None:
+            self.pins.setdefault(job_id, set()).add(key)
+
+    def release(self, job_id):
+        """
+        Let the images a job used be evicted again, once the job finished.
+
+        Args:
+            job_id (str): The job given to lookup() or add().
+        """
+        with self.lock:
+            if self.pins.pop(job_id, None) is not None:
+                self._evict()
+
+    def _evict(self):
+        # Keep the most recently used entry even if it alone exceeds the budget
+        pinned = set().union(*self.pins.values())
+        for key in list(self.entries)[:-1]:
+            if self.total_bytes <= self.max_bytes and len(self.entries) <= self.max_entries:
+                break
+            if key in pinned:
+                continue
+            entry = self._drop(key)
+            self._remove(entry["filename"])
+            self._remove(entry["filename"] + METADATA_SUFFIX)
+
+
+def _entry_bytes(entry):
+    # Copies made where an image could not be linked under its original name take space too
+    return entry["size"] + sum(copied for _, copied in entry.get("links", {}).values())
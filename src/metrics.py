@@ -0,0 +1,214 @@
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the latency histograms in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, math.inf]
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues)) + (extra or [])
+    if not pairs:
+        return ""
+    escaped = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metric:
+    """
+    Base class of the metrics, holding one value per combination of label values.
+
+    Recording only takes a lock and updates a dictionary entry, so it is cheap
+    enough for the hot path of a job.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        self.function = None
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects the labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, function):
+        """
+        Read the value from function at scrape time instead of recording it.
+        Only metrics without labels support this.
+        """
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, "", self.function())]
+        with self.lock:
+            return [
+                (self.name, _format_labels(self.labelnames, key), value)
+                for key, value in sorted(self.values.items())
+            ]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = list(buckets)
+        if not math.isinf(self.buckets[-1]):
+            self.buckets.append(math.inf)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            entry["sum"] += value
+            entry["count"] += 1
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["buckets"][index] += 1
+                    break
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, entry in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, entry["buckets"]):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                    samples.append((f"{self.name}_bucket", labels, cumulative))
+                labels = _format_labels(self.labelnames, key)
+                samples.append((f"{self.name}_sum", labels, entry["sum"]))
+                samples.append((f"{self.name}_count", labels, entry["count"]))
+        return samples
+
+
+class Registry:
+    """
+    The set of metrics exposed by the worker.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+        """
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+JOBS = REGISTRY.register(Counter(
+    "comfy_worker_jobs_total", "Jobs handled by the worker, by result.", ["result"]))
+JOB_ERRORS = REGISTRY.register(Counter(
+    "comfy_worker_job_errors_total", "Jobs that did not complete in ComfyUI, by final status.", ["status"]))
+PHASE_SECONDS = REGISTRY.register(Histogram(
+    "comfy_worker_phase_seconds", "Time spent in each phase of a job.", ["phase"]))
+INPUT_BYTES = REGISTRY.register(Counter(
+    "comfy_worker_input_bytes_total", "Bytes of input images received, by source.", ["source"]))
+OUTPUT_BYTES = REGISTRY.register(Counter(
+    "comfy_worker_output_bytes_total", "Bytes of output images returned, by destination.", ["destination"]))
+TRANSFER_BYTES = REGISTRY.register(Counter(
+    "comfy_worker_transfer_bytes_total", "Bytes moved by uploads and downloads, by direction.", ["direction"]))
+TRANSFER_SECONDS = REGISTRY.register(Counter(
+    "comfy_worker_transfer_seconds_total", "Time spent in uploads and downloads, by direction.", ["direction"]))
+CALLBACK_SECONDS = REGISTRY.register(Histogram(
+    "comfy_worker_callback_seconds", "Latency of the status and result callbacks.", ["kind"]))
+WEBSOCKET_RECONNECTS = REGISTRY.register(Counter(
+    "comfy_worker_websocket_reconnects_total", "Reconnects of the shared ComfyUI event stream."))
+QUEUE_REMAINING = REGISTRY.register(Gauge(
+    "comfy_worker_comfy_queue_remaining", "Prompts queued or running in ComfyUI."))
+TRANSCODE_SECONDS = REGISTRY.register(Histogram(
+    "comfy_worker_transcode_seconds", "Time spent transcoding an output image, by format.", ["format"]))
+TRANSCODE_SAVED_BYTES = REGISTRY.register(Counter(
+    "comfy_worker_transcode_saved_bytes_total", "Bytes saved by transcoding output images, by format.", ["format"]))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    "comfy_worker_batch_size", "Prompts submitted together by the batch scheduler.", buckets=[1, 2, 4, 8, 16, 32]))
+BUCKET_DEDUP_SAVED_BYTES = REGISTRY.register(Counter(
+    "comfy_worker_bucket_dedup_saved_bytes_total", "Bytes of output images not uploaded because they were uploaded before."))
+MODEL_CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "comfy_worker_model_cache_lookups_total", "Models of jobs looked up in the local model cache, by result.", ["result"]))
+MODEL_CACHE_BYTES = REGISTRY.register(Gauge(
+    "comfy_worker_model_cache_bytes", "Bytes of models copied to the local model cache."))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to log
+        pass
+
+
+def start_http_server(port, host="0.0.0.0"):
+    """
+    Serve the metrics on http://host:port/metrics from a background thread.
+
+    Args:
+        port (int): The port to listen on.
+        host (str): The address to bind to.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"runpod-worker-comfy - serving metrics on http://{host}:{port}/metrics")
+    return server
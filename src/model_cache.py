@@ -0,0 +1,260 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# The model inputs of the loader nodes, by class_type: input name -> model folder
+LOADER_INPUTS = {
+    "CheckpointLoaderSimple": {"ckpt_name": "checkpoints"},
+    "CheckpointLoader": {"ckpt_name": "checkpoints"},
+    "ImageOnlyCheckpointLoader": {"ckpt_name": "checkpoints"},
+    "UNETLoader": {"unet_name": "unet"},
+    "UnetLoaderGGUF": {"unet_name": "unet"},
+    "VAELoader": {"vae_name": "vae"},
+    "CLIPLoader": {"clip_name": "clip"},
+    "CLIPLoaderGGUF": {"clip_name": "clip"},
+    "DualCLIPLoader": {"clip_name1": "clip", "clip_name2": "clip"},
+    "DualCLIPLoaderGGUF": {"clip_name1": "clip", "clip_name2": "clip"},
+    "TripleCLIPLoader": {"clip_name1": "clip", "clip_name2": "clip", "clip_name3": "clip"},
+    "CLIPVisionLoader": {"clip_name": "clip_vision"},
+    "ControlNetLoader": {"control_net_name": "controlnet"},
+    "UpscaleModelLoader": {"model_name": "upscale_models"},
+}
+# Input holding the LoRA of every LoRA loader, whatever its class_type
+LORA_INPUT = "lora_name"
+# Folders newer ComfyUI versions use for the same kind of model
+FOLDER_ALIASES = {
+    "unet": ["unet", "diffusion_models"],
+    "clip": ["clip", "text_encoders"],
+}
+
+
+def model_references(workflow):
+    """
+    List the model files the loader nodes of a workflow reference.
+
+    Args:
+        workflow (dict): The workflow in the ComfyUI API format.
+
+    Returns:
+        list: (folder, name) tuples without duplicates, in workflow order.
+    """
+    references = []
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get("inputs") or {}
+        model_inputs = dict(LOADER_INPUTS.get(node.get("class_type"), {}))
+        if LORA_INPUT in inputs and "lora" in str(node.get("class_type", "")).lower():
+            model_inputs[LORA_INPUT] = "loras"
+        for input_name, folder in model_inputs.items():
+            name = inputs.get(input_name)
+            # Linked inputs are lists, only literal filenames can be cached
+            if isinstance(name, str) and name and (folder, name) not in references:
+                references.append((folder, name))
+    return references
+
+
+class ModelCache:
+    """
+    Copies of network volume models on the local disk of the worker.
+
+    ComfyUI is configured to look into cache_path before the network volume (see
+    start.sh), so a model is read from local disk as soon as its copy exists.
+    Models referenced by a job are copied in the background by a single thread, so
+    a miss never delays the job and the volume is not read by several copies at
+    once. The least recently used copies are deleted once the cache grows beyond
+    max_bytes.
+    """
+
+    def __init__(self, cache_path, source_paths, max_bytes):
+        self.cache_path = cache_path
+        self.source_paths = list(source_paths)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.copying = set()
+        self.hits = 0
+        self.misses = 0
+        self.copies = 0
+        self.copy_ms = 0.0
+        self.copy_bytes = 0
+        self.executor = None
+        self._load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _load(self):
+        # Copies left behind by an earlier process of this worker are still valid
+        if not self.enabled or not os.path.isdir(self.cache_path):
+            return
+        files = []
+        for root, _, filenames in os.walk(self.cache_path):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if filename.endswith(".part"):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                key = os.path.relpath(path, self.cache_path).replace(os.sep, "/")
+                files.append((stat.st_atime, key, stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+        self._evict()
+
+    def resolve(self, folder, name):
+        """
+        Find a model on the network volume.
+
+        Args:
+            folder (str): The model folder, e.g. "checkpoints".
+            name (str): The filename as given in the workflow, may contain subfolders.
+
+        Returns:
+            str: The path of the model, or None if no source path holds it.
+        """
+        for source_path in self.source_paths:
+            for alias in FOLDER_ALIASES.get(folder, [folder]):
+                path = os.path.join(source_path, alias, name)
+                if os.path.isfile(path):
+                    return path
+        return None
+
+    def holds(self, folder, name):
+        """
+        Return whether a model is cached or being copied.
+
+        Args:
+            folder (str): The model folder, e.g. "checkpoints".
+            name (str): The filename as given in the workflow.
+
+        Returns:
+            bool: True if the model is read from local disk once it is loaded.
+        """
+        if not self.enabled:
+            return False
+        key = f"{folder}/{name}"
+        with self.lock:
+            return key in self.copying or (
+                key in self.entries and os.path.isfile(os.path.join(self.cache_path, key))
+            )
+
+    def prepare(self, workflow):
+        """
+        Make sure the models of a workflow are cached, copying missing ones in the background.
+
+        Args:
+            workflow (dict): The workflow in the ComfyUI API format.
+
+        Returns:
+            dict: The number of models that were cached ("hits") and that were not ("misses").
+        """
+        stats = {"hits": 0, "misses": 0}
+        if not self.enabled:
+            return stats
+        for folder, name in model_references(workflow):
+            key = f"{folder}/{name}"
+            with self.lock:
+                if key in self.entries and os.path.isfile(os.path.join(self.cache_path, key)):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    stats["hits"] += 1
+                    metrics.MODEL_CACHE_LOOKUPS.inc(result="hit")
+                    continue
+                if key in self.entries:
+                    # The copy was removed behind our back
+                    self.total_bytes -= self.entries.pop(key)
+                self.misses += 1
+                stats["misses"] += 1
+                metrics.MODEL_CACHE_LOOKUPS.inc(result="miss")
+                if key in self.copying:
+                    continue
+                source = self.resolve(folder, name)
+                if source is None:
+                    continue
+                self.copying.add(key)
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=1)
+            self.executor.submit(self._copy, key, source)
+        return stats
+
+    def _copy(self, key, source):
+        target = os.path.join(self.cache_path, key)
+        partial_path = f"{target}.{uuid.uuid4().hex}.part"
+        try:
+            size = os.path.getsize(source)
+            if size > self.max_bytes:
+                print(f"runpod-worker-comfy - model {key} does not fit into the model cache")
+                return
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            start_time = time.perf_counter()
+            shutil.copyfile(source, partial_path)
+            os.replace(partial_path, target)
+            elapsed = time.perf_counter() - start_time
+        except OSError as e:
+            print(f"runpod-worker-comfy - could not cache model {key}: {e}")
+            return
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            with self.lock:
+                self.copying.discard(key)
+
+        metrics.TRANSFER_BYTES.inc(size, direction="model_copy")
+        metrics.TRANSFER_SECONDS.inc(elapsed, direction="model_copy")
+        print(f"runpod-worker-comfy - cached model {key} ({size} bytes) in {round(elapsed * 1000)} ms")
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous
+            self.entries[key] = size
+            self.total_bytes += size
+            self.copies += 1
+            self.copy_ms += elapsed * 1000
+            self.copy_bytes += size
+            self._evict()
+
+    def stats(self):
+        """
+        Return the hit, miss and copy statistics of the cache.
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "copies": self.copies,
+                "copy_ms": round(self.copy_ms, 2),
+                "copy_bytes": self.copy_bytes,
+                "total_bytes": self.total_bytes,
+                "models": len(self.entries),
+            }
+
+    def wait(self):
+        """
+        Wait until the copies that were started are done.
+        """
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _evict(self):
+        # Keep the most recently used model even if it alone exceeds the budget
+        while len(self.entries) > 1 and self.total_bytes > self.max_bytes:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_path, key))
+            except OSError:
+                pass
+            print(f"runpod-worker-comfy - evicted model {key} from the model cache")
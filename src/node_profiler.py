@@ -0,0 +1,123 @@
+import json
+import math
+import threading
+from collections import deque
+
+# Upper bounds of the histogram buckets in milliseconds
+BUCKETS_MS = [10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, math.inf]
+
+
+class NodeStats:
+    """
+    Execution times of one node class: a cumulative histogram plus a rolling
+    window of the most recent samples for percentiles.
+    """
+
+    def __init__(self, window):
+        self.buckets = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.cached = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.recent = deque(maxlen=window)
+
+    def add(self, ms):
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.recent.append(ms)
+        for index, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[index] += 1
+                break
+
+    def percentile(self, fraction):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "cached": self.cached,
+            "total_ms": round(self.total_ms, 2),
+            "mean_ms": round(self.total_ms / self.count, 2) if self.count else None,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "max_ms": self.max_ms,
+            "buckets": {
+                ("+Inf" if math.isinf(bound) else str(bound)): count
+                for bound, count in zip(BUCKETS_MS, self.buckets)
+            },
+        }
+
+
+class NodeProfiler:
+    """
+    Aggregates the per-node timings of all jobs of the worker by class_type.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.dumper = None
+        self.stopped = threading.Event()
+
+    def record(self, node_timings):
+        """
+        Add the node timings of a finished job.
+
+        Args:
+            node_timings (list): Entries with "class_type", "ms" and "cached" as
+                collected by ComfyClient.
+        """
+        with self.lock:
+            for timing in node_timings:
+                stats = self.stats.get(timing["class_type"])
+                if stats is None:
+                    stats = self.stats[timing["class_type"]] = NodeStats(self.window)
+                if timing.get("cached"):
+                    stats.cached += 1
+                else:
+                    stats.add(timing["ms"])
+
+    def summary(self):
+        """
+        Return the aggregated statistics, the node classes that took the most
+        time in total first.
+        """
+        with self.lock:
+            ordered = sorted(self.stats.items(), key=lambda item: item[1].total_ms, reverse=True)
+            return {class_type: stats.summary() for class_type, stats in ordered}
+
+    def dump(self):
+        """
+        Emit the aggregated statistics as a single structured log line.
+        """
+        print(f"runpod-worker-comfy - node profile {json.dumps(self.summary(), separators=(',', ':'))}")
+
+    def start_dump(self, interval):
+        """
+        Dump the statistics every interval seconds in the background.
+        """
+        with self.lock:
+            if self.dumper is not None or interval <= 0:
+                return
+            self.dumper = threading.Thread(target=self._dump_periodically, args=(interval,), daemon=True)
+            self.dumper.start()
+
+    def stop_dump(self):
+        """
+        Stop the periodic dump.
+        """
+        self.stopped.set()
+        if self.dumper is not None:
+            self.dumper.join()
+            self.dumper = None
+
+    def _dump_periodically(self, interval):
+        while not self.stopped.wait(interval):
+            if self.stats:
+                self.dump()
@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+import requests
+
+# Input types whose literal values are checked, with the conversion ComfyUI applies to them
+LITERAL_TYPES = {
+    "INT": int,
+    "FLOAT": float,
+    "STRING": str,
+    "BOOLEAN": bool,
+}
+# Seconds between attempts to fetch the node definitions, doubled after every failure
+RETRY_INTERVAL_S = 10
+RETRY_INTERVAL_MAX_S = 300
+
+
+def custom_nodes_fingerprint(custom_nodes_path):
+    """
+    Return a hash of the installed custom nodes, which changes whenever a custom
+    node is added, removed or updated.
+
+    Args:
+        custom_nodes_path (str): The custom_nodes folder of ComfyUI.
+
+    Returns:
+        str: The hex encoded SHA-256 digest.
+    """
+    hasher = hashlib.sha256()
+    try:
+        entries = sorted(os.scandir(custom_nodes_path), key=lambda entry: entry.name)
+    except OSError:
+        entries = []
+    for entry in entries:
+        try:
+            mtime = entry.stat().st_mtime_ns
+        except OSError:
+            continue
+        hasher.update(f"{entry.name}\0{mtime}\0".encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def types_match(output_type, input_type):
+    """
+    Return whether an output of output_type may be linked to an input of input_type.
+    """
+    if not isinstance(output_type, str) or not isinstance(input_type, str):
+        return True
+    if output_type == "*" or input_type == "*":
+        return True
+    return bool(set(output_type.split(",")) & set(input_type.split(",")))
+
+
+def literal_matches(value, input_type):
+    """
+    Return whether a literal value fits an input of input_type.
+
+    ComfyUI converts literal values to the type of their input, e.g. "42" and 42.0
+    are valid seeds, so a value is accepted whenever that conversion succeeds.
+    """
+    if isinstance(input_type, list):
+        # Combo inputs, their options (e.g. model files) change too often to check them
+        return not isinstance(value, (dict, list))
+    convert = LITERAL_TYPES.get(input_type)
+    if convert is None:
+        return True
+    try:
+        convert(value)
+    except (TypeError, ValueError, OverflowError):
+        return False
+    return True
+
+
+class ObjectInfoSchema:
+    """
+    The node definitions of ComfyUI (its /object_info), used to validate workflows
+    before anything is uploaded or queued.
+
+    The definitions are fetched once and stored in cache_path together with a
+    fingerprint of the custom nodes, so a restarted worker reuses them until
+    custom nodes are added, removed or updated. While fetching them fails,
+    load_in_background retries with an exponential backoff.
+    """
+
+    def __init__(self, url, cache_path, custom_nodes_path, timeout=30):
+        self.url = url
+        self.cache_path = cache_path
+        self.custom_nodes_path = custom_nodes_path
+        self.timeout = timeout
+        self.nodes = None
+        self.image_input_pairs = None
+        self.lock = threading.Lock()
+        self.retry_interval = RETRY_INTERVAL_S
+        self.next_attempt = 0
+        self.loader = None
+
+    @property
+    def loaded(self):
+        return self.nodes is not None
+
+    def load(self):
+        """
+        Load the node definitions from the cache file, or fetch them from ComfyUI
+        if the custom nodes changed since they were cached.
+
+        Returns:
+            bool: True if the definitions are available.
+        """
+        with self.lock:
+            if self.nodes is not None:
+                return True
+            fingerprint = custom_nodes_fingerprint(self.custom_nodes_path)
+            try:
+                with open(self.cache_path, "r") as f:
+                    cached = json.load(f)
+                if cached.get("fingerprint") == fingerprint:
+                    self.nodes = cached["nodes"]
+                    print(f"runpod-worker-comfy - loaded {len(self.nodes)} node definitions from {self.cache_path}")
+                    return True
+            except (OSError, ValueError, KeyError):
+                pass
+
+            try:
+                response = requests.get(f"{self.url}/object_info", timeout=self.timeout)
+                response.raise_for_status()
+                nodes = response.json()
+            except (requests.RequestException, ValueError) as e:
+                print(f"runpod-worker-comfy - could not fetch the node definitions, workflows are not validated: {e}")
+                self.next_attempt = time.monotonic() + self.retry_interval
+                self.retry_interval = min(self.retry_interval * 2, RETRY_INTERVAL_MAX_S)
+                return False
+            self.nodes = nodes
+            print(f"runpod-worker-comfy - fetched {len(nodes)} node definitions")
+
+            partial_path = f"{self.cache_path}.{uuid.uuid4().hex}.part"
+            try:
+                with open(partial_path, "w") as f:
+                    json.dump({"fingerprint": fingerprint, "nodes": nodes}, f)
+                os.replace(partial_path, self.cache_path)
+            except OSError as e:
+                print(f"runpod-worker-comfy - could not cache the node definitions: {e}")
+            finally:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+            return True
+
+    def load_in_background(self):
+        """
+        Retry loading the node definitions in a background thread, unless they are
+        loaded, a retry is running or the backoff since the last failure has not
+        passed yet. Jobs are not validated until the definitions are loaded.
+        """
+        with self.lock:
+            if self.nodes is not None or time.monotonic() < self.next_attempt:
+                return
+            if self.loader is not None and self.loader.is_alive():
+                return
+            self.loader = threading.Thread(target=self.load, daemon=True)
+            self.loader.start()
+
+    def image_inputs(self):
+        """
+        Return the (class_type, input name) pairs of the inputs that load an image
+        uploaded to the input folder, or None while the definitions are not loaded.
+        """
+        nodes = self.nodes
+        if nodes is None:
+            return None
+        if self.image_input_pairs is None:
+            pairs = set()
+            for class_type, definition in nodes.items():
+                specs = definition.get("input") or {}
+                for section in ("required", "optional"):
+                    for name, spec in (specs.get(section) or {}).items():
+                        if isinstance(spec, list) and len(spec) > 1 and isinstance(spec[1], dict) \
+                                and spec[1].get("image_upload"):
+                            pairs.add((class_type, name))
+            self.image_input_pairs = frozenset(pairs)
+        return self.image_input_pairs
+
+    def validate(self, workflow, node_ids=None):
+        """
+        Check the nodes, required inputs, links and literal input types of a workflow.
+
+        Workflows are not validated while the node definitions are not loaded.
+
+        Args:
+            workflow (dict): The workflow in the ComfyUI API format.
+            node_ids (list): The ids of the nodes to check, e.g. the ones a job
+                changed in a template that was checked already. All nodes by default.
+
+        Returns:
+            str: A description of the first problem found, or None if there is none.
+        """
+        nodes = self.nodes
+        if nodes is None:
+            return None
+        if not isinstance(workflow, dict):
+            return "The workflow must be an object of nodes"
+        if node_ids is None:
+            checked = workflow.items()
+        else:
+            checked = ((node_id, workflow.get(node_id)) for node_id in node_ids)
+        for node_id, node in checked:
+            if not isinstance(node, dict):
+                return f"Node {node_id} must be an object"
+            class_type = node.get("class_type")
+            definition = nodes.get(class_type)
+            if definition is None:
+                return f"Node {node_id} has an unknown class_type '{class_type}'"
+            inputs = node.get("inputs") or {}
+            specs = definition.get("input") or {}
+            required = specs.get("required") or {}
+            optional = specs.get("optional") or {}
+            for name in required:
+                if name not in inputs:
+                    return f"Node {node_id} ({class_type}) is missing the required input '{name}'"
+            for name, value in inputs.items():
+                spec = required.get(name) or optional.get(name)
+                if not spec:
+                    continue
+                input_type = spec[0]
+                if isinstance(value, list):
+                    problem = self._check_link(workflow, node_id, name, value, input_type)
+                    if problem is not None:
+                        return problem
+                elif not literal_matches(value, input_type):
+                    return f"Node {node_id} ({class_type}) has an invalid value for input '{name}' of type {input_type}: {value!r}"
+        return None
+
+    def _check_link(self, workflow, node_id, name, link, input_type):
+        if len(link) != 2 or not isinstance(link[1], int):
+            return f"Node {node_id} has an invalid link for input '{name}': {link!r}"
+        source = workflow.get(str(link[0]))
+        if not isinstance(source, dict):
+            return f"Node {node_id} links input '{name}' to the missing node {link[0]}"
+        outputs = (self.nodes.get(source.get("class_type")) or {}).get("output") or []
+        if not 0 <= link[1] < len(outputs):
+            return f"Node {node_id} links input '{name}' to the missing output {link[1]} of node {link[0]}"
+        if not types_match(outputs[link[1]], input_type):
+            return (
+                f"Node {node_id} links input '{name}' of type {input_type} "
+                f"to output {link[1]} of node {link[0]} of type {outputs[link[1]]}"
+            )
+        return None
@@ -0,0 +1,50 @@
+import threading
+
+
+def base64_size(size):
+    """
+    Return the length of the base64 encoding of size bytes.
+    """
+    return 4 * ((size + 2) // 3)
+
+
+class InlineBudget:
+    """
+    The number of bytes of base64 encoded images a single result may hold.
+
+    Images are returned inline while they fit. Once an image does not fit, the
+    budget is exhausted and all images processed after it are spilled to the
+    bucket, even smaller ones.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.exhausted = False
+        self.spilled = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        """
+        Reserve room for an image of size bytes.
+
+        Args:
+            size (int): The size of the raw image in bytes.
+
+        Returns:
+            bool: True if the image may be returned inline, False if it has to be spilled.
+        """
+        encoded_size = base64_size(size)
+        with self.lock:
+            if not self.exhausted and self.used + encoded_size <= self.max_bytes:
+                self.used += encoded_size
+                return True
+            self.exhausted = True
+            return False
+
+    def spill(self):
+        """
+        Count an image that was uploaded to the bucket instead of returned inline.
+        """
+        with self.lock:
+            self.spilled += 1
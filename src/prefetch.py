@@ -0,0 +1,190 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+import metrics
+from model_cache import FOLDER_ALIASES, model_references
+
+# Size of the chunks model files are read ahead in
+READ_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def load_model_paths(config_paths):
+    """
+    Collect the extra model folders ComfyUI searches, in the order it searches them.
+
+    Args:
+        config_paths (list): extra_model_paths.yaml files; missing files are skipped.
+
+    Returns:
+        tuple: (first, last) dictionaries from model folder name to the folders
+               that are searched before and after the models folder of ComfyUI,
+               as ComfyUI puts the paths of "is_default" configs first.
+    """
+    first, last = {}, {}
+    for config_path in config_paths:
+        if not os.path.isfile(config_path):
+            continue
+        with open(config_path, "r") as f:
+            configs = yaml.safe_load(f) or {}
+        for config in configs.values():
+            if not isinstance(config, dict):
+                continue
+            base_path = os.path.expandvars(os.path.expanduser(config.get("base_path", "")))
+            target = first if config.get("is_default") else last
+            for folder, paths in config.items():
+                if folder in ("base_path", "is_default") or paths is None:
+                    continue
+                for path in str(paths).split("\n"):
+                    path = path.strip()
+                    if path:
+                        target.setdefault(folder, []).append(os.path.join(base_path, path))
+    return first, last
+
+
+class ModelPrefetcher:
+    """
+    Reads the model files of a workflow ahead of ComfyUI, so that its loader nodes
+    find them in the page cache instead of reading them from network storage.
+
+    A small pool of background threads asks the kernel to read the files ahead
+    with posix_fadvise(POSIX_FADV_WILLNEED) while the job uploads its inputs and
+    waits in the ComfyUI queue. The kernel only reads the pages that are not in
+    the page cache yet, so models that stayed resident cost nothing. Where
+    posix_fadvise is not available the files are read instead. At most max_bytes,
+    capped at the available memory, are read ahead per workflow. Models the
+    model_cache holds or is copying are left alone, they are read from local disk
+    or the copy already reads them.
+    """
+
+    def __init__(self, models_dir, config_paths, max_bytes, workers=2, model_cache=None):
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.models_dir = models_dir
+        self.model_cache = model_cache
+        self.first, self.last = load_model_paths(config_paths)
+        self.lock = threading.Lock()
+        self.reading = set()
+        self.executor = None
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def search_dirs(self, folder):
+        """
+        Return the folders ComfyUI searches for a kind of model, in search order.
+        """
+        aliases = FOLDER_ALIASES.get(folder, [folder])
+        dirs = []
+        for alias in aliases:
+            dirs.extend(self.first.get(alias, []))
+        dirs.extend(os.path.join(self.models_dir, alias) for alias in aliases)
+        for alias in aliases:
+            dirs.extend(self.last.get(alias, []))
+        return dirs
+
+    def resolve(self, folder, name):
+        """
+        Find the file ComfyUI will load for a model.
+
+        Args:
+            folder (str): The model folder, e.g. "checkpoints".
+            name (str): The filename as given in the workflow.
+
+        Returns:
+            str: The path of the model, or None if it is not found.
+        """
+        for directory in self.search_dirs(folder):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def prefetch(self, workflow):
+        """
+        Start reading the models of a workflow ahead in the background.
+
+        Args:
+            workflow (dict): The workflow in the ComfyUI API format.
+
+        Returns:
+            list: The paths of the files that are read ahead.
+        """
+        if not self.enabled:
+            return []
+        budget = min(self.max_bytes, available_memory())
+        scheduled = []
+        for folder, name in model_references(workflow):
+            if self.model_cache is not None and self.model_cache.holds(folder, name):
+                continue
+            path = self.resolve(folder, name)
+            if path is None:
+                continue
+            size = os.path.getsize(path)
+            with self.lock:
+                if path in self.reading:
+                    continue
+                if size > budget:
+                    continue
+                budget -= size
+                self.reading.add(path)
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.workers)
+            self.executor.submit(self._read, path)
+            scheduled.append(path)
+        return scheduled
+
+    def _read(self, path):
+        start_time = time.perf_counter()
+        size = 0
+        try:
+            with open(path, "rb", buffering=0) as f:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                    print(f"runpod-worker-comfy - asked the kernel to read ahead {path}")
+                    return
+                buffer = bytearray(READ_CHUNK_SIZE)
+                while True:
+                    read = f.readinto(buffer)
+                    if not read:
+                        break
+                    size += read
+        except OSError as e:
+            print(f"runpod-worker-comfy - could not read ahead {path}: {e}")
+            return
+        finally:
+            with self.lock:
+                self.reading.discard(path)
+        elapsed = time.perf_counter() - start_time
+        metrics.TRANSFER_BYTES.inc(size, direction="model_prefetch")
+        metrics.TRANSFER_SECONDS.inc(elapsed, direction="model_prefetch")
+        print(f"runpod-worker-comfy - read ahead {path} ({size} bytes) in {round(elapsed * 1000)} ms")
+
+    def wait(self):
+        """
+        Wait until the read-aheads that were started are done.
+        """
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def available_memory():
+    """
+    Return the memory available for the page cache in bytes, read from /proc/meminfo.
+    Without /proc/meminfo the memory is assumed to be unlimited.
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return float("inf")
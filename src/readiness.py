@@ -0,0 +1,113 @@
+import threading
+import time
+
+import requests
+
+# Longest pause between two probes while waiting for ComfyUI to come up, in seconds
+MAX_BACKOFF = 1.0
+
+
+class ComfyReadiness:
+    """
+    Cached health state of the ComfyUI server.
+
+    wait_until_ready() blocks once at startup, probing the server with exponential
+    backoff. Afterwards start_monitor() keeps the state fresh in the background:
+    while the shared event stream is connected ComfyUI is known to be alive,
+    otherwise the server is probed over HTTP. Jobs read the state with is_ready()
+    and never probe on their own.
+    """
+
+    def __init__(self, url, event_stream=None, refresh_interval=5, probe_timeout=2):
+        self.url = url
+        self.event_stream = event_stream
+        self.refresh_interval = refresh_interval
+        self.probe_timeout = probe_timeout
+        self.ready = False
+        self.checked = False
+        self.lock = threading.Lock()
+        self.monitor = None
+        self.stopped = threading.Event()
+
+    def probe(self):
+        """
+        Probe ComfyUI once over HTTP.
+
+        Returns:
+            bool: True if the server answered with status 200.
+        """
+        try:
+            return requests.get(self.url, timeout=self.probe_timeout).status_code == 200
+        except requests.RequestException:
+            return False
+
+    def wait_until_ready(self, timeout, initial_delay=0.05):
+        """
+        Wait for ComfyUI to come up, backing off exponentially between probes.
+
+        Args:
+            timeout (float): Seconds to wait at most.
+            initial_delay (float): Seconds to wait after the first failed probe.
+
+        Returns:
+            bool: True if ComfyUI is reachable.
+        """
+        start_time = time.monotonic()
+        delay = initial_delay
+        last_log = start_time
+        while True:
+            if self.probe():
+                print(f"runpod-worker-comfy - API is reachable after {round((time.monotonic() - start_time) * 1000)} ms.")
+                self._set(True)
+                return True
+            now = time.monotonic()
+            if now - start_time >= timeout:
+                print(f"runpod-worker-comfy - Failed to connect to server at {self.url} after {timeout} s.")
+                self._set(False)
+                return False
+            # Log message every 5 seconds
+            if now - last_log >= 5:
+                print("Still waiting on the server to come up...")
+                last_log = now
+            time.sleep(min(delay, timeout - (now - start_time)))
+            delay = min(delay * 2, MAX_BACKOFF)
+
+    def start_monitor(self):
+        """
+        Refresh the health state every refresh_interval seconds in the background.
+        """
+        with self.lock:
+            if self.monitor is not None:
+                return
+            self.monitor = threading.Thread(target=self._monitor, daemon=True)
+            self.monitor.start()
+
+    def stop_monitor(self):
+        """
+        Stop the background refresh.
+        """
+        self.stopped.set()
+        if self.monitor is not None:
+            self.monitor.join()
+            self.monitor = None
+
+    def is_ready(self):
+        """
+        Return the cached health state without touching the network.
+        """
+        return self.ready
+
+    def _monitor(self):
+        while not self.stopped.wait(self.refresh_interval):
+            if self.event_stream is not None and self.event_stream.connected.is_set():
+                self._set(True)
+            else:
+                self._set(self.probe())
+
+    def _set(self, ready):
+        with self.lock:
+            changed = self.checked and ready != self.ready
+            self.ready = ready
+            self.checked = True
+        if changed:
+            print(f"runpod-worker-comfy - ComfyUI is {'reachable again' if ready else 'no longer reachable'}")
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import input_cache
+
+
+def workflow_key(workflow, images, template_key=None, variant=None):
+    """
+    Return the canonical hash of a workflow and its input images.
+
+    Args:
+        workflow (dict): The workflow as sent by the client.
+        images (list): The input images of the job, each with 'name' and 'image'.
+        template_key (str): The key of the template and overrides the workflow was
+            built from, hashed instead of the workflow.
+        variant (str): Identifies options that change the output of the same
+            workflow, e.g. the output format.
+
+    Returns:
+        str: The hex encoded SHA-256 digest, identical for identical jobs.
+    """
+    hasher = hashlib.sha256()
+    if template_key is not None:
+        hasher.update(b"template\0" + template_key.encode("utf-8"))
+    else:
+        hasher.update(json.dumps(workflow, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+    for image in sorted(images or [], key=lambda image: image["name"]):
+        hasher.update(b"\0" + image["name"].encode("utf-8") + b"\0")
+        hasher.update(input_cache.digest(image["image"]).encode("utf-8"))
+    if variant is not None:
+        hasher.update(b"\0variant\0" + variant.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def is_cacheable(workflow, images, excluded_classes):
+    """
+    Check whether the outputs of a job only depend on its workflow and inputs.
+
+    Args:
+        workflow (dict): The workflow as sent by the client.
+        images (list): The input images of the job.
+        excluded_classes (set): Node classes that are not deterministic.
+
+    Returns:
+        bool: False if the workflow uses an excluded node class or an input image
+              is given by URL, whose content can change behind the same URL.
+    """
+    if any("image" not in image for image in images or []):
+        return False
+    return not any(
+        isinstance(node, dict) and node.get("class_type") in excluded_classes
+        for node in workflow.values()
+    )
+
+
+class ResultCache:
+    """
+    Disk-backed cache of job results keyed by workflow_key().
+
+    Every result is stored as a JSON file in path. Results expire after ttl
+    seconds and the least recently used ones are deleted once the cache grows
+    beyond max_bytes.
+    """
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.json")
+
+    def _load(self):
+        if not self.enabled or not os.path.isdir(self.path):
+            return
+        files = []
+        for filename in os.listdir(self.path):
+            if not filename.endswith(".json"):
+                continue
+            stat = os.stat(os.path.join(self.path, filename))
+            files.append((stat.st_mtime, filename[:-len(".json")], stat.st_size))
+        for created, key, size in sorted(files):
+            self.entries[key] = {"size": size, "created": created}
+            self.total_bytes += size
+        self._evict()
+
+    def get(self, key):
+        """
+        Return the stored result of a job.
+
+        Args:
+            key (str): The workflow_key() of the job.
+
+        Returns:
+            dict: The stored result, or None if it is missing or expired.
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry["created"] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        try:
+            with open(self._file(key), "r") as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            with self.lock:
+                self._remove(key)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """
+        Store the result of a job.
+
+        Args:
+            key (str): The workflow_key() of the job.
+            result (dict): The JSON serializable result.
+        """
+        if not self.enabled:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        data = json.dumps(result).encode("utf-8")
+        # Write to a temporary file first so readers never see a partial result
+        partial_path = f"{self._file(key)}.{uuid.uuid4().hex}.part"
+        with open(partial_path, "wb") as f:
+            f.write(data)
+        os.replace(partial_path, self._file(key))
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous["size"]
+            self.entries[key] = {"size": len(data), "created": time.time()}
+            self.total_bytes += len(data)
+            self._evict()
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry["size"]
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.entries and self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
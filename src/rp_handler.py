@@ -1,31 +1,207 @@
 import runpod
 from runpod.serverless.utils import rp_upload
+import asyncio
+import atexit
 import urllib.request
 import urllib.parse
 import time
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import base64
-from io import BytesIO
+import mimetypes
+import uuid
 import websocket
 import json
 import urllib.request
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 import comfyclient
+import batching
+import bucket_upload
+import callbacks
+import input_cache
+import metrics
+import model_cache
+import node_profiler
+import output_budget
+import object_info
+import prefetch
+import readiness
+import result_cache
+import templates
+import tracing
+import transcode
+import warmup
 
 # Time to wait between API check attempts in milliseconds
 COMFY_API_AVAILABLE_INTERVAL_MS = 50
 # Maximum number of API check attempts
 COMFY_API_AVAILABLE_MAX_RETRIES = 6000
-# Time to wait between poll attempts in milliseconds
-COMFY_POLLING_INTERVAL_MS = os.environ.get("COMFY_POLLING_INTERVAL_MS", 250)
-# Maximum number of poll attempts
-COMFY_POLLING_MAX_RETRIES = os.environ.get("COMFY_POLLING_MAX_RETRIES", 500)
+# Seconds between two refreshes of the cached ComfyUI health state
+COMFY_HEALTH_INTERVAL_S = float(os.environ.get("COMFY_HEALTH_INTERVAL_S", 5))
 # Host where ComfyUI is running
 COMFY_HOST = "127.0.0.1:8188"
 # Enforce a clean state after each job is done
 # see https://docs.runpod.io/docs/handler-additional-controls#refresh-worker
 REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
+# Maximum number of jobs that a single worker keeps in flight against ComfyUI.
+# Values above 1 switch the worker to the async handler.
+COMFY_MAX_CONCURRENCY = max(1, int(os.environ.get("COMFY_MAX_CONCURRENCY", 1)))
+# The path where ComfyUI reads its input images from
+COMFY_INPUT_PATH = os.environ.get("COMFY_INPUT_PATH", "/comfyui/input")
+# Size budget of the content-addressed input image cache in bytes, 0 disables it
+INPUT_CACHE_MAX_BYTES = int(os.environ.get("INPUT_CACHE_MAX_BYTES", 2 * 1024**3))
+# Number of input images that are decoded and uploaded to ComfyUI at the same time
+COMFY_UPLOAD_WORKERS = max(1, int(os.environ.get("COMFY_UPLOAD_WORKERS", 4)))
+# Size budget of the cache of images downloaded from 'images[].url' in bytes, 0 disables it
+INPUT_URL_CACHE_MAX_BYTES = int(os.environ.get("INPUT_URL_CACHE_MAX_BYTES", 2 * 1024**3))
+# Number of input images that are downloaded from their URL at the same time
+INPUT_DOWNLOAD_WORKERS = max(1, int(os.environ.get("INPUT_DOWNLOAD_WORKERS", 4)))
+# Seconds to wait for the server of an input image URL
+INPUT_DOWNLOAD_TIMEOUT = float(os.environ.get("INPUT_DOWNLOAD_TIMEOUT", 60))
+# Size budget of the deterministic result cache in bytes, 0 disables it
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 0))
+# Seconds a cached result is served for
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", 3600))
+# Folder the cached results are stored in
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", "/tmp/result-cache")
+# Node classes whose output is not deterministic; workflows using them are never cached
+RESULT_CACHE_EXCLUDED_NODES = {
+    name.strip() for name in os.environ.get("RESULT_CACHE_EXCLUDED_NODES", "").split(",") if name.strip()
+}
+# Seconds between two dumps of the per-node execution profile to the log, 0 disables them
+NODE_PROFILE_DUMP_INTERVAL_S = float(os.environ.get("NODE_PROFILE_DUMP_INTERVAL_S", 300))
+# Number of threads that send status and result callbacks
+CALLBACK_WORKERS = max(1, int(os.environ.get("CALLBACK_WORKERS", 2)))
+# Seconds to wait for a callback endpoint to answer
+CALLBACK_TIMEOUT_S = float(os.environ.get("CALLBACK_TIMEOUT_S", 10))
+# Number of times a failed callback is retried, with exponential backoff
+CALLBACK_RETRIES = int(os.environ.get("CALLBACK_RETRIES", 3))
+# Seconds the worker waits for undelivered result callbacks before it stops
+CALLBACK_FLUSH_TIMEOUT_S = float(os.environ.get("CALLBACK_FLUSH_TIMEOUT_S", 60))
+# Port of the Prometheus metrics endpoint, unset disables it
+METRICS_PORT = os.environ.get("METRICS_PORT")
+# Number of output images that are fetched, encoded and uploaded at the same time
+COMFY_OUTPUT_WORKERS = max(1, int(os.environ.get("COMFY_OUTPUT_WORKERS", 4)))
+# Number of processes output images are transcoded in, 0 transcodes them in the handler process
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", os.cpu_count() or 1))
+# Bytes of base64 encoded images a result may hold, further images are uploaded to the bucket. 0 disables the limit
+OUTPUT_INLINE_MAX_BYTES = int(os.environ.get("OUTPUT_INLINE_MAX_BYTES", 0))
+# Layout of the keys output images are uploaded under, see README
+BUCKET_KEY_TEMPLATE = os.environ.get("BUCKET_KEY_TEMPLATE", bucket_upload.DEFAULT_KEY_TEMPLATE)
+# Number of output images that are uploaded to the bucket at the same time, across all jobs
+BUCKET_UPLOAD_CONCURRENCY = max(1, int(os.environ.get("BUCKET_UPLOAD_CONCURRENCY", 8)))
+# Images larger than this many bytes are uploaded in parts of this size
+BUCKET_MULTIPART_THRESHOLD = int(os.environ.get("BUCKET_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+# Folder images are stored in instead of the bucket when it has no credentials, the same as rp_upload uses
+SIMULATED_UPLOAD_PATH = "simulated_uploaded"
+# Upload output images under keys derived from their content and never upload the same image twice
+BUCKET_DEDUP = os.environ.get("BUCKET_DEDUP", "false").lower() == "true"
+# File the content digests of the uploaded images are kept in, empty keeps them in memory only
+BUCKET_DEDUP_INDEX_PATH = os.environ.get("BUCKET_DEDUP_INDEX_PATH", "/tmp/bucket-index.jsonl")
+# Stream progress events and output images while the job runs instead of returning them at the end
+STREAM_OUTPUT = os.environ.get("STREAM_OUTPUT", "false").lower() == "true"
+# Folder on the local disk models are copied to, ComfyUI looks there before the network volume
+MODEL_CACHE_PATH = os.environ.get("MODEL_CACHE_PATH", "/tmp/ckpts")
+# Size budget of the local model cache in bytes, 0 disables it
+MODEL_CACHE_MAX_BYTES = int(os.environ.get("MODEL_CACHE_MAX_BYTES", 0))
+# Comma separated folders the models are copied from, each holding the model folders like "checkpoints"
+MODEL_CACHE_SOURCES = [
+    path.strip()
+    for path in os.environ.get("MODEL_CACHE_SOURCES", "/comfyui/models,/runpod-volume/additional-models/models").split(",")
+    if path.strip()
+]
+# Bytes of model files read ahead per job while its inputs are uploaded, 0 disables the read-ahead
+MODEL_PREFETCH_MAX_BYTES = int(os.environ.get("MODEL_PREFETCH_MAX_BYTES", 0))
+# Number of model files that are read ahead at the same time
+MODEL_PREFETCH_WORKERS = max(1, int(os.environ.get("MODEL_PREFETCH_WORKERS", 2)))
+# The models folder of ComfyUI
+COMFY_MODELS_PATH = os.environ.get("COMFY_MODELS_PATH", "/comfyui/models")
+# Comma separated extra_model_paths.yaml files ComfyUI is started with
+COMFY_EXTRA_MODEL_PATHS = [
+    path.strip()
+    for path in os.environ.get("COMFY_EXTRA_MODEL_PATHS", "/comfyui/extra_model_paths.yaml,/model_cache_paths.yaml").split(",")
+    if path.strip()
+]
+# Milliseconds a prompt waits for prompts of other jobs with the same workflow structure, 0 disables batching
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", 0))
+# Maximum number of prompts that are submitted together
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 8))
+# Comma separated inputs whose values may differ between the workflows of a batch
+BATCH_INPUTS = [
+    name.strip()
+    for name in os.environ.get("BATCH_INPUTS", "seed,noise_seed,text").split(",")
+    if name.strip()
+]
+# Folder of the workflow templates jobs can refer to by "template_id", loaded at startup
+WORKFLOW_TEMPLATES_PATH = os.environ.get("WORKFLOW_TEMPLATES_PATH", "/templates")
+# Validate workflows against the node definitions of ComfyUI before anything is uploaded
+VALIDATE_WORKFLOWS = os.environ.get("VALIDATE_WORKFLOWS", "true").lower() == "true"
+# File the node definitions of ComfyUI are cached in
+OBJECT_INFO_CACHE_PATH = os.environ.get("OBJECT_INFO_CACHE_PATH", "/tmp/object_info.json")
+# The custom_nodes folder of ComfyUI, the cached node definitions are refreshed when it changes
+COMFY_CUSTOM_NODES_PATH = os.environ.get("COMFY_CUSTOM_NODES_PATH", "/comfyui/custom_nodes")
+# Comma separated workflow files or folders that are run once before the first job, to preload their models
+WARMUP_WORKFLOWS = os.environ.get("WARMUP_WORKFLOWS", "")
+# Seconds a warm-up workflow may go without any progress
+WARMUP_TIMEOUT_S = float(os.environ.get("WARMUP_TIMEOUT_S", 600))
+
+
+# Health of ComfyUI, checked once at startup and refreshed in the background
+READINESS = readiness.ComfyReadiness(f"http://{COMFY_HOST}", refresh_interval=COMFY_HEALTH_INTERVAL_S)
+
+# Execution times of the nodes of all jobs, aggregated by class_type
+NODE_PROFILER = node_profiler.NodeProfiler()
+
+# Sends the status and result callbacks of all jobs in the background
+CALLBACKS = callbacks.CallbackDispatcher(
+    workers=CALLBACK_WORKERS, timeout=CALLBACK_TIMEOUT_S, retries=CALLBACK_RETRIES
+)
+# Results that are still queued when the worker stops must not be lost
+atexit.register(CALLBACKS.flush, CALLBACK_FLUSH_TIMEOUT_S)
+
+# Pooled HTTP connections to ComfyUI, shared by all jobs of this worker
+COMFY_SESSION = requests.Session()
+COMFY_SESSION.mount("http://", HTTPAdapter(pool_maxsize=COMFY_UPLOAD_WORKERS * COMFY_MAX_CONCURRENCY))
+
+# Pooled HTTP connections for downloading input images from their URL
+DOWNLOAD_SESSION = requests.Session()
+DOWNLOAD_SESSION.mount("http://", HTTPAdapter(pool_maxsize=INPUT_DOWNLOAD_WORKERS * COMFY_MAX_CONCURRENCY))
+DOWNLOAD_SESSION.mount("https://", HTTPAdapter(pool_maxsize=INPUT_DOWNLOAD_WORKERS * COMFY_MAX_CONCURRENCY))
+
+# Input images already present in the ComfyUI input folder, shared by all jobs of this worker
+INPUT_CACHE = input_cache.InputImageCache(COMFY_INPUT_PATH, INPUT_CACHE_MAX_BYTES)
+URL_CACHE = input_cache.InputImageCache(
+    COMFY_INPUT_PATH, INPUT_URL_CACHE_MAX_BYTES, prefix=input_cache.URL_CACHE_FILE_PREFIX
+)
+# Results of deterministic jobs, returned again for exact repeats
+RESULT_CACHE = result_cache.ResultCache(RESULT_CACHE_PATH, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL)
+# The node definitions of ComfyUI, loaded once ComfyUI is up
+OBJECT_INFO = object_info.ObjectInfoSchema(f"http://{COMFY_HOST}", OBJECT_INFO_CACHE_PATH, COMFY_CUSTOM_NODES_PATH)
+# Uploads the output images to the bucket over a pooled client
+UPLOADER = bucket_upload.BucketUploader.from_env(
+    BUCKET_KEY_TEMPLATE,
+    BUCKET_UPLOAD_CONCURRENCY,
+    BUCKET_MULTIPART_THRESHOLD,
+    index=bucket_upload.UploadIndex(BUCKET_DEDUP_INDEX_PATH) if BUCKET_DEDUP else None,
+)
+# Transcodes the outputs of jobs that ask for an output_format
+TRANSCODER = transcode.Transcoder(TRANSCODE_WORKERS)
+# Workflows jobs can refer to instead of sending them
+TEMPLATES = templates.TemplateRegistry(WORKFLOW_TEMPLATES_PATH)
+# Groups the prompts of concurrent jobs that only differ in BATCH_INPUTS, there
+# is nothing to group when the worker runs one job at a time
+BATCHER = batching.BatchScheduler(
+    BATCH_WINDOW_MS / 1000 if COMFY_MAX_CONCURRENCY > 1 else 0, BATCH_MAX_SIZE, BATCH_INPUTS
+)
+# Local copies of the models the jobs use
+MODEL_CACHE = model_cache.ModelCache(MODEL_CACHE_PATH, MODEL_CACHE_SOURCES, MODEL_CACHE_MAX_BYTES)
+# Reads the models of a job into the page cache before ComfyUI loads them
+MODEL_PREFETCHER = prefetch.ModelPrefetcher(
+    COMFY_MODELS_PATH, COMFY_EXTRA_MODEL_PATHS, MODEL_PREFETCH_MAX_BYTES,
+    workers=MODEL_PREFETCH_WORKERS, model_cache=MODEL_CACHE,
+)
 
 
 def validate_input(job_input):
@@ -50,100 +226,262 @@ def validate_input(job_input):
         except json.JSONDecodeError:
             return None, "Invalid JSON format in input"
 
-    # Validate 'workflow' in input
+    # Validate 'workflow' in input, or build it from a template
     workflow = job_input.get("workflow")
+    template_id = job_input.get("template_id") if workflow is None else None
+    template_key = None
+    if template_id is not None:
+        workflow, error_message = TEMPLATES.render(template_id, job_input.get("overrides"))
+        if error_message:
+            return None, error_message
+        template_key = TEMPLATES.get(template_id).key(job_input.get("overrides"))
     if workflow is None:
         return None, "Missing 'workflow' parameter"
 
+    # Reject malformed workflows before any image is uploaded, templates were checked
+    # once already and only the nodes a job overrides are checked again
+    if VALIDATE_WORKFLOWS:
+        if template_id is not None:
+            error_message = TEMPLATES.get(template_id).check(OBJECT_INFO) or OBJECT_INFO.validate(
+                workflow, [str(node_id) for node_id in job_input.get("overrides") or {}]
+            )
+        else:
+            error_message = OBJECT_INFO.validate(workflow)
+        if error_message:
+            return None, f"Invalid workflow: {error_message}"
+
     # Validate 'images' in input, if provided
     images = job_input.get("images")
     if images is not None:
         if not isinstance(images, list) or not all(
-            "name" in image and "image" in image for image in images
+            "name" in image and ("image" in image or "url" in image) for image in images
         ):
             return (
                 None,
-                "'images' must be a list of objects with 'name' and 'image' keys",
+                "'images' must be a list of objects with 'name' and 'image' or 'url' keys",
             )
 
+    # Validate 'output_format', 'quality' and 'lossless', if provided
+    output_format, error_message = transcode.OutputFormat.from_input(job_input)
+    if error_message:
+        return None, error_message
+
     # Return validated data and no error
-    return {"workflow": workflow, "images": images, "callback": job_input.get("callback", None)}, None
+    return {
+        "workflow": workflow,
+        "images": images,
+        "callback": job_input.get("callback", None),
+        "status_callback": job_input.get("status_callback", None),
+        "trace": bool(job_input.get("trace", False)),
+        "template_id": template_id,
+        "template_key": template_key,
+        "output_format": output_format,
+    }, None
+
+
+def comfy_is_ready():
+    """
+    Return the cached health state of ComfyUI.
+
+    The first call waits for ComfyUI to come up, with exponential backoff for up to
+    COMFY_API_AVAILABLE_MAX_RETRIES * COMFY_API_AVAILABLE_INTERVAL_MS, and starts the
+    background refresh. Later calls never touch the network.
 
+    Returns:
+        bool: True if ComfyUI is reachable.
+    """
+    if not READINESS.checked:
+        READINESS.wait_until_ready(
+            COMFY_API_AVAILABLE_MAX_RETRIES * COMFY_API_AVAILABLE_INTERVAL_MS / 1000,
+            COMFY_API_AVAILABLE_INTERVAL_MS / 1000,
+        )
+        READINESS.start_monitor()
+    return READINESS.is_ready()
 
-def check_server(url, retries=500, delay=50):
+
+def upload_image(name, upload_name, image_data):
     """
-    Check if a server is reachable via HTTP GET request
+    Decode a single base64 encoded image and upload it to ComfyUI.
 
     Args:
-    - url (str): The URL to check
-    - retries (int, optional): The number of times to attempt connecting to the server. Default is 50
-    - delay (int, optional): The time in milliseconds to wait between retries. Default is 500
+        name (str): The name the client gave the image.
+        upload_name (str): The filename to store the image as.
+        image_data (str): The base64 encoded image.
 
     Returns:
-    bool: True if the server is reachable within the given number of retries, otherwise False
+        tuple: (error, size, elapsed_ms) where error is None on success and size
+               is the number of decoded bytes.
     """
-    
-    for i in range(retries):
-        try:
-            response = requests.get(url)
-    
-            # If the response status code is 200, the server is up and running
-            if response.status_code == 200:
-                print(f"runpod-worker-comfy - API is reachable after {(i + 1) * delay} ms.")
-                return True
-        except requests.RequestException as e:
-            # If an exception occurs, the server may not be ready
-            pass
-    
-        # Log message every 5 seconds
-        if (i + 1) % (5000 // delay) == 0:
-            print("Still waiting on the server to come up...")
-    
-        # Wait for the specified delay before retrying
-        time.sleep(delay / 1000)
+    start_time = time.perf_counter()
+    blob = base64.b64decode(image_data)
+    content_type = mimetypes.guess_type(upload_name)[0] or "image/png"
+
+    # Prepare the form data, the decoded bytes are sent without another copy
+    files = {
+        "image": (upload_name, blob, content_type),
+        "overwrite": (None, "true"),
+    }
 
-    print(
-        f"runpod-worker-comfy - Failed to connect to server at {url} after {retries} attempts."
-    )
-    return False
+    # POST request to upload the image
+    response = COMFY_SESSION.post(f"http://{COMFY_HOST}/upload/image", files=files)
+    elapsed_ms = round((time.perf_counter() - start_time) * 1000, 2)
+    if response.status_code != 200:
+        return f"Error uploading {name}: {response.text}", len(blob), elapsed_ms
+    return None, len(blob), elapsed_ms
+
+
+def download_images(images, job_id=None):
+    """
+    Download the images given by URL straight into the ComfyUI input folder.
+
+    Downloads run on INPUT_DOWNLOAD_WORKERS threads and are streamed to disk, so
+    the image never sits in memory. Unchanged images are served from the URL cache.
+
+    Args:
+        images (list): A list of dictionaries, each containing the 'name' and the 'url' of the image.
+        job_id (str): The job the images are for, they stay cached until it finished.
 
+    Returns:
+        tuple: (renamed, hits, details, errors) with the mapping from image names to
+               their filenames in the input folder, the number of cache hits and the
+               success and error messages.
+    """
+    renamed = {}
+    hits = 0
+    details = []
+    errors = []
+
+    def download(image):
+        start_time = time.perf_counter()
+        try:
+            filename, hit, size = input_cache.download_image(
+                DOWNLOAD_SESSION, URL_CACHE, image["url"], image["name"], INPUT_DOWNLOAD_TIMEOUT, job_id
+            )
+        except Exception as e:
+            return image, None, False, 0, str(e), 0
+        elapsed_ms = round((time.perf_counter() - start_time) * 1000, 2)
+        return image, filename, hit, size, None, elapsed_ms
+
+    workers = min(INPUT_DOWNLOAD_WORKERS, len(images))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(download, images))
 
-def upload_images(images):
+    for image, filename, hit, size, error, elapsed_ms in results:
+        name = image["name"]
+        if error:
+            errors.append(f"Error downloading {name}: {error}")
+            continue
+        print(f"runpod-worker-comfy - {'reused cached' if hit else 'downloaded'} {name} ({size} bytes) in {elapsed_ms} ms")
+        metrics.INPUT_BYTES.inc(size, source="url")
+        if not hit:
+            metrics.TRANSFER_BYTES.inc(size, direction="url_download")
+            metrics.TRANSFER_SECONDS.inc(elapsed_ms / 1000, direction="url_download")
+        hits += hit
+        if filename != name:
+            URL_CACHE.link_original(filename, name)
+            renamed[name] = filename
+        details.append(f"{'Reused cached' if hit else 'Successfully downloaded'} {name} in {elapsed_ms} ms")
+    return renamed, hits, details, errors
+
+
+def upload_images(images, job_id=None):
     """
     Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
 
+    Images the input image cache already holds are not uploaded again. Cached images
+    live under content-addressed filenames, the image inputs of the workflow have to
+    be rewritten with the returned "renamed" mapping to use them. They are also kept
+    under their original name for references that are not rewritten. The remaining images are uploaded
+    by COMFY_UPLOAD_WORKERS threads over pooled connections; each thread decodes
+    and sends one image at a time, which bounds the memory held by decoded images.
+
+    Images given by 'url' instead of 'image' are downloaded by download_images().
+
     Args:
-        images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string.
-        server_address (str): The address of the ComfyUI server.
+        images (list): A list of dictionaries, each containing the 'name' of the image and either the 'image' as a base64 encoded string or its 'url'.
+        job_id (str): The job the images are for, they stay cached until it finished.
 
     Returns:
-        list: A list of responses from the server for each image upload.
+        dict: The status, a message, the details for each image, the "renamed" mapping
+              from image names to the filenames they were stored as, the cache
+              "hits" and "misses" of this upload under "cache" and the time the
+              upload took in "upload_time_ms".
     """
     if not images:
-        return {"status": "success", "message": "No images to upload", "details": []}
+        return {
+            "status": "success",
+            "message": "No images to upload",
+            "details": [],
+            "renamed": {},
+            "cache": {"hits": 0, "misses": 0},
+            "upload_time_ms": 0,
+        }
 
+    start_time = time.perf_counter()
     responses = []
     upload_errors = []
+    renamed = {}
+    pending = []
+    hits = 0
 
     print(f"runpod-worker-comfy - image(s) upload")
 
+    # Images given by URL are downloaded while the inline images are uploaded
+    url_images = [image for image in images if "image" not in image]
+    prefetch = ThreadPoolExecutor(max_workers=1)
+    downloads = prefetch.submit(download_images, url_images, job_id) if url_images else None
+
     for image in images:
+        if "image" not in image:
+            continue
         name = image["name"]
         image_data = image["image"]
-        blob = base64.b64decode(image_data)
-
-        # Prepare the form data
-        files = {
-            "image": (name, BytesIO(blob), "image/png"),
-            "overwrite": (None, "true"),
-        }
 
-        # POST request to upload the image
-        response = requests.post(f"http://{COMFY_HOST}/upload/image", files=files)
-        if response.status_code != 200:
-            upload_errors.append(f"Error uploading {name}: {response.text}")
-        else:
-            responses.append(f"Successfully uploaded {name}")
+        key = None
+        upload_name = name
+        if INPUT_CACHE.enabled:
+            key = input_cache.digest(image_data)
+            cached_name = INPUT_CACHE.lookup(key, job_id)
+            if cached_name is not None:
+                hits += 1
+                INPUT_CACHE.link_original(cached_name, name)
+                renamed[name] = cached_name
+                responses.append(f"Reused cached {name}")
+                continue
+            upload_name = INPUT_CACHE.filename_for(key, name)
+        pending.append((name, upload_name, image_data, key))
+
+    if pending:
+        workers = min(COMFY_UPLOAD_WORKERS, len(pending))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda item: upload_image(*item[:3]), pending))
+        for (name, upload_name, _, key), (error, size, elapsed_ms) in zip(pending, results):
+            print(f"runpod-worker-comfy - uploaded {name} ({size} bytes) in {elapsed_ms} ms")
+            metrics.INPUT_BYTES.inc(size, source="inline")
+            metrics.TRANSFER_BYTES.inc(size, direction="comfy_upload")
+            metrics.TRANSFER_SECONDS.inc(elapsed_ms / 1000, direction="comfy_upload")
+            if error:
+                upload_errors.append(error)
+                continue
+            responses.append(f"Successfully uploaded {name} in {elapsed_ms} ms")
+            if key is not None:
+                INPUT_CACHE.add(key, upload_name, size, job_id)
+                INPUT_CACHE.link_original(upload_name, name)
+                renamed[name] = upload_name
+
+    misses = len(pending) if INPUT_CACHE.enabled else 0
+    if downloads is not None:
+        downloaded, url_hits, details, errors = downloads.result()
+        renamed.update(downloaded)
+        responses.extend(details)
+        upload_errors.extend(errors)
+        hits += url_hits
+        if URL_CACHE.enabled:
+            misses += len(url_images) - url_hits
+    prefetch.shutdown()
+
+    cache_stats = {"hits": hits, "misses": misses}
+    upload_time_ms = round((time.perf_counter() - start_time) * 1000, 2)
 
     if upload_errors:
         print(f"runpod-worker-comfy - image(s) upload with errors")
@@ -151,13 +489,19 @@ def upload_images(images):
             "status": "error",
             "message": "Some images failed to upload",
             "details": upload_errors,
+            "renamed": renamed,
+            "cache": cache_stats,
+            "upload_time_ms": upload_time_ms,
         }
 
-    print(f"runpod-worker-comfy - image(s) upload complete")
+    print(f"runpod-worker-comfy - image(s) upload complete in {upload_time_ms} ms, {hits} of {len(images)} served from cache")
     return {
         "status": "success",
         "message": "All images uploaded successfully",
         "details": responses,
+        "renamed": renamed,
+        "cache": cache_stats,
+        "upload_time_ms": upload_time_ms,
     }
 
 
@@ -208,7 +552,210 @@ def base64_encode(img_path):
         return f"{encoded_string}"
 
 
-def process_output_images(comfy, output_images, job_id):
+def saved_images(output):
+    """
+    List the non-temporary images of a single node output.
+
+    Args:
+        output (dict): The output of a node as reported by its "executed" event.
+
+    Returns:
+        list: The image descriptors ("filename", "subfolder", "type") of the output.
+    """
+    images = []
+    if output is None:
+        return images
+    for image in output.get('images', []):
+        if image is None:
+            continue
+        # if image type is temp then skip
+        if image.get('type') == 'temp':
+            continue
+        images.append(image)
+    return images
+
+
+def output_image_key(image):
+    """
+    Return the key identifying an output image within a prompt.
+    """
+    return (image.get("type"), image.get("subfolder"), image.get("filename"))
+
+
+def collect_output_images(comfy):
+    """
+    List the images a finished prompt saved, in the order ComfyUI reported them.
+
+    Args:
+        comfy (ComfyClient): The client that ran the prompt.
+
+    Returns:
+        list: The image descriptors ("filename", "subfolder", "type") of all
+              non-temporary outputs.
+    """
+    images = []
+    for output in comfy.outputs:
+        print(f"runpod-worker-comfy - output: {output}")
+        images.extend(saved_images(output))
+    # Images sent over the websocket by SaveImageWebsocket nodes never touch the disk
+    for node, frames in comfy.websocket_images.items():
+        for index, frame in enumerate(frames):
+            images.append({
+                "filename": f"{node}_{index:05}_.{frame['format']}",
+                "subfolder": "",
+                "type": "websocket",
+                "data": frame["image"],
+            })
+    return images
+
+
+def simulate_upload(filename, data):
+    """
+    Store an image in the 'simulated_uploaded' folder, like rp_upload.upload_image does
+    when no bucket credentials are set. rp_upload has no such fallback for images in memory.
+
+    Args:
+        filename (str): The filename of the image, used for its extension.
+        data (bytes): The image.
+
+    Returns:
+        str: The path the image was stored at.
+    """
+    os.makedirs(SIMULATED_UPLOAD_PATH, exist_ok=True)
+    path = f"{SIMULATED_UPLOAD_PATH}/{uuid.uuid4().hex[:8]}{os.path.splitext(filename)[1]}"
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def read_output_image(comfy, image, local_image_path):
+    """
+    Return the bytes of an output image, preferring data already in memory,
+    then the output folder, then the /view endpoint of ComfyUI.
+
+    Args:
+        comfy (ComfyClient): The client that ran the prompt.
+        image (dict): The image descriptor.
+        local_image_path (str): Where ComfyUI would have saved the image.
+
+    Returns:
+        bytes: The raw image data.
+    """
+    if image.get("data") is not None:
+        return image["data"]
+    # if the file path exists use it
+    if os.path.exists(local_image_path):
+        with open(local_image_path, "rb") as f:
+            return f.read()
+    # otherwise, load it from comfy.get_image(image)
+    return comfy.get_image(image)
+
+
+def process_output_image(comfy, image, job_id, output_path, output_format=None, budget=None):
+    """
+    Fetch a single output image and either upload it to the bucket or base64 encode it.
+
+    Args:
+        comfy (ComfyClient): The client that ran the prompt.
+        image (dict): The image descriptor reported by ComfyUI.
+        job_id (str): The unique identifier for the job.
+        output_path (str): The folder ComfyUI saves its outputs to.
+        output_format (OutputFormat): The format the job asked for, or None to
+            return the image as saved by ComfyUI.
+        budget (InlineBudget): The inline budget of the job. With a budget the image
+            is returned inline while it fits, and uploaded to the bucket otherwise.
+
+    Returns:
+        dict | str: The bucket entry of the image, or the base64 encoded image.
+    """
+    # Get path by combining output path and the image filename
+    output_image = os.path.join(image["subfolder"], image["filename"])
+    local_image_path = f"{output_path}/{output_image}"
+
+    if output_format is not None and output_format.applies_to(image["filename"]):
+        # The transcoded image only exists in memory
+        filename, data = TRANSCODER.transcode(
+            image["filename"], read_output_image(comfy, image, local_image_path), output_format
+        )
+        image = {**image, "filename": filename, "data": data}
+
+    spill = os.environ.get("BUCKET_ENDPOINT_URL", False)
+    if budget is not None:
+        image_data = read_output_image(comfy, image, local_image_path)
+        if budget.reserve(len(image_data)):
+            print("runpod-worker-comfy - encoding image: ", image['filename'])
+            metrics.OUTPUT_BYTES.inc(len(image_data), destination="inline")
+            return base64.b64encode(image_data).decode("utf-8")
+        if not spill:
+            print(f"runpod-worker-comfy - warning: {image['filename']} exceeds the inline budget but no bucket is configured")
+            metrics.OUTPUT_BYTES.inc(len(image_data), destination="inline")
+            return base64.b64encode(image_data).decode("utf-8")
+        budget.spill()
+        image = {**image, "data": image_data}
+
+    if spill:
+        endpoint = os.environ.get("BUCKET_ENDPOINT_URL")
+        print(f"runpod-worker-comfy - uploading image: {image['filename']} to {endpoint}")
+        if UPLOADER.configured:
+            # Upload from memory or straight from the output folder, without temporary files
+            start_time = time.perf_counter()
+            if image.get("data") is not None:
+                url, uploaded = UPLOADER.upload_image(job_id, image["filename"], data=image["data"])
+                size = len(image["data"])
+            elif os.path.exists(local_image_path):
+                url, uploaded = UPLOADER.upload_image(job_id, image["filename"], path=local_image_path)
+                size = os.path.getsize(local_image_path)
+            else:
+                image_data = comfy.get_image(image)
+                start_time = time.perf_counter()
+                url, uploaded = UPLOADER.upload_image(job_id, image["filename"], data=image_data)
+                size = len(image_data)
+            if not uploaded:
+                print(f"runpod-worker-comfy - {image['filename']} was uploaded before, reusing {url}")
+                metrics.OUTPUT_BYTES.inc(size, destination="bucket")
+                metrics.BUCKET_DEDUP_SAVED_BYTES.inc(size)
+                return {
+                    "filename": image['filename'],
+                    "url": url,
+                    "type": image.get('type'),
+                    "subfolder": image['subfolder'],
+                    "deduplicated": True,
+                }
+        elif image.get("data") is not None:
+            # Without credentials the images are stored in 'simulated_uploaded'
+            start_time = time.perf_counter()
+            url = simulate_upload(image["filename"], image["data"])
+            size = len(image["data"])
+        else:
+            # If the file doesn't exist, download it from comfy.get_image(image)
+            if not os.path.exists(local_image_path):
+                image_data = comfy.get_image(image)
+                with open(local_image_path, "wb") as f:
+                    f.write(image_data)
+            # URL to image in AWS S3
+            start_time = time.perf_counter()
+            url = rp_upload.upload_image(job_id, local_image_path)
+            size = os.path.getsize(local_image_path)
+        metrics.OUTPUT_BYTES.inc(size, destination="bucket")
+        metrics.TRANSFER_BYTES.inc(size, direction="bucket_upload")
+        metrics.TRANSFER_SECONDS.inc(time.perf_counter() - start_time, direction="bucket_upload")
+        print(
+            "runpod-worker-comfy - the image was generated and uploaded to AWS S3 at %s" % url
+        )
+        return {
+            "filename": image['filename'],
+            "url": url,
+            "type": image.get('type'),
+            "subfolder": image['subfolder']
+        }
+
+    print("runpod-worker-comfy - encoding image: ", image['filename'])
+    image_data = read_output_image(comfy, image, local_image_path)
+    metrics.OUTPUT_BYTES.inc(len(image_data), destination="inline")
+    return base64.b64encode(image_data).decode("utf-8")
+
+
+def process_output_images(comfy, job_id, exclude=(), output_format=None, budget=None):
     """
     This function takes the "outputs" from image generation and the job ID,
     then determines the correct way to return the image, either as a direct URL
@@ -216,24 +763,42 @@ def process_output_images(comfy, output_images, job_id):
     environment configuration.
 
     Args:
-        outputs (array): A list of file names for output images.
+        comfy (ComfyClient): The client that ran the prompt, holding its outputs.
         job_id (str): The unique identifier for the job.
+        exclude (set): Keys (see output_image_key) of images that were already
+            processed, e.g. streamed while the prompt was running.
+        output_format (OutputFormat): The format the job asked for, or None to
+            return the images as saved by ComfyUI.
+        budget (InlineBudget): The inline budget of the job, created from
+            OUTPUT_INLINE_MAX_BYTES if not given.
 
     Returns:
         dict: A dictionary with the status ('success' or 'error') and the message,
-              which is either the URL to the image in the AWS S3 bucket or a base64
-              encoded string of the image. In case of error, the message details the issue.
+              the list of images, each either the URL to the image in the AWS S3 bucket
+              or a base64 encoded string of the image, and the time the stage took
+              in "output_time_ms".
 
     The function works as follows:
     - It first determines the output path for the images from an environment variable,
       defaulting to "/comfyui/output" if not set.
     - It then iterates through the outputs to find the filenames of the generated images.
-    - After confirming the existence of the image in the output folder, it checks if the
-      AWS S3 bucket is configured via the BUCKET_ENDPOINT_URL environment variable.
-    - If AWS S3 is configured, it uploads the image to the bucket and returns the URL.
-    - If AWS S3 is not configured, it encodes the image in base64 and returns the string.
-    - If the image file does not exist in the output folder, it returns an error status
-      with a message indicating the missing image file.
+    - The images are processed by a pool of COMFY_OUTPUT_WORKERS threads, the results
+      keep the order in which ComfyUI reported the images.
+    - If AWS S3 is configured via the BUCKET_ENDPOINT_URL environment variable, each
+      image is uploaded to the bucket and its URL is returned. Uploads stream from
+      memory or the output folder over a pooled client, images that are missing from
+      the output folder are fetched from ComfyUI into memory first.
+    - If AWS S3 is not configured, each image is encoded in base64, read either from
+      the output folder or from ComfyUI.
+    - Images captured from SaveImageWebsocket nodes are uploaded or encoded straight
+      from memory.
+    - With OUTPUT_INLINE_MAX_BYTES set, images are encoded in base64 while they fit
+      into that budget and uploaded to the bucket once it is exhausted, so a large
+      batch never produces a huge result. The number of uploaded images is returned
+      in "spilled_images".
+    - With BUCKET_DEDUP enabled, images are uploaded under keys derived from their
+      content. Images that were uploaded before are not uploaded again, their entries
+      are marked "deduplicated" and counted in "deduplicated_images".
     """
 
     # The path where ComfyUI stores the generated images
@@ -241,168 +806,540 @@ def process_output_images(comfy, output_images, job_id):
 
     print(f"runpod-worker-comfy - image generation is done")
 
+    if budget is None and OUTPUT_INLINE_MAX_BYTES > 0:
+        budget = output_budget.InlineBudget(OUTPUT_INLINE_MAX_BYTES)
+
+    start_time = time.perf_counter()
+    images = [image for image in collect_output_images(comfy) if output_image_key(image) not in exclude]
     encoded_images = []
-    for output in comfy.outputs:
-        print(f"runpod-worker-comfy - output: {output}")
-        if output is None:
-            continue
-        for image in output['images']:
-            if image is None:
-                continue
-            # if image type is temp then skip
-            if image['type'] == 'temp':
-                continue
-            if os.environ.get("BUCKET_ENDPOINT_URL", False):
-                endpoint = os.environ.get("BUCKET_ENDPOINT_URL")
-                print(f"runpod-worker-comfy - uploading image: {image['filename']} to {endpoint}")
-                output_image = os.path.join(image["subfolder"], image["filename"])
-                local_image_path = f"{COMFY_OUTPUT_PATH}/{output_image}"
-                # If the file doesn't exist, download it from comfy.get_image(image)
-                if not os.path.exists(local_image_path):
-                    image_data = comfy.get_image(image)
-                    with open(local_image_path, "wb") as f:
-                        f.write(image_data)
-                # URL to image in AWS S3
-                url = rp_upload.upload_image(job_id, local_image_path)
-                encoded_images.append({
-                    "filename": image['filename'],
-                    "url": url,
-                    "type": image['type'],
-                    "subfolder": image['subfolder']
-                })
-                print(
-                    "runpod-worker-comfy - the image was generated and uploaded to AWS S3 at %s" % url
-                )
-            else:
-                print("runpod-worker-comfy - encoding image: ", image['filename'])
-                # Get path by combining output path and the image filename
-                output_image = os.path.join(image["subfolder"], image["filename"])
-                file_path = f"{COMFY_OUTPUT_PATH}/{output_image}"
-                print(f"runpod-worker-comfy - file path: {file_path}")
-                # if the file path exists use it
-                if os.path.exists(file_path):
-                    image_data = open(file_path, "rb").read()
-                else:
-                    # otherwise, load it from comfy.get_image(image)
-                    image_data = comfy.get_image(image)
-                
-                encoded_images.append(base64.b64encode(image_data).decode("utf-8"))
-        
-        
-    # The image is in the output folder
-    
-    if encoded_images and len(encoded_images) > 0:
-        return {
+    if images:
+        workers = min(COMFY_OUTPUT_WORKERS, len(images))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            encoded_images = list(executor.map(
+                lambda image: process_output_image(comfy, image, job_id, COMFY_OUTPUT_PATH, output_format, budget),
+                images,
+            ))
+    output_time_ms = round((time.perf_counter() - start_time) * 1000, 2)
+    print(f"runpod-worker-comfy - processed {len(encoded_images)} image(s) in {output_time_ms} ms")
+
+    if encoded_images:
+        result = {
             "status": "success",
             "message": "Image generated successfully",
             "images": encoded_images,
+            "output_time_ms": output_time_ms,
         }
+        if budget is not None and budget.spilled:
+            print(f"runpod-worker-comfy - {budget.spilled} image(s) exceeded the inline budget")
+            result["spilled_images"] = budget.spilled
+        deduplicated = sum(1 for image in encoded_images if isinstance(image, dict) and image.get("deduplicated"))
+        if deduplicated:
+            result["deduplicated_images"] = deduplicated
+        return result
     else:
         return {
             "status": "success",
-            "message": "No images saved."
+            "message": "No images saved.",
+            "output_time_ms": output_time_ms,
         }
     
-def send_status(validated_data, status):
+def send_status(validated_data, status, job_id=None):
+    """
+    Queue a status update for the status callback of the job, if it has one.
+
+    Updates that are still waiting are replaced by newer ones of the same job.
+    """
     if 'status_callback' in validated_data and validated_data["status_callback"] is not None:
-        # Send the result to the callback URL
-        callback_url = validated_data["status_callback"]
-        response = requests.post(callback_url, json=status)
-        print(f"runpod-worker-comfy - Callback response: {response.text}")
+        CALLBACKS.send_status(job_id, validated_data["status_callback"], status)
 
-def send_result_callback(validated_data, result):
+def send_result_callback(validated_data, result, job_id=None):
+    """
+    Queue the result for the callback of the job, if it has one. It is sent after
+    the status updates of the job that were queued before it.
+
+    Returns:
+        Delivery: The queued callback, or None if the job has no callback.
+    """
     print("runpod-worker-comfy - job completed")
     if 'callback' in validated_data and validated_data["callback"] is not None:
         print(f"runpod-worker-comfy - Sending result to callback URL: {validated_data['callback']}")
-        # Send the result to the callback URL
-        callback_url = validated_data["callback"]
-        response = requests.post(callback_url, json=result)
-        print(f"runpod-worker-comfy - Callback response: {response.text}")
+        return CALLBACKS.send_result(validated_data["callback"], result, job_id)
+    return None
 
-def handler(job):
+def status_error_result(status):
     """
-    The main function that handles a job of generating an image.
+    Build the job result for a prompt that did not complete.
 
-    This function validates the input, sends a prompt to ComfyUI for processing,
-    polls ComfyUI for result, and retrieves generated images.
+    Args:
+        status (dict): The final status reported by the ComfyClient.
+
+    Returns:
+        dict: A result with status "error", the message and the details of the failure.
+    """
+    data = status.get("data")
+    if status["status"] == "error" and isinstance(data, dict) and "error" in data:
+        message = data["error"]["message"]
+        details = data["error"]["details"]
+    elif status["status"] == "timed out":
+        message = "Timed out waiting for ComfyUI"
+        details = None
+    else:
+        message = "ComfyUI rejected the workflow" if status["status"] == "fail" else "ComfyUI reported an error"
+        details = data
+    return {
+        "status": "error",
+        "message": message,
+        "details": details
+    }
+
+
+def track_status(trace, status):
+    """
+    Record the status transitions of a prompt in the job trace.
+
+    Runs on the websocket thread, so the marks carry the time the event arrived.
+
+    Args:
+        trace (JobTrace): The trace of the job.
+        status (dict): The new status reported by the ComfyClient.
+    """
+    print(f"runpod-worker-comfy - Status Changed => {status}")
+    if status["status"] == "processing":
+        trace.mark("execution_started")
+        if (status.get("data") or {}).get("type") == "progress":
+            trace.mark("first_progress")
+    elif status["status"] == "completed":
+        trace.mark("execution_success")
+
+
+def stream_event(status):
+    """
+    Turn a status of ComfyClient into the progress event streamed to the client.
+
+    Args:
+        status (dict): The status as yielded by ComfyClient.iter_statuses().
+
+    Returns:
+        dict: The event with "type" "status", the status and, if known, the node
+              that is executing and its progress.
+    """
+    event = {"type": "status", "status": status["status"]}
+    msg = status.get("data")
+    if not isinstance(msg, dict):
+        return event
+    event["event"] = msg.get("type")
+    data = msg.get("data") or {}
+    if data.get("node") is not None:
+        event["node"] = data["node"]
+    if msg.get("type") == "progress":
+        event["progress"] = {"value": data.get("value"), "max": data.get("max")}
+    return event
+
+
+def job_events(job, trace, stream=False):
+    """
+    Run a job of generating an image, recording the time of each phase in trace.
+
+    This is a generator yielding a progress event for every status change of the
+    prompt. With stream set, the images of each output are also processed and
+    yielded as soon as its "executed" event arrives, instead of once the whole
+    workflow finished.
 
     Args:
         job (dict): A dictionary containing job details and input parameters.
+        trace (JobTrace): The trace of the job.
+        stream (bool): Whether to process output images as they arrive.
+
+    Yields:
+        dict: The events of the job, see stream_event(); streamed images are
+              yielded as {"type": "image", "node": ..., "image": ...}.
 
     Returns:
-        dict: A dictionary containing either an error message or a success status with generated images.
+        dict: A dictionary containing either an error message or a success status
+              with all generated images, including the streamed ones.
     """
     job_input = job["input"]
 
     # Make sure that the input is valid
-    validated_data, error_message = validate_input(job_input)
+    with trace.phase("validation"):
+        validated_data, error_message = validate_input(job_input)
     if error_message:
         print(f"runpod-worker-comfy - error: {error_message}")
         return {"error": error_message}
+    trace.requested = validated_data["trace"]
 
     # Extract validated data
     workflow = validated_data["workflow"]
     images = validated_data.get("images")
 
-    # Make sure that the ComfyUI API is available
-    check_server(
-        f"http://{COMFY_HOST}",
-        COMFY_API_AVAILABLE_MAX_RETRIES,
-        COMFY_API_AVAILABLE_INTERVAL_MS,
-    )
+    # Exact repeats of a deterministic job are answered without ComfyUI
+    cache_key = None
+    if RESULT_CACHE.enabled and result_cache.is_cacheable(workflow, images, RESULT_CACHE_EXCLUDED_NODES):
+        with trace.phase("result_cache"):
+            output_format = validated_data["output_format"]
+            cache_key = result_cache.workflow_key(
+                workflow, images, validated_data["template_key"], output_format.key if output_format else None
+            )
+            cached_result = RESULT_CACHE.get(cache_key)
+        if cached_result is not None:
+            print(f"runpod-worker-comfy - returning cached result {cache_key}")
+            result = {**cached_result, "cached": True, "refresh_worker": REFRESH_WORKER}
+            with trace.phase("callbacks"):
+                send_result_callback(validated_data, result, job["id"])
+            return result
+
+    # Fail fast when ComfyUI is down, its health is kept up to date in the background
+    if not comfy_is_ready():
+        error_message = f"ComfyUI is not reachable at http://{COMFY_HOST}"
+        print(f"runpod-worker-comfy - error: {error_message}")
+        return {"error": error_message}
+    if VALIDATE_WORKFLOWS and not OBJECT_INFO.loaded:
+        # The node definitions could not be fetched at startup, later jobs are validated once they are
+        OBJECT_INFO.load_in_background()
+
+    # Models missing from the local disk are copied in the background for the next jobs
+    with trace.phase("model_cache"):
+        model_cache_result = MODEL_CACHE.prepare(workflow)
+
+    # Warm the page cache with the models that are not copied while the inputs are uploaded
+    with trace.phase("model_prefetch"):
+        MODEL_PREFETCHER.prefetch(workflow)
 
     # Upload images if they exist
-    upload_result = upload_images(images)
+    with trace.phase("upload"):
+        upload_result = upload_images(images, job.get("id"))
 
     if upload_result["status"] == "error":
         return upload_result
 
+    # Point the workflow at the filenames the images are stored under
+    workflow = input_cache.rewrite_workflow(
+        workflow, upload_result["renamed"], OBJECT_INFO.image_inputs() or input_cache.IMAGE_INPUTS
+    )
+
     job_id = job["id"];
     client = comfyclient.ComfyClient(COMFY_HOST)
-    client.status_change_callback = lambda status: print(f"runpod-worker-comfy - Status Changed => {status}")
+    client.status_change_callback = lambda status: track_status(trace, status)
 
     print("runpod-worker-comfy - sending prompt to ComfyUI")
-    print(f"runpod-worker-comfy - workflow: {workflow}")
+    prompt_json = None
+    if validated_data["template_id"] is not None:
+        print(f"runpod-worker-comfy - template: {validated_data['template_id']}")
+        # Only the nodes the job changed are serialized
+        prompt_json = TEMPLATES.get(validated_data["template_id"]).serialize(workflow)
+    else:
+        print(f"runpod-worker-comfy - workflow: {workflow}")
 
-    client.submit(workflow, job_id)
+    with trace.phase("submit"):
+        BATCHER.submit(client, workflow, job_id, prompt_json)
+    trace.mark("submitted")
     print ("runpod-worker-comfy - waiting for the job to finish")
-    status = client.waitForStatus()
-    lastStatus = json.dumps(status)
-    while True:
-        if client.is_finished():
+
+    output_phase = "output_upload" if os.environ.get("BUCKET_ENDPOINT_URL", False) else "output_encoding"
+    output_path = os.environ.get("COMFY_OUTPUT_PATH", "/comfyui/output")
+    streamed_keys = set()
+    streamed_images = []
+    budget = output_budget.InlineBudget(OUTPUT_INLINE_MAX_BYTES) if OUTPUT_INLINE_MAX_BYTES > 0 else None
+
+    status = client.getStatus()
+    for status in client.iter_statuses():
+        if status["status"] in comfyclient.FINISHED_STATUSES:
             break
-        strStatus = json.dumps(status)
-        if(status != lastStatus):
-            print(f"runpod-worker-comfy - Status => {status}")
-            send_status(validated_data, status)
-
-        lastStatus = strStatus
-            
-        time.sleep(0.5)
-    
+        print(f"runpod-worker-comfy - Status => {status}")
+        with trace.phase("callbacks"):
+            send_status(validated_data, status, job_id)
+        yield stream_event(status)
+
+        msg = status.get("data")
+        if stream and isinstance(msg, dict) and msg.get("type") == "executed":
+            node = msg["data"].get("node")
+            for image in saved_images(msg["data"].get("output")):
+                if output_image_key(image) in streamed_keys:
+                    continue
+                with trace.phase(output_phase):
+                    entry = process_output_image(
+                        client, image, job_id, output_path, validated_data["output_format"], budget
+                    )
+                trace.mark("first_image")
+                streamed_keys.add(output_image_key(image))
+                streamed_images.append(entry)
+                yield {"type": "image", "node": node, "image": entry}
+
     print(f"runpod-worker-comfy - Finished => {status}")
-    
+    trace.nodes = client.node_timings
+    NODE_PROFILER.record(client.node_timings)
+
     # if there was an error return  an error result
-    if status["status"] == "error":
-        send_status(validated_data, status)
-        result = {
-            "status": "error",
-            "message": status['data']['error']['message'],
-            "details": status['data']['error']['details']
-        }
-        send_result_callback(validated_data, result)
+    if status["status"] != "completed":
+        metrics.JOB_ERRORS.inc(status=status["status"])
+        result = status_error_result(status)
+        with trace.phase("callbacks"):
+            send_status(validated_data, status, job_id)
+            send_result_callback(validated_data, result, job_id)
         return result
 
     # Get the generated image and return it as URL in an AWS bucket or as base64
-    images_result = process_output_images(client, images, job_id)
+    with trace.phase(output_phase):
+        images_result = process_output_images(
+            client, job_id, exclude=streamed_keys, output_format=validated_data["output_format"], budget=budget
+        )
+    images_result.pop("output_time_ms", None)
+    if streamed_images:
+        images_result = {
+            **images_result,
+            "message": "Image generated successfully",
+            "images": streamed_images + images_result.get("images", []),
+        }
+    if images_result.get("images"):
+        trace.mark("first_image")
+
+    if cache_key is not None and images_result.get("images"):
+        with trace.phase("result_cache"):
+            RESULT_CACHE.put(cache_key, {
+                "status": images_result["status"],
+                "message": images_result["message"],
+                "images": images_result["images"],
+            })
+
+    result = {
+        **images_result,
+        "input_cache": upload_result["cache"],
+        "model_cache": model_cache_result,
+        "refresh_worker": REFRESH_WORKER,
+    }
+    if validated_data["output_format"] is not None:
+        result["transcode"] = validated_data["output_format"].summary()
+
+    with trace.phase("callbacks"):
+        send_result_callback(validated_data, result, job_id)
+
+    return result
+
 
-    result = {**images_result, "refresh_worker": REFRESH_WORKER}
+def process_job(job, trace):
+    """
+    Run a job of generating an image to completion, recording the time of each phase in trace.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+        trace (JobTrace): The trace of the job.
+
+    Returns:
+        dict: A dictionary containing either an error message or a success status with generated images.
+    """
+    with BATCHER.job():
+        events = job_events(job, trace)
+        while True:
+            try:
+                next(events)
+            except StopIteration as stop:
+                return stop.value
+
+
+def record_job_metrics(trace, result):
+    """
+    Count a finished job and record the duration of its phases.
+
+    Args:
+        trace (JobTrace): The finished trace of the job.
+        result (dict): The result the job returned.
+    """
+    if not isinstance(result, dict) or "error" in result or result.get("status") == "error":
+        metrics.JOBS.inc(result="error")
+    else:
+        metrics.JOBS.inc(result="cached" if result.get("cached") else "success")
+    trace_data = trace.to_dict()
+    for phase, ms in {**trace_data["phases_ms"], **trace_data["derived_ms"]}.items():
+        metrics.PHASE_SECONDS.observe(ms / 1000, phase=phase)
 
-    send_result_callback(validated_data, result)
 
+def handler(job):
+    """
+    The main function that handles a job of generating an image.
+
+    This function validates the input, sends a prompt to ComfyUI for processing,
+    waits for ComfyUI to finish, and retrieves generated images.
+
+    Every job emits a single structured log line with the time spent in each
+    phase; jobs sent with "trace": true also get the trace in their result.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Returns:
+        dict: A dictionary containing either an error message or a success status with generated images.
+    """
+    trace = tracing.JobTrace(job.get("id"))
+    result = process_job(job, trace)
+    return finish_job(trace, result)
+
+
+def finish_job(trace, result):
+    """
+    Wrap up a job: let the cache evict its input images, flush the callbacks if
+    the worker is refreshed, then log and record the trace, attaching it to the
+    result if it was requested.
+
+    Args:
+        trace (JobTrace): The trace of the job.
+        result (dict): The result of the job.
+
+    Returns:
+        dict: The result.
+    """
+    INPUT_CACHE.release(trace.job_id)
+    URL_CACHE.release(trace.job_id)
+    if REFRESH_WORKER:
+        # The worker is stopped after this job, its result callback has to be out first
+        CALLBACKS.flush(CALLBACK_FLUSH_TIMEOUT_S)
+    trace.finish()
+    trace.log()
+    record_job_metrics(trace, result)
+    if trace.requested and isinstance(result, dict):
+        result["trace"] = trace.to_dict()
     return result
 
 
-# Start the handler only if this script is run directly
+def generator_handler(job):
+    """
+    Streaming entry point used when STREAM_OUTPUT is enabled.
+
+    Yields a progress event for every status change of the prompt and every output
+    image as soon as the node that saved it finished, so the first images of a
+    workflow with several outputs arrive before the whole workflow is done. The
+    last event is the result of the job with "type" "result"; its "images" only
+    hold the images that were not streamed before, "streamed_images" counts the
+    ones that were.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Yields:
+        dict: The events of the job, see job_events().
+    """
+    trace = tracing.JobTrace(job.get("id"))
+    streamed = 0
+    with BATCHER.job():
+        events = job_events(job, trace, stream=True)
+        while True:
+            try:
+                event = next(events)
+            except StopIteration as stop:
+                result = finish_job(trace, stop.value)
+                break
+            if event["type"] == "image":
+                streamed += 1
+            yield event
+
+    final = {"type": "result", **result}
+    if streamed:
+        final["images"] = result.get("images", [])[streamed:]
+        final["streamed_images"] = streamed
+    yield final
+
+
+async def async_handler(job):
+    """
+    Asynchronous entry point used when the worker runs several jobs at once.
+
+    The blocking work of a job (input upload, waiting on ComfyUI, output encoding
+    and callbacks) runs in a worker thread, so the pre- and post-processing of one
+    job overlaps with the GPU execution of another.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Returns:
+        dict: The result of handler(job).
+    """
+    return await asyncio.to_thread(handler, job)
+
+
+async def async_generator_handler(job):
+    """
+    Asynchronous streaming entry point used when the worker streams several jobs at once.
+
+    Each event of generator_handler(job) is produced in a worker thread, so the
+    jobs in flight do not block each other.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Yields:
+        dict: The events of generator_handler(job).
+    """
+    events = generator_handler(job)
+    done = object()
+    while True:
+        event = await asyncio.to_thread(next, events, done)
+        if event is done:
+            return
+        yield event
+
+
+def concurrency_modifier(current_concurrency):
+    """
+    Tell RunPod how many jobs this worker may process at the same time.
+
+    Args:
+        current_concurrency (int): The concurrency RunPod is currently using.
+
+    Returns:
+        int: The configured COMFY_MAX_CONCURRENCY.
+    """
+    return COMFY_MAX_CONCURRENCY
+
+
+def start():
+    """
+    Start the RunPod serverless worker with the handler mode matching the config.
+    """
+    # Open the shared ComfyUI event stream now, so connecting is not part of the first job,
+    # and wait for ComfyUI once before taking jobs
+    stream = comfyclient.get_event_stream(COMFY_HOST)
+    READINESS.event_stream = stream
+    metrics.WEBSOCKET_RECONNECTS.set_function(lambda: stream.reconnects)
+    metrics.QUEUE_REMAINING.set_function(lambda: stream.queue_remaining)
+    metrics.MODEL_CACHE_BYTES.set_function(lambda: MODEL_CACHE.total_bytes)
+    if METRICS_PORT:
+        metrics.start_http_server(int(METRICS_PORT))
+    ready = comfy_is_ready()
+    if ready and VALIDATE_WORKFLOWS and OBJECT_INFO.load():
+        TEMPLATES.check(OBJECT_INFO)
+    if ready and WARMUP_WORKFLOWS:
+        # Load the main models now, so the first job is as fast as the ones after it
+        warmup.run_warmups(COMFY_HOST, warmup.warmup_files(WARMUP_WORKFLOWS), WARMUP_TIMEOUT_S)
+    NODE_PROFILER.start_dump(NODE_PROFILE_DUMP_INTERVAL_S)
+    # Spawning the transcoding processes takes a while, it is not part of the first job either
+    TRANSCODER.start()
+
+    if COMFY_MAX_CONCURRENCY <= 1:
+        if STREAM_OUTPUT:
+            runpod.serverless.start({"handler": generator_handler, "return_aggregate_stream": True})
+        else:
+            runpod.serverless.start({"handler": handler})
+        return
+
+    if REFRESH_WORKER:
+        print(
+            "runpod-worker-comfy - warning: REFRESH_WORKER stops the worker after each job, "
+            "which also interrupts the other jobs that are in flight"
+        )
+    print(f"runpod-worker-comfy - running up to {COMFY_MAX_CONCURRENCY} jobs concurrently")
+    if STREAM_OUTPUT:
+        runpod.serverless.start({
+            "handler": async_generator_handler,
+            "concurrency_modifier": concurrency_modifier,
+            "return_aggregate_stream": True,
+        })
+    else:
+        runpod.serverless.start(
+            {"handler": async_handler, "concurrency_modifier": concurrency_modifier}
+        )
+
+
+# Start the handler only if this script is run directly. The worker is started with
+# handler.py instead, so the processes the transcoder spawns do not import this module
+# as their main script and set up its caches, uploads and callbacks a second time.
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
+    start()
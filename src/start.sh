@@ -4,7 +4,29 @@
 TCMALLOC="$(ldconfig -p | grep -Po "libtcmalloc.so.\d" | head -n 1)"
 export LD_PRELOAD="${TCMALLOC}"
 
-mkdir -p /tmp/ckpts
+# Local copies of the network volume models, see MODEL_CACHE_MAX_BYTES. ComfyUI looks into
+# the cache before any other model folder, models without a copy are read from the volume.
+MODEL_CACHE_PATH="${MODEL_CACHE_PATH:-/tmp/ckpts}"
+mkdir -p "${MODEL_CACHE_PATH}"
+COMFY_ARGS="--disable-auto-launch"
+if [ "${MODEL_CACHE_MAX_BYTES:-0}" != "0" ]; then
+    cat > /model_cache_paths.yaml <<EOF
+model_cache:
+  base_path: ${MODEL_CACHE_PATH}
+  is_default: true
+  checkpoints: checkpoints/
+  clip: clip/
+  text_encoders: clip/
+  clip_vision: clip_vision/
+  controlnet: controlnet/
+  loras: loras/
+  upscale_models: upscale_models/
+  vae: vae/
+  unet: unet/
+  diffusion_models: unet/
+EOF
+    COMFY_ARGS="${COMFY_ARGS} --extra-model-paths-config /model_cache_paths.yaml"
+fi
 
 
 # If /comfyui/models is not already a symlink and is a directory remove it. Also ensure that /runpod-volume/models exists
@@ -41,14 +63,14 @@ fi
 # Serve the API and don't shutdown the container
 if [ "$SERVE_API_LOCALLY" == "true" ]; then
     echo "runpod-worker-comfy: Starting ComfyUI"
-    python3 -u /comfyui/main.py --disable-auto-launch --listen &
+    python3 -u /comfyui/main.py ${COMFY_ARGS} --listen &
 
     echo "runpod-worker-comfy: Starting RunPod Handler"
-    python3 -u /rp_handler.py --rp_serve_api --rp_api_host=0.0.0.0
+    python3 -u /handler.py --rp_serve_api --rp_api_host=0.0.0.0
 else
     echo "runpod-worker-comfy: Starting ComfyUI"
-    python3 -u /comfyui/main.py --disable-auto-launch &
+    python3 -u /comfyui/main.py ${COMFY_ARGS} &
 
     echo "runpod-worker-comfy: Starting RunPod Handler"
-    python3 -u /rp_handler.py
+    python3 -u /handler.py
 fi
\ No newline at end of file
@@ -0,0 +1,187 @@
+import glob
+import hashlib
+import json
+import os
+
+from warmup import load_workflow
+
+
+def check_workflow(workflow):
+    """
+    Check that a workflow has the shape of the ComfyUI API format.
+
+    Args:
+        workflow (dict): The workflow to check.
+
+    Returns:
+        str: A description of the problem, or None if the workflow is well-formed.
+    """
+    if not isinstance(workflow, dict) or not workflow:
+        return "the workflow must be a non-empty object of nodes"
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict) or not isinstance(node.get("class_type"), str):
+            return f"node {node_id} has no class_type"
+        if not isinstance(node.get("inputs", {}), dict):
+            return f"the inputs of node {node_id} must be an object"
+    return None
+
+
+class Template:
+    """
+    A workflow loaded once, shared by all jobs that use it.
+
+    The template is validated once per set of node definitions and every node is
+    serialized once, so a job only validates and serializes the nodes it overrides.
+    """
+
+    def __init__(self, template_id, workflow):
+        self.template_id = template_id
+        self.workflow = workflow
+        self.serialized = json.dumps(workflow, sort_keys=True)
+        self.digest = hashlib.sha256(self.serialized.encode("utf-8")).hexdigest()
+        # The JSON of each node as it is sent to ComfyUI
+        self.node_json = {node_id: json.dumps(node) for node_id, node in workflow.items()}
+        self.checked_nodes = None
+        self.problem = None
+
+    def check(self, schema):
+        """
+        Validate the template against the node definitions, once for every set of
+        definitions the schema loads.
+
+        Args:
+            schema (ObjectInfoSchema): The node definitions of ComfyUI.
+
+        Returns:
+            str: A description of the first problem found, or None if there is none.
+        """
+        nodes = schema.nodes
+        if nodes is not self.checked_nodes:
+            self.problem = schema.validate(self.workflow)
+            self.checked_nodes = nodes
+        return self.problem
+
+    def serialize(self, workflow):
+        """
+        Return the JSON of a workflow built from this template, reusing the JSON
+        of every node that is shared with the template.
+
+        Args:
+            workflow (dict): The workflow, e.g. as returned by apply().
+
+        Returns:
+            str: The workflow serialized like json.dumps() does.
+        """
+        parts = []
+        for node_id, node in workflow.items():
+            if node is self.workflow.get(node_id):
+                node_json = self.node_json[node_id]
+            else:
+                node_json = json.dumps(node)
+            parts.append(f"{json.dumps(node_id)}: {node_json}")
+        return "{" + ", ".join(parts) + "}"
+
+    def key(self, overrides):
+        """
+        Return the hash identifying the workflow built with overrides, without
+        serializing the whole workflow.
+        """
+        hasher = hashlib.sha256(self.digest.encode("utf-8"))
+        hasher.update(json.dumps(overrides or {}, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+        return hasher.hexdigest()
+
+    def apply(self, overrides):
+        """
+        Return the workflow with the input values of overrides applied.
+
+        Only the overridden nodes are copied, all other nodes are shared with the
+        template and must not be modified.
+
+        Args:
+            overrides (dict): Maps node ids to the input values to set on them.
+
+        Returns:
+            tuple: (workflow, error_message) with the workflow, or None and a
+                   description of the problem.
+        """
+        if not overrides:
+            return self.workflow, None
+        workflow = dict(self.workflow)
+        for node_id, values in overrides.items():
+            node = workflow.get(str(node_id))
+            if node is None:
+                return None, f"Template '{self.template_id}' has no node {node_id}"
+            if not isinstance(values, dict):
+                return None, f"The overrides of node {node_id} must be an object of input values"
+            workflow[str(node_id)] = {**node, "inputs": {**node.get("inputs", {}), **values}}
+        return workflow, None
+
+
+class TemplateRegistry:
+    """
+    The workflow templates of the worker, loaded at startup from the *.json files
+    of a folder. The filename without its extension is the template id.
+
+    Templates are checked when they are loaded, a template that is not a valid
+    workflow is skipped with a log message.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.templates = {}
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.isdir(self.path):
+            return
+        for file_path in sorted(glob.glob(os.path.join(self.path, "*.json"))):
+            template_id = os.path.splitext(os.path.basename(file_path))[0]
+            try:
+                workflow = load_workflow(file_path)
+            except (OSError, ValueError) as e:
+                print(f"runpod-worker-comfy - skipping template {template_id}: {e}")
+                continue
+            problem = check_workflow(workflow)
+            if problem is not None:
+                print(f"runpod-worker-comfy - skipping template {template_id}: {problem}")
+                continue
+            self.templates[template_id] = Template(template_id, workflow)
+        if self.templates:
+            print(f"runpod-worker-comfy - loaded {len(self.templates)} workflow template(s) from {self.path}")
+
+    def get(self, template_id):
+        """
+        Return the template with the given id, or None if there is none.
+        """
+        return self.templates.get(template_id)
+
+    def check(self, schema):
+        """
+        Validate all templates against the node definitions, logging the invalid ones.
+
+        Args:
+            schema (ObjectInfoSchema): The node definitions of ComfyUI.
+        """
+        for template_id, template in self.templates.items():
+            problem = template.check(schema)
+            if problem is not None:
+                print(f"runpod-worker-comfy - template {template_id} is invalid: {problem}")
+
+    def render(self, template_id, overrides=None):
+        """
+        Build the workflow of a job from a template.
+
+        Args:
+            template_id (str): The id of the template.
+            overrides (dict): Maps node ids to the input values to set on them.
+
+        Returns:
+            tuple: (workflow, error_message) with the workflow, or None and a
+                   description of the problem.
+        """
+        template = self.templates.get(template_id)
+        if template is None:
+            return None, f"Unknown template '{template_id}'"
+        if overrides is not None and not isinstance(overrides, dict):
+            return None, "'overrides' must map node ids to objects of input values"
+        return template.apply(overrides)
@@ -0,0 +1,100 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class JobTrace:
+    """
+    Timing trace of a single job.
+
+    Phases are durations measured with phase(), a phase entered more than once
+    accumulates. Marks are points in time relative to the start of the job,
+    only the first mark of each name is kept so that "first_progress" really is
+    the first one. Marks may be set from other threads, e.g. the websocket thread.
+    """
+
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self.requested = False
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self.phases = {}
+        self.marks = {}
+        self.nodes = []
+        self.lock = threading.Lock()
+
+    def _elapsed_ms(self, since):
+        return round((time.perf_counter() - since) * 1000, 2)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Measure the duration of the enclosed block as the phase name.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = self._elapsed_ms(start_time)
+            with self.lock:
+                self.phases[name] = round(self.phases.get(name, 0) + elapsed_ms, 2)
+
+    def mark(self, name):
+        """
+        Record the first time the event name happened.
+        """
+        elapsed_ms = self._elapsed_ms(self.start_time)
+        with self.lock:
+            self.marks.setdefault(name, elapsed_ms)
+
+    def between(self, start_mark, end_mark):
+        """
+        Return the milliseconds between two marks, or None if either is missing.
+        """
+        with self.lock:
+            if start_mark not in self.marks or end_mark not in self.marks:
+                return None
+            return round(self.marks[end_mark] - self.marks[start_mark], 2)
+
+    def finish(self):
+        """
+        Mark the end of the job.
+        """
+        self.end_time = time.perf_counter()
+        self.mark("returned")
+
+    def to_dict(self):
+        """
+        Return the trace as a JSON serializable dictionary.
+
+        Besides the raw phases and marks it contains the derived durations
+        "queue_wait" (submit to first event of execution), "execution" (first
+        event of execution to completion), "time_to_first_progress" (submit to
+        first progress update), "time_to_first_image" (submit to the first output
+        image being ready) and "success_to_return" (completion to the job
+        returning), and the execution time of each node under "nodes".
+        """
+        end_time = self.end_time or time.perf_counter()
+        derived = {
+            "queue_wait": self.between("submitted", "execution_started"),
+            "execution": self.between("execution_started", "execution_success"),
+            "time_to_first_progress": self.between("submitted", "first_progress"),
+            "time_to_first_image": self.between("submitted", "first_image"),
+            "success_to_return": self.between("execution_success", "returned"),
+        }
+        with self.lock:
+            return {
+                "job_id": self.job_id,
+                "total_ms": round((end_time - self.start_time) * 1000, 2),
+                "phases_ms": dict(self.phases),
+                "marks_ms": dict(self.marks),
+                "derived_ms": {key: value for key, value in derived.items() if value is not None},
+                "nodes": list(self.nodes),
+            }
+
+    def log(self):
+        """
+        Emit the trace as a single structured log line.
+        """
+        print(f"runpod-worker-comfy - trace {json.dumps(self.to_dict(), separators=(',', ':'))}")
@@ -0,0 +1,211 @@
+import io
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, features
+
+import metrics
+
+# Formats outputs can be transcoded to: output_format -> (Pillow format, file extension)
+FORMATS = {
+    "png": ("PNG", ".png"),
+    "webp": ("WEBP", ".webp"),
+    "jpeg": ("JPEG", ".jpg"),
+    "jpg": ("JPEG", ".jpg"),
+    "avif": ("AVIF", ".avif"),
+}
+# Pillow features the formats need, not every build of Pillow can encode all of them
+FEATURES = {"PNG": "zlib", "WEBP": "webp", "JPEG": "jpg", "AVIF": "avif"}
+# Quality used when a job asks for a lossy format without giving one
+DEFAULT_QUALITY = 90
+
+
+def ready():
+    """
+    Return right away. Runs in the worker processes of the Transcoder to start them.
+    """
+
+
+def encode(data, pillow_format, quality):
+    """
+    Re-encode an image. Runs in the worker processes of the Transcoder.
+
+    Args:
+        data (bytes): The image as saved by ComfyUI.
+        pillow_format (str): The Pillow format to encode to.
+        quality (int): The quality of lossy formats, 1 to 100.
+
+    Returns:
+        bytes: The encoded image.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        if pillow_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        if pillow_format == "PNG":
+            image.save(output, format=pillow_format, optimize=True)
+        else:
+            image.save(output, format=pillow_format, quality=quality)
+        return output.getvalue()
+
+
+class OutputFormat:
+    """
+    The output format a job asked for, collecting the transcoding statistics of
+    the job's images.
+    """
+
+    def __init__(self, output_format, quality=DEFAULT_QUALITY, lossless=False):
+        self.output_format = output_format
+        self.pillow_format, self.extension = FORMATS[output_format]
+        self.quality = quality
+        self.lossless = lossless
+        self.lock = threading.Lock()
+        self.images = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.ms = 0.0
+
+    @classmethod
+    def from_input(cls, job_input):
+        """
+        Read "output_format", "quality" and "lossless" from the input of a job.
+
+        Args:
+            job_input (dict): The input of the job.
+
+        Returns:
+            tuple: (output_format, error_message) with the OutputFormat, or None if
+                   the outputs are returned as saved by ComfyUI, and a description
+                   of the problem, if any.
+        """
+        output_format = job_input.get("output_format")
+        if output_format is None:
+            return None, None
+        if not isinstance(output_format, str) or output_format.lower() not in FORMATS:
+            return None, f"'output_format' must be one of {', '.join(FORMATS)}"
+        if not features.check(FEATURES[FORMATS[output_format.lower()][0]]):
+            return None, f"'output_format' {output_format.lower()} is not supported by this worker"
+        quality = job_input.get("quality", DEFAULT_QUALITY)
+        if isinstance(quality, bool) or not isinstance(quality, int) or not 1 <= quality <= 100:
+            return None, "'quality' must be an integer between 1 and 100"
+        return cls(output_format.lower(), quality, bool(job_input.get("lossless", False))), None
+
+    @property
+    def key(self):
+        """
+        A string identifying the output of this format, for cache keys.
+        """
+        return f"{self.pillow_format}:{self.quality}:{self.lossless}"
+
+    def applies_to(self, filename):
+        """
+        Return whether an image saved as filename is transcoded. Lossless output
+        keeps the images as saved by ComfyUI, as do images already in the format.
+        """
+        if self.lossless:
+            return False
+        return os.path.splitext(filename)[1].lower() != self.extension
+
+    def record(self, bytes_in, bytes_out, ms):
+        with self.lock:
+            self.images += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.ms += ms
+
+    def summary(self):
+        """
+        Return the transcoding statistics of the job.
+        """
+        with self.lock:
+            return {
+                "format": self.output_format,
+                "images": self.images,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "bytes_saved": self.bytes_in - self.bytes_out,
+                "ms": round(self.ms, 2),
+            }
+
+
+class Transcoder:
+    """
+    Transcodes output images in a pool of worker processes, so encoding large
+    images uses all cores instead of contending for the GIL with the handler.
+    With workers set to 0 images are transcoded in the calling thread. An image
+    that cannot be transcoded is returned as saved by ComfyUI, and a pool whose
+    processes died is replaced for the next image.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def transcode(self, filename, data, output_format):
+        """
+        Transcode an image into the format a job asked for.
+
+        Args:
+            filename (str): The filename of the image.
+            data (bytes): The image.
+            output_format (OutputFormat): The format to transcode to.
+
+        Returns:
+            tuple: (filename, data) of the transcoded image, or the image itself
+                   if it is not transcoded or transcoding failed.
+        """
+        if output_format is None or not output_format.applies_to(filename):
+            return filename, data
+        start_time = time.perf_counter()
+        args = (data, output_format.pillow_format, output_format.quality)
+        try:
+            if self.workers > 0:
+                executor = self._executor()
+                try:
+                    transcoded = executor.submit(encode, *args).result()
+                except BrokenProcessPool:
+                    self._reset(executor)
+                    raise
+            else:
+                transcoded = encode(*args)
+        except Exception as e:
+            print(
+                f"runpod-worker-comfy - warning: could not transcode {filename} "
+                f"to {output_format.output_format}, returning it as saved: {e!r}"
+            )
+            return filename, data
+        elapsed = time.perf_counter() - start_time
+        output_format.record(len(data), len(transcoded), elapsed * 1000)
+        metrics.TRANSCODE_SECONDS.observe(elapsed, format=output_format.output_format)
+        metrics.TRANSCODE_SAVED_BYTES.inc(len(data) - len(transcoded), format=output_format.output_format)
+        return os.path.splitext(filename)[0] + output_format.extension, transcoded
+
+    def start(self):
+        """
+        Start the worker processes now, so the first job does not wait for them.
+        """
+        if self.workers > 0:
+            executor = self._executor()
+            for _ in range(self.workers):
+                executor.submit(ready)
+
+    def _reset(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                # Forking a process that runs the websocket and callback threads is not safe
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self.executor
@@ -0,0 +1,91 @@
+import glob
+import json
+import os
+import time
+
+import comfyclient
+
+
+def warmup_files(spec):
+    """
+    Resolve the configured warm-up workflows to a list of files.
+
+    Args:
+        spec (str): Comma separated workflow files or folders. Folders stand for
+            all the *.json files in them, in alphabetical order.
+
+    Returns:
+        list: The paths of the workflow files, in the configured order.
+    """
+    paths = []
+    for entry in (spec or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        if os.path.isdir(entry):
+            paths.extend(sorted(glob.glob(os.path.join(entry, "*.json"))))
+        else:
+            paths.append(entry)
+    return paths
+
+
+def load_workflow(path):
+    """
+    Read a warm-up workflow, either a request body like test_input.json or a
+    workflow exported from ComfyUI in the API format.
+
+    Args:
+        path (str): The workflow file.
+
+    Returns:
+        dict: The workflow.
+
+    Raises:
+        ValueError: If the file is not JSON or does not hold a workflow object.
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+    if isinstance(data, dict) and isinstance(data.get("input"), dict) and "workflow" in data["input"]:
+        data = data["input"]["workflow"]
+    if isinstance(data, str):
+        data = json.loads(data)
+    if not isinstance(data, dict):
+        raise ValueError(f"expected a workflow object, got {type(data).__name__}")
+    return data
+
+
+def run_warmups(server_address, paths, timeout=600):
+    """
+    Run the warm-up workflows one after the other, so the models they load are
+    in memory before the first job.
+
+    A warm-up that fails is logged and skipped, it never keeps the worker from
+    taking jobs.
+
+    Args:
+        server_address (str): The host and port of ComfyUI.
+        paths (list): The workflow files to run.
+        timeout (float): Seconds a warm-up may go without any progress.
+
+    Returns:
+        list: One entry per workflow with its "workflow", final "status", "ms"
+              and the execution time of its nodes under "nodes".
+    """
+    results = []
+    for path in paths:
+        start_time = time.perf_counter()
+        nodes = []
+        try:
+            workflow = load_workflow(path)
+            client = comfyclient.ComfyClient(server_address, timeout=timeout)
+            client.submit(workflow)
+            status = client.wait_until_finished()["status"]
+            nodes = client.node_timings
+        except (OSError, ValueError) as e:
+            print(f"runpod-worker-comfy - warm-up {path} could not be loaded: {e}")
+            status = "error"
+        elapsed_ms = round((time.perf_counter() - start_time) * 1000, 2)
+        result = {"workflow": path, "status": status, "ms": elapsed_ms, "nodes": nodes}
+        print(f"runpod-worker-comfy - warm-up {json.dumps(result, separators=(',', ':'))}")
+        results.append(result)
+    return results
@@ -0,0 +1,95 @@
+import contextlib
+import unittest
+import sys
+import os
+import threading
+import time
+
+# Make sure that "src" is known and can be used to import batching.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import batching
+
+
+def workflow(seed, text="a cat", steps=20):
+    return {
+        "3": {"class_type": "KSampler", "inputs": {"seed": seed, "steps": steps, "positive": ["6", 0]}},
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": text}},
+    }
+
+
+class FakeClient:
+    def __init__(self, submitted):
+        self.submitted = submitted
+
+    def submit(self, workflow, job_id=None, prompt_json=None):
+        self.submitted.append(job_id)
+        return f"prompt-{job_id}"
+
+
+class TestBatchScheduler(unittest.TestCase):
+    def test_structure_key_ignores_batch_inputs(self):
+        key = batching.structure_key(workflow(1), {"seed", "text"})
+
+        self.assertEqual(key, batching.structure_key(workflow(2, "a dog"), {"seed", "text"}))
+        self.assertNotEqual(key, batching.structure_key(workflow(1, steps=30), {"seed", "text"}))
+        self.assertNotEqual(key, batching.structure_key(workflow(2), {"text"}))
+
+    def test_disabled_scheduler_submits_right_away(self):
+        submitted = []
+        scheduler = batching.BatchScheduler(0, 8, ["seed"])
+
+        self.assertEqual(scheduler.submit(FakeClient(submitted), workflow(1), "a"), "prompt-a")
+        self.assertEqual(submitted, ["a"])
+
+    def test_identical_structures_are_submitted_back_to_back(self):
+        submitted = []
+        scheduler = batching.BatchScheduler(60, 3, ["seed", "text"])
+        results = {}
+
+        def submit(job_id, job_workflow):
+            results[job_id] = scheduler.submit(FakeClient(submitted), job_workflow, job_id)
+
+        threads = []
+        jobs = contextlib.ExitStack()
+        for _ in range(3):
+            jobs.enter_context(scheduler.job())
+        for count, (job_id, job_workflow) in enumerate([("a1", workflow(1)), ("a2", workflow(2, "a dog")), ("a3", workflow(3))]):
+            thread = threading.Thread(target=submit, args=(job_id, job_workflow))
+            thread.start()
+            threads.append(thread)
+            # Keep the order of arrival
+            while count < 2 and sum(len(batch.members) for batch in scheduler.batches.values()) <= count:
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join(5)
+        jobs.close()
+
+        # The batch is full and goes out long before its window closes
+        self.assertEqual(submitted, ["a1", "a2", "a3"])
+        self.assertEqual(results, {"a1": "prompt-a1", "a2": "prompt-a2", "a3": "prompt-a3"})
+        self.assertEqual(scheduler.batches, {})
+
+    def test_batch_is_submitted_when_the_window_closes(self):
+        submitted = []
+        scheduler = batching.BatchScheduler(0.05, 8, ["seed"])
+
+        start_time = time.monotonic()
+        with scheduler.job(), scheduler.job():
+            self.assertEqual(scheduler.submit(FakeClient(submitted), workflow(1), "a"), "prompt-a")
+
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.05)
+        self.assertEqual(submitted, ["a"])
+        self.assertEqual(scheduler.batches, {})
+
+    def test_lone_job_does_not_wait_for_the_window(self):
+        submitted = []
+        scheduler = batching.BatchScheduler(60, 8, ["seed"])
+
+        start_time = time.monotonic()
+        with scheduler.job():
+            self.assertEqual(scheduler.submit(FakeClient(submitted), workflow(1), "a"), "prompt-a")
+
+        self.assertLess(time.monotonic() - start_time, 5)
+        self.assertEqual(submitted, ["a"])
+        self.assertEqual(scheduler.batches, {})
+        self.assertEqual(scheduler.jobs, 0)
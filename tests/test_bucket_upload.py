@@ -0,0 +1,106 @@
+import unittest
+import sys
+import os
+import socket
+import tempfile
+import hashlib
+from unittest.mock import patch
+
+import boto3
+import requests
+from moto.server import ThreadedMotoServer
+
+# Make sure that "src" is known and can be used to import bucket_upload.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import bucket_upload
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class TestBucketUploader(unittest.TestCase):
+    """Runs against a local S3 compatible server."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.port = free_port()
+        cls.server = ThreadedMotoServer(ip_address="127.0.0.1", port=cls.port)
+        cls.server.start()
+        cls.endpoint_url = f"http://127.0.0.1:{cls.port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.uploader = bucket_upload.BucketUploader(
+            self.endpoint_url, "key", "secret",
+            bucket_name="outputs",
+            key_template="{date}/{job_id}/{stem}-{uuid}{ext}",
+            multipart_threshold=5 * 1024 * 1024,
+            multipart_chunksize=5 * 1024 * 1024,
+        )
+        self.s3 = boto3.client(
+            "s3", endpoint_url=self.endpoint_url, aws_access_key_id="key",
+            aws_secret_access_key="secret", region_name="us-east-1",
+        )
+        self.s3.create_bucket(Bucket="outputs")
+
+    def test_key_layout(self):
+        key = self.uploader.key_for("job", "ComfyUI_00001_.png")
+
+        date, job_id, name = key.split("/")
+        self.assertEqual(job_id, "job")
+        self.assertRegex(name, r"^ComfyUI_00001_-[0-9a-f]{8}\.png$")
+        self.assertEqual(len(date), 10)
+
+    def test_upload_from_memory(self):
+        url = self.uploader.upload("job/image.png", data=b"image")
+
+        self.assertEqual(requests.get(url).content, b"image")
+        head = self.s3.head_object(Bucket="outputs", Key="job/image.png")
+        self.assertEqual(head["ContentType"], "image/png")
+
+    def test_large_images_are_uploaded_in_parts(self):
+        data = os.urandom(11 * 1024 * 1024)
+        with tempfile.NamedTemporaryFile(suffix=".webp") as f:
+            f.write(data)
+            f.flush()
+            self.uploader.upload("job/large.webp", path=f.name)
+
+        head = self.s3.head_object(Bucket="outputs", Key="job/large.webp")
+        # Objects uploaded in parts have an ETag ending in the number of parts
+        self.assertTrue(head["ETag"].strip('"').endswith("-3"))
+        self.assertEqual(self.s3.get_object(Bucket="outputs", Key="job/large.webp")["Body"].read(), data)
+
+    def test_configured(self):
+        self.assertTrue(self.uploader.configured)
+        self.assertFalse(bucket_upload.BucketUploader("http://example.com", "", "").configured)
+
+    def test_deduplicated_uploads_reuse_the_first_upload(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            index_path = os.path.join(tmp, "index.jsonl")
+            self.uploader.index = bucket_upload.UploadIndex(index_path)
+
+            url, uploaded = self.uploader.upload_image("job1", "ComfyUI_00001_.PNG", data=b"same")
+            self.assertTrue(uploaded)
+            with patch.object(self.uploader, "upload") as upload:
+                # A restarted worker reads the index from the file
+                self.uploader.index = bucket_upload.UploadIndex(index_path)
+                again, uploaded = self.uploader.upload_image("job2", "ComfyUI_00007_.png", data=b"same")
+            upload.assert_not_called()
+
+        self.assertFalse(uploaded)
+        key = hashlib.sha256(b"same").hexdigest() + ".png"
+        self.assertIn(key, again)
+        self.assertEqual(requests.get(again).content, b"same")
+        self.assertEqual([o["Key"] for o in self.s3.list_objects_v2(Bucket="outputs")["Contents"]], [key])
+
+    def test_content_digest_of_files(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"image")
+            f.flush()
+            self.assertEqual(bucket_upload.content_digest(path=f.name), bucket_upload.content_digest(data=b"image"))
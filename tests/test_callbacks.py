@@ -0,0 +1,93 @@
+import unittest
+from unittest.mock import patch, Mock
+import sys
+import os
+import threading
+import time
+
+# Make sure that "src" is known and can be used to import callbacks.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import callbacks
+
+
+class TestCallbackDispatcher(unittest.TestCase):
+    def test_pending_statuses_are_coalesced(self):
+        dispatcher = callbacks.CallbackDispatcher(workers=1)
+        # Keep the worker threads from picking up the queue
+        dispatcher.threads = ["started"]
+
+        dispatcher.send_status("job", "http://example.com/status", {"value": 1})
+        dispatcher.send_status("job", "http://example.com/status", {"value": 2})
+        dispatcher.send_status("other", "http://example.com/status", {"value": 1})
+
+        self.assertEqual([d.payload for d in dispatcher.queue], [{"value": 2}, {"value": 1}])
+
+    def test_statuses_are_dropped_when_queue_is_full(self):
+        dispatcher = callbacks.CallbackDispatcher(workers=1, max_queue=1)
+        dispatcher.threads = ["started"]
+
+        dispatcher.send_status("a", "http://example.com/status", {})
+        dispatcher.send_status("b", "http://example.com/status", {})
+        dispatcher.send_result("http://example.com/result", {})
+
+        self.assertEqual([d.kind for d in dispatcher.queue], ["status", "result"])
+
+    def test_result_is_retried_and_flushed(self):
+        dispatcher = callbacks.CallbackDispatcher(workers=1, retries=2, backoff=0)
+        responses = [
+            callbacks.requests.ConnectionError("refused"),
+            Mock(status_code=503, text="busy"),
+            Mock(status_code=200, text="ok"),
+        ]
+
+        with patch.object(dispatcher.session, "post", side_effect=responses) as mock_post:
+            delivery = dispatcher.send_result("http://example.com/result", {"status": "success"})
+            self.assertTrue(dispatcher.flush(timeout=5))
+
+        self.assertTrue(delivery.done.is_set())
+        self.assertTrue(delivery.delivered)
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(mock_post.call_args.kwargs["timeout"], dispatcher.timeout)
+
+    def test_slow_endpoint_does_not_block_the_caller(self):
+        dispatcher = callbacks.CallbackDispatcher(workers=1)
+        release = threading.Event()
+
+        def slow_post(*args, **kwargs):
+            release.wait(5)
+            return Mock(status_code=200, text="ok")
+
+        with patch.object(dispatcher.session, "post", side_effect=slow_post):
+            delivery = dispatcher.send_result("http://example.com/result", {})
+            self.assertFalse(delivery.done.is_set())
+            self.assertFalse(dispatcher.flush(timeout=0.01))
+            release.set()
+            self.assertTrue(dispatcher.flush(timeout=5))
+
+    def test_callbacks_of_a_job_are_sent_in_order(self):
+        dispatcher = callbacks.CallbackDispatcher(workers=2)
+        release = threading.Event()
+        posted = []
+
+        def post(url, json, timeout):
+            posted.append(json)
+            if json == {"status": "processing"}:
+                release.wait(5)
+            return Mock(status_code=200, text="ok")
+
+        with patch.object(dispatcher.session, "post", side_effect=post):
+            dispatcher.send_status("job", "http://example.com/status", {"status": "processing"})
+            while not posted:
+                time.sleep(0.01)
+            dispatcher.send_status("job", "http://example.com/status", {"status": "error"})
+            dispatcher.send_result("http://example.com/result", {"result": "error"}, "job")
+            dispatcher.send_status("other", "http://example.com/status", {"status": "queued"})
+            # The second worker sends the other job's status while the first one is busy
+            while len(posted) < 2:
+                time.sleep(0.01)
+            release.set()
+            self.assertTrue(dispatcher.flush(timeout=5))
+
+        self.assertEqual(posted, [
+            {"status": "processing"}, {"status": "queued"}, {"status": "error"}, {"result": "error"},
+        ])
@@ -0,0 +1,300 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+import os
+import json
+import threading
+import time
+
+# Make sure that "src" is known and can be used to import comfyclient.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import comfyclient
+
+
+def _message(msg_type, **data):
+    return json.dumps({"type": msg_type, "data": data})
+
+
+class TestComfyEventStream(unittest.TestCase):
+    def test_events_are_routed_by_prompt_id(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        received_a, received_b = [], []
+        stream.subscribe("a", received_a.append)
+        stream.subscribe("b", received_b.append)
+
+        stream._on_message(None, _message("executing", node="3", prompt_id="a"))
+        stream._on_message(None, _message("executing", node="4", prompt_id="b"))
+
+        self.assertEqual([m["data"]["node"] for m in received_a], ["3"])
+        self.assertEqual([m["data"]["node"] for m in received_b], ["4"])
+
+    def test_events_before_subscribe_are_replayed_in_order(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        stream._on_message(None, _message("executing", node="3", prompt_id="a"))
+        stream._on_message(None, _message("executed", node="9", output={"images": []}, prompt_id="a"))
+
+        received = []
+        stream.subscribe("a", received.append)
+
+        self.assertEqual([m["type"] for m in received], ["executing", "executed"])
+        self.assertNotIn("a", stream.pending)
+
+    def test_status_is_broadcast_and_tracks_queue(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        received = []
+        stream.subscribe("a", received.append)
+
+        stream._on_message(None, _message("status", status={"exec_info": {"queue_remaining": 2}}))
+
+        self.assertEqual(stream.queue_remaining, 2)
+        self.assertEqual(received[0]["type"], "status")
+
+    def test_binary_frames_outside_execution_are_ignored(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        stream._on_message(None, b"\x00\x00\x00\x01\x00\x00\x00\x02png")
+        self.assertEqual(len(stream.pending), 0)
+
+
+    def test_binary_frames_are_routed_to_executing_node(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        received = []
+        stream.subscribe("a", received.append)
+
+        stream._on_message(None, _message("executing", node="12", prompt_id="a"))
+        stream._on_message(None, b"\x00\x00\x00\x01\x00\x00\x00\x02png")
+
+        self.assertEqual(received[-1]["type"], "image")
+        self.assertEqual(received[-1]["data"]["node"], "12")
+        self.assertEqual(received[-1]["data"]["format"], "png")
+        self.assertEqual(received[-1]["data"]["image"], b"png")
+
+    def test_recover_replays_the_outcome_of_finished_and_lost_prompts(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        responses = {
+            "/queue": {"queue_running": [[1, "running", {}, {}, []]], "queue_pending": []},
+            "/history/done": {"done": {"status": {"status_str": "success", "completed": True}, "outputs": {"9": {"images": []}}}},
+            "/history/failed": {"failed": {"status": {"status_str": "error", "completed": False, "messages": [
+                ["execution_start", {"prompt_id": "failed"}],
+                ["execution_error", {"prompt_id": "failed", "node_id": "4", "exception_message": "out of memory"}],
+            ]}}},
+            "/history/running": {},
+            "/history/lost": {},
+        }
+
+        def fake_urlopen(url):
+            response = MagicMock()
+            response.__enter__.return_value.read.return_value = json.dumps(responses[url.split("8188")[1]]).encode()
+            return response
+
+        received = {prompt_id: [] for prompt_id in ("done", "failed", "running", "lost")}
+        for prompt_id, messages in received.items():
+            stream.subscribe(prompt_id, messages.append)
+        with patch("comfyclient.urllib.request.urlopen", side_effect=fake_urlopen):
+            stream._recover(list(received))
+
+        self.assertEqual([m["type"] for m in received["done"]], ["executed", "execution_success"])
+        self.assertEqual([m["type"] for m in received["failed"]], ["execution_error"])
+        self.assertEqual(received["failed"][0]["data"]["exception_message"], "out of memory")
+        self.assertEqual(received["running"], [])
+        self.assertEqual([m["type"] for m in received["lost"]], ["execution_error"])
+        self.assertEqual(received["lost"][0]["data"]["prompt_id"], "lost")
+
+
+class TestComfyClient(unittest.TestCase):
+    def _submit(self, client, stream, prompt_id=None):
+        def fake_urlopen(req):
+            body = json.loads(req.data)
+            response = MagicMock()
+            response.read.return_value = json.dumps({"prompt_id": prompt_id or body["prompt_id"]}).encode()
+            return response
+
+        with patch("comfyclient.urllib.request.urlopen", side_effect=fake_urlopen):
+            return client.submit({"1": {}}, "job")
+
+    def test_submit_completes_on_execution_success(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        stream.connected.set()
+        client = comfyclient.ComfyClient(event_stream=stream)
+
+        prompt_id = self._submit(client, stream)
+        stream._on_message(None, _message("executed", node="9", output={"images": [{"filename": "a.png"}]}, prompt_id=prompt_id))
+        stream._on_message(None, _message("execution_success", prompt_id=prompt_id))
+
+        self.assertTrue(client.is_finished())
+        self.assertEqual(client.getStatus()["status"], "completed")
+        self.assertEqual(client.outputs, [{"images": [{"filename": "a.png"}]}])
+        self.assertNotIn(prompt_id, stream.subscribers)
+
+    def test_submit_sends_the_given_prompt_json(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        stream.connected.set()
+        client = comfyclient.ComfyClient(event_stream=stream)
+        sent = []
+
+        def fake_urlopen(req):
+            sent.append(json.loads(req.data))
+            response = MagicMock()
+            response.read.return_value = json.dumps({"prompt_id": sent[-1]["prompt_id"]}).encode()
+            return response
+
+        with patch("comfyclient.urllib.request.urlopen", side_effect=fake_urlopen):
+            prompt_id = client.submit({"1": {}}, "job", '{"1": {"class_type": "Cached"}}')
+
+        self.assertEqual(sent, [{"prompt": {"1": {"class_type": "Cached"}}, "client_id": "worker", "prompt_id": prompt_id}])
+
+    def test_submit_follows_server_assigned_prompt_id(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        stream.connected.set()
+        # Events can arrive before the /prompt response is read
+        stream._on_message(None, _message("executing", node="3", prompt_id="server-id"))
+        client = comfyclient.ComfyClient(event_stream=stream)
+
+        prompt_id = self._submit(client, stream, prompt_id="server-id")
+
+        self.assertEqual(prompt_id, "server-id")
+        self.assertEqual(client.getStatus()["status"], "processing")
+        self.assertEqual(list(stream.subscribers), ["server-id"])
+
+    def test_iter_statuses_yields_every_transition(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        stream.connected.set()
+        client = comfyclient.ComfyClient(event_stream=stream)
+
+        prompt_id = self._submit(client, stream)
+        stream._on_message(None, _message("executing", node="3", prompt_id=prompt_id))
+        stream._on_message(None, _message("progress", value=1, max=2, prompt_id=prompt_id))
+        stream._on_message(None, _message("progress", value=2, max=2, prompt_id=prompt_id))
+        stream._on_message(None, _message("execution_success", prompt_id=prompt_id))
+
+        statuses = [status["status"] for status in client.iter_statuses()]
+
+        self.assertEqual(statuses, ["processing", "processing", "processing", "completed"])
+
+    def test_execution_error_finishes_with_error_details(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        stream.connected.set()
+        client = comfyclient.ComfyClient(event_stream=stream)
+
+        prompt_id = self._submit(client, stream)
+        stream._on_message(None, _message(
+            "execution_error", prompt_id=prompt_id, node_id="4", node_type="CheckpointLoaderSimple",
+            exception_message="model not found", exception_type="FileNotFoundError", traceback=[],
+        ))
+
+        status = client.wait_until_finished()
+
+        self.assertEqual(status["status"], "error")
+        self.assertEqual(status["data"]["error"]["message"], "model not found")
+        self.assertEqual(status["data"]["error"]["details"]["node_type"], "CheckpointLoaderSimple")
+
+    def test_iter_statuses_times_out_without_events(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        stream.connected.set()
+        client = comfyclient.ComfyClient(timeout=0.01, event_stream=stream)
+
+        prompt_id = self._submit(client, stream)
+        requests = []
+
+        def fake_urlopen(req, timeout=None):
+            requests.append(req)
+            response = MagicMock()
+            response.__enter__.return_value.read.return_value = json.dumps({"queue_running": []}).encode()
+            return response
+
+        with patch("comfyclient.urllib.request.urlopen", side_effect=fake_urlopen):
+            self.assertEqual(client.wait_until_finished()["status"], "timed out")
+
+        self.assertNotIn(prompt_id, stream.subscribers)
+        # The prompt is removed from the queue of ComfyUI
+        self.assertTrue(requests[-1].full_url.endswith("/queue"))
+        self.assertEqual(json.loads(requests[-1].data), {"delete": [prompt_id]})
+
+    def test_queued_prompt_does_not_time_out_while_others_progress(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        stream.connected.set()
+        client = comfyclient.ComfyClient(timeout=0.2, event_stream=stream)
+        prompt_id = self._submit(client, stream)
+        stream._on_message(None, _message("status", status={"exec_info": {"queue_remaining": 2}}))
+
+        def other_prompt_progresses():
+            for value in range(6):
+                time.sleep(0.05)
+                stream._on_message(None, _message("progress", value=value, max=6, prompt_id="other"))
+            stream._on_message(None, _message("execution_success", prompt_id=prompt_id))
+
+        thread = threading.Thread(target=other_prompt_progresses)
+        thread.start()
+        statuses = [status["status"] for status in client.iter_statuses()]
+        thread.join()
+
+        self.assertEqual(statuses, ["queued", "completed"])
+
+    def test_timeout_unsubscribes_without_holding_the_client_lock(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        stream.connected.set()
+        client = comfyclient.ComfyClient(timeout=0.01, event_stream=stream)
+        prompt_id = self._submit(client, stream)
+        locked = []
+        unsubscribe = stream.unsubscribe
+
+        def checked_unsubscribe(prompt_id):
+            # Taking the stream lock while holding the client lock deadlocks with the websocket thread
+            locked.append(client.lock.locked())
+            unsubscribe(prompt_id)
+
+        with patch.object(stream, "unsubscribe", side_effect=checked_unsubscribe):
+            self.assertEqual(client.wait_until_finished()["status"], "timed out")
+
+        self.assertEqual(locked, [False])
+
+    def test_save_image_websocket_frames_are_collected(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        stream.connected.set()
+        client = comfyclient.ComfyClient(event_stream=stream)
+
+        def fake_urlopen(req):
+            response = MagicMock()
+            response.read.return_value = json.dumps({"prompt_id": json.loads(req.data)["prompt_id"]}).encode()
+            return response
+
+        workflow = {"3": {"class_type": "KSampler"}, "12": {"class_type": "SaveImageWebsocket"}}
+        with patch("comfyclient.urllib.request.urlopen", side_effect=fake_urlopen):
+            prompt_id = client.submit(workflow)
+
+        stream._on_message(None, _message("executing", node="3", prompt_id=prompt_id))
+        stream._on_message(None, b"\x00\x00\x00\x01\x00\x00\x00\x01preview")
+        stream._on_message(None, _message("executing", node="12", prompt_id=prompt_id))
+        stream._on_message(None, b"\x00\x00\x00\x01\x00\x00\x00\x02final")
+
+        self.assertEqual(client.websocket_images, {"12": [{"format": "png", "image": b"final"}]})
+
+    def test_node_timings_are_collected_by_class_type(self):
+        stream = comfyclient.ComfyEventStream(client_id="worker")
+        stream.connected.set()
+        client = comfyclient.ComfyClient(event_stream=stream)
+
+        def fake_urlopen(req):
+            response = MagicMock()
+            response.read.return_value = json.dumps({"prompt_id": json.loads(req.data)["prompt_id"]}).encode()
+            return response
+
+        workflow = {
+            "4": {"class_type": "CheckpointLoaderSimple"},
+            "3": {"class_type": "KSampler"},
+            "8": {"class_type": "VAEDecode"},
+        }
+        with patch("comfyclient.urllib.request.urlopen", side_effect=fake_urlopen):
+            prompt_id = client.submit(workflow)
+
+        with patch("comfyclient.time.perf_counter", side_effect=[1.0, 3.0, 3.5]):
+            stream._on_message(None, _message("execution_cached", nodes=["4"], prompt_id=prompt_id))
+            stream._on_message(None, _message("executing", node="3", prompt_id=prompt_id))
+            stream._on_message(None, _message("progress", value=1, max=1, prompt_id=prompt_id))
+            stream._on_message(None, _message("executing", node="8", prompt_id=prompt_id))
+            stream._on_message(None, _message("execution_success", prompt_id=prompt_id))
+
+        self.assertEqual(client.node_timings, [
+            {"node": "4", "class_type": "CheckpointLoaderSimple", "ms": 0, "cached": True},
+            {"node": "3", "class_type": "KSampler", "ms": 2000.0, "cached": False},
+            {"node": "8", "class_type": "VAEDecode", "ms": 500.0, "cached": False},
+        ])
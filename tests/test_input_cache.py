@@ -0,0 +1,250 @@
+import unittest
+import unittest.mock
+import sys
+import os
+import tempfile
+
+# Make sure that "src" is known and can be used to import input_cache.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import input_cache
+
+
+class TestInputImageCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.input_path = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _store(self, cache, key, size):
+        filename = cache.filename_for(key, "image.png")
+        with open(os.path.join(self.input_path, filename), "wb") as f:
+            f.write(b"x" * size)
+        cache.add(key, filename, size)
+        return filename
+
+    def test_lookup_hits_after_add(self):
+        cache = input_cache.InputImageCache(self.input_path, max_bytes=100)
+        key = input_cache.digest("aW1hZ2U=")
+        self.assertIsNone(cache.lookup(key))
+
+        filename = self._store(cache, key, 10)
+
+        self.assertEqual(cache.lookup(key), filename)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lookup_misses_when_file_is_gone(self):
+        cache = input_cache.InputImageCache(self.input_path, max_bytes=100)
+        filename = self._store(cache, "abc", 10)
+        os.remove(os.path.join(self.input_path, filename))
+
+        self.assertIsNone(cache.lookup("abc"))
+        self.assertEqual(cache.total_bytes, 0)
+
+    def test_least_recently_used_files_are_evicted(self):
+        cache = input_cache.InputImageCache(self.input_path, max_bytes=25)
+        first = self._store(cache, "a", 10)
+        self._store(cache, "b", 10)
+        cache.lookup("a")
+        self._store(cache, "c", 10)
+
+        self.assertEqual(list(cache.entries), ["a", "c"])
+        self.assertTrue(os.path.exists(os.path.join(self.input_path, first)))
+        self.assertFalse(os.path.exists(os.path.join(self.input_path, cache.filename_for("b", "image.png"))))
+
+    def test_existing_files_are_indexed_on_start(self):
+        cache = input_cache.InputImageCache(self.input_path, max_bytes=100)
+        filename = self._store(cache, "abc", 10)
+
+        restarted = input_cache.InputImageCache(self.input_path, max_bytes=100)
+
+        self.assertEqual(restarted.lookup("abc"), filename)
+
+    def test_rewrite_workflow_replaces_image_names(self):
+        workflow = {
+            "1": {"class_type": "LoadImage", "inputs": {"image": "mask.png", "upload": "image"}},
+            "2": {"class_type": "KSampler", "inputs": {"seed": 1, "model": ["4", 0]}},
+        }
+
+        rewritten = input_cache.rewrite_workflow(workflow, {"mask.png": "rpcache_abc.png"})
+
+        self.assertEqual(rewritten["1"]["inputs"]["image"], "rpcache_abc.png")
+        self.assertEqual(rewritten["2"], workflow["2"])
+        self.assertEqual(workflow["1"]["inputs"]["image"], "mask.png")
+
+    def test_rewrite_workflow_only_touches_image_inputs(self):
+        workflow = {
+            "1": {"class_type": "LoadImageMask", "inputs": {"image": "mask.png [input]", "channel": "alpha"}},
+            "2": {"class_type": "SaveImage", "inputs": {"filename_prefix": "mask.png", "images": ["1", 0]}},
+            "3": {"class_type": "CustomLoader", "inputs": {"picture": "mask.png"}},
+        }
+        renamed = {"mask.png": "rpcache_abc.png"}
+
+        rewritten = input_cache.rewrite_workflow(workflow, renamed)
+        self.assertEqual(rewritten["1"]["inputs"]["image"], "rpcache_abc.png [input]")
+        self.assertEqual(rewritten["2"], workflow["2"])
+        self.assertEqual(rewritten["3"], workflow["3"])
+
+        rewritten = input_cache.rewrite_workflow(workflow, renamed, {("CustomLoader", "picture")})
+        self.assertEqual(rewritten["3"]["inputs"]["picture"], "rpcache_abc.png")
+
+    def test_original_name_is_kept_next_to_the_cached_file(self):
+        cache = input_cache.InputImageCache(self.input_path, max_bytes=100)
+        filename = self._store(cache, "abc", 10)
+
+        cache.link_original(filename, "sub/mask.png")
+        cache.link_original(filename, "../mask.png")
+
+        with open(os.path.join(self.input_path, "mask.png"), "rb") as f:
+            self.assertEqual(f.read(), b"x" * 10)
+        self.assertEqual(
+            sorted(os.listdir(self.input_path)),
+            sorted([filename, filename + input_cache.METADATA_SUFFIX, "mask.png"]),
+        )
+
+    def test_evicted_files_take_their_original_names_with_them(self):
+        cache = input_cache.InputImageCache(self.input_path, max_bytes=15)
+        first = self._store(cache, "a", 10)
+        cache.link_original(first, "mask.png")
+
+        second = self._store(cache, "b", 10)
+
+        self.assertEqual(os.listdir(self.input_path), [second])
+
+    def test_original_name_taken_by_another_image_is_kept(self):
+        cache = input_cache.InputImageCache(self.input_path, max_bytes=15)
+        first = self._store(cache, "a", 5)
+        cache.link_original(first, "mask.png")
+        second = self._store(cache, "b", 5)
+        cache.link_original(second, "mask.png")
+
+        self._store(cache, "c", 10)
+
+        self.assertEqual(os.stat(os.path.join(self.input_path, "mask.png")).st_size, 5)
+        self.assertIsNone(cache.lookup("a"))
+
+    def test_copies_count_towards_the_budget(self):
+        cache = input_cache.InputImageCache(self.input_path, max_bytes=100)
+        filename = self._store(cache, "a", 10)
+
+        with unittest.mock.patch("os.link", side_effect=OSError("cross-device link")):
+            cache.link_original(filename, "mask.png")
+
+        self.assertEqual(cache.total_bytes, 20)
+        restarted = input_cache.InputImageCache(self.input_path, max_bytes=100)
+        self.assertEqual(restarted.total_bytes, 20)
+
+    def test_images_of_jobs_in_flight_are_not_evicted(self):
+        cache = input_cache.InputImageCache(self.input_path, max_bytes=15)
+        filename = cache.filename_for("a", "image.png")
+        with open(os.path.join(self.input_path, filename), "wb") as f:
+            f.write(b"x" * 10)
+        cache.add("a", filename, 10, "job-1")
+
+        self._store(cache, "b", 10)
+        self.assertEqual(cache.entry("a")["filename"], filename)
+
+        cache.release("job-1")
+        self.assertIsNone(cache.lookup("a"))
+        self.assertFalse(os.path.exists(os.path.join(self.input_path, filename)))
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=b"", headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+
+class TestDownloadImage(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = input_cache.InputImageCache(
+            self.tmp.name, max_bytes=1000, prefix=input_cache.URL_CACHE_FILE_PREFIX
+        )
+        self.session = unittest.mock.Mock()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_download_streams_into_input_folder(self):
+        self.session.get.return_value = FakeResponse(200, b"image bytes", {"ETag": '"v1"'})
+
+        filename, hit, size = input_cache.download_image(
+            self.session, self.cache, "https://example.com/a.png", "a.png"
+        )
+
+        self.assertFalse(hit)
+        self.assertEqual(size, 11)
+        self.assertTrue(filename.startswith(input_cache.URL_CACHE_FILE_PREFIX))
+        with open(os.path.join(self.tmp.name, filename), "rb") as f:
+            self.assertEqual(f.read(), b"image bytes")
+        self.assertEqual(
+            sorted(os.listdir(self.tmp.name)), [filename, filename + input_cache.METADATA_SUFFIX]
+        )
+
+    def test_unchanged_image_is_revalidated_and_reused(self):
+        self.session.get.return_value = FakeResponse(200, b"image bytes", {"ETag": '"v1"'})
+        filename, _, _ = input_cache.download_image(self.session, self.cache, "https://example.com/a.png", "a.png")
+
+        self.session.get.return_value = FakeResponse(304)
+        cached, hit, size = input_cache.download_image(self.session, self.cache, "https://example.com/a.png", "a.png")
+
+        self.assertTrue(hit)
+        self.assertEqual((cached, size), (filename, 11))
+        self.assertEqual(self.session.get.call_args.kwargs["headers"], {"If-None-Match": '"v1"'})
+
+    def test_validators_survive_a_restart(self):
+        self.session.get.return_value = FakeResponse(
+            200, b"image bytes", {"ETag": '"v1"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"}
+        )
+        filename, _, _ = input_cache.download_image(self.session, self.cache, "https://example.com/a.png", "a.png")
+
+        restarted = input_cache.InputImageCache(
+            self.tmp.name, max_bytes=100, prefix=input_cache.URL_CACHE_FILE_PREFIX
+        )
+        self.session.get.return_value = FakeResponse(304)
+        cached, hit, _ = input_cache.download_image(self.session, restarted, "https://example.com/a.png", "a.png")
+
+        self.assertTrue(hit)
+        self.assertEqual(cached, filename)
+        self.assertEqual(
+            self.session.get.call_args.kwargs["headers"],
+            {"If-None-Match": '"v1"', "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT"},
+        )
+
+    def test_failed_download_leaves_no_partial_file(self):
+        self.session.get.return_value = FakeResponse(404)
+
+        with self.assertRaises(RuntimeError):
+            input_cache.download_image(self.session, self.cache, "https://example.com/a.png", "a.png")
+
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_names_cannot_leave_the_input_folder(self):
+        disabled = input_cache.InputImageCache(self.tmp.name, max_bytes=0)
+        self.session.get.return_value = FakeResponse(200, b"image bytes")
+
+        for name in ("../../comfyui/custom_nodes/x.py", "/etc/x.py", "sub/../../x.py", "..\\x.py"):
+            with self.subTest(name=name), self.assertRaises(ValueError):
+                input_cache.download_image(self.session, disabled, "https://example.com/a.png", name)
+        self.session.get.assert_not_called()
+
+        filename, _, _ = input_cache.download_image(self.session, disabled, "https://example.com/a.png", "sub/a.png")
+        self.assertEqual(filename, "a.png")
+        self.assertEqual(os.listdir(self.tmp.name), ["a.png"])
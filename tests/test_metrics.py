@@ -0,0 +1,66 @@
+import unittest
+import sys
+import os
+import urllib.request
+
+# Make sure that "src" is known and can be used to import metrics.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_renders_labelled_values(self):
+        counter = metrics.Counter("jobs_total", "Jobs.", ["result"])
+        counter.inc(result="success")
+        counter.inc(2, result="success")
+        counter.inc(result="error")
+
+        self.assertEqual(
+            counter.render(),
+            "# HELP jobs_total Jobs.\n"
+            "# TYPE jobs_total counter\n"
+            'jobs_total{result="error"} 1\n'
+            'jobs_total{result="success"} 3',
+        )
+
+    def test_histogram_renders_cumulative_buckets(self):
+        histogram = metrics.Histogram("phase_seconds", "Phases.", ["phase"], buckets=[0.1, 1])
+        histogram.observe(0.05, phase="upload")
+        histogram.observe(0.5, phase="upload")
+        histogram.observe(5, phase="upload")
+
+        lines = histogram.render().splitlines()[2:]
+
+        self.assertEqual(lines, [
+            'phase_seconds_bucket{phase="upload",le="0.1"} 1',
+            'phase_seconds_bucket{phase="upload",le="1"} 2',
+            'phase_seconds_bucket{phase="upload",le="+Inf"} 3',
+            'phase_seconds_sum{phase="upload"} 5.55',
+            'phase_seconds_count{phase="upload"} 3',
+        ])
+
+    def test_wrong_labels_are_rejected(self):
+        counter = metrics.Counter("jobs_total", "Jobs.", ["result"])
+        with self.assertRaises(ValueError):
+            counter.inc(status="error")
+
+    def test_function_metrics_are_read_at_scrape_time(self):
+        gauge = metrics.Gauge("queue_remaining", "Queue.")
+        queue = [3]
+        gauge.set_function(lambda: queue[0])
+        queue[0] = 5
+
+        self.assertEqual(gauge.render().splitlines()[-1], "queue_remaining 5")
+
+    def test_http_server_serves_registry(self):
+        server = metrics.start_http_server(0, host="127.0.0.1")
+        try:
+            port = server.server_address[1]
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                body = response.read().decode("utf-8")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertIn("# TYPE comfy_worker_jobs_total counter", body)
+        self.assertIn("# TYPE comfy_worker_phase_seconds histogram", body)
@@ -0,0 +1,88 @@
+import unittest
+import sys
+import os
+import json
+import tempfile
+
+# Make sure that "src" is known and can be used to import model_cache.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import model_cache
+
+# Local folder for test resources
+RUNPOD_WORKER_COMFY_TEST_RESOURCES_WORKFLOWS = "./test_resources/workflows"
+
+
+def write_model(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"m" * size)
+
+
+class TestModelCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.folder.name, "volume")
+        self.cache_path = os.path.join(self.folder.name, "cache")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_model_references_of_loader_nodes(self):
+        with open(os.path.join(RUNPOD_WORKER_COMFY_TEST_RESOURCES_WORKFLOWS, "workflow_flux1_dev.json")) as f:
+            workflow = json.load(f)["input"]["workflow"]
+        workflow["99"] = {"class_type": "LoraLoader|pysssss", "inputs": {"lora_name": "style.safetensors"}}
+        workflow["100"] = {"class_type": "VAELoader", "inputs": {"vae_name": ["99", 0]}}
+
+        self.assertEqual(
+            sorted(model_cache.model_references(workflow)),
+            [
+                ("clip", "clip_l.safetensors"),
+                ("clip", "t5xxl_fp8_e4m3fn.safetensors"),
+                ("loras", "style.safetensors"),
+                ("unet", "flux1-dev.safetensors"),
+                ("vae", "ae.safetensors"),
+            ],
+        )
+
+    def test_prepare_copies_misses_and_hits_afterwards(self):
+        write_model(os.path.join(self.source, "checkpoints", "sd.safetensors"), 10)
+        write_model(os.path.join(self.source, "diffusion_models", "flux.safetensors"), 20)
+        cache = model_cache.ModelCache(self.cache_path, [self.source], max_bytes=100)
+        workflow = {
+            "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd.safetensors"}},
+            "12": {"class_type": "UNETLoader", "inputs": {"unet_name": "flux.safetensors"}},
+            "13": {"class_type": "VAELoader", "inputs": {"vae_name": "missing.safetensors"}},
+        }
+
+        self.assertEqual(cache.prepare(workflow), {"hits": 0, "misses": 3})
+        cache.wait()
+
+        self.assertTrue(os.path.isfile(os.path.join(self.cache_path, "checkpoints", "sd.safetensors")))
+        self.assertTrue(os.path.isfile(os.path.join(self.cache_path, "unet", "flux.safetensors")))
+        self.assertEqual(cache.prepare(workflow), {"hits": 2, "misses": 1})
+        stats = cache.stats()
+        self.assertEqual((stats["copies"], stats["copy_bytes"], stats["total_bytes"]), (2, 30, 30))
+        self.assertTrue(cache.holds("checkpoints", "sd.safetensors"))
+        self.assertFalse(cache.holds("vae", "missing.safetensors"))
+
+    def test_least_recently_used_models_are_evicted(self):
+        for name in ["a", "b", "c"]:
+            write_model(os.path.join(self.source, "loras", f"{name}.safetensors"), 40)
+        cache = model_cache.ModelCache(self.cache_path, [self.source], max_bytes=100)
+
+        for name in ["a", "b", "a", "c"]:
+            cache.prepare({"1": {"class_type": "LoraLoader", "inputs": {"lora_name": f"{name}.safetensors"}}})
+            cache.wait()
+
+        self.assertEqual(sorted(os.listdir(os.path.join(self.cache_path, "loras"))), ["a.safetensors", "c.safetensors"])
+        self.assertEqual(cache.total_bytes, 80)
+
+    def test_cache_is_rebuilt_from_disk(self):
+        write_model(os.path.join(self.cache_path, "vae", "ae.safetensors"), 10)
+
+        cache = model_cache.ModelCache(self.cache_path, [self.source], max_bytes=100)
+
+        self.assertEqual(
+            cache.prepare({"1": {"class_type": "VAELoader", "inputs": {"vae_name": "ae.safetensors"}}}),
+            {"hits": 1, "misses": 0},
+        )
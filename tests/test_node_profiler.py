@@ -0,0 +1,40 @@
+import unittest
+import sys
+import os
+
+# Make sure that "src" is known and can be used to import node_profiler.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import node_profiler
+
+
+class TestNodeProfiler(unittest.TestCase):
+    def test_timings_are_aggregated_by_class_type(self):
+        profiler = node_profiler.NodeProfiler()
+        for ms in [900, 1100, 1000]:
+            profiler.record([
+                {"node": "4", "class_type": "CheckpointLoaderSimple", "ms": 0, "cached": True},
+                {"node": "3", "class_type": "KSampler", "ms": ms, "cached": False},
+                {"node": "8", "class_type": "VAEDecode", "ms": 40, "cached": False},
+            ])
+
+        summary = profiler.summary()
+
+        self.assertEqual(list(summary), ["KSampler", "VAEDecode", "CheckpointLoaderSimple"])
+        self.assertEqual(summary["KSampler"]["count"], 3)
+        self.assertEqual(summary["KSampler"]["mean_ms"], 1000)
+        self.assertEqual(summary["KSampler"]["p50_ms"], 1000)
+        self.assertEqual(summary["KSampler"]["max_ms"], 1100)
+        self.assertEqual(summary["KSampler"]["buckets"]["1000"], 2)
+        self.assertEqual(summary["KSampler"]["buckets"]["2500"], 1)
+        self.assertEqual(summary["CheckpointLoaderSimple"]["cached"], 3)
+        self.assertEqual(summary["CheckpointLoaderSimple"]["count"], 0)
+
+    def test_rolling_window_limits_percentile_samples(self):
+        profiler = node_profiler.NodeProfiler(window=2)
+        for ms in [5000, 10, 20]:
+            profiler.record([{"node": "3", "class_type": "KSampler", "ms": ms, "cached": False}])
+
+        summary = profiler.summary()["KSampler"]
+
+        self.assertEqual(summary["p95_ms"], 20)
+        self.assertEqual(summary["max_ms"], 5000)
@@ -0,0 +1,155 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+import os
+import json
+import tempfile
+
+# Make sure that "src" is known and can be used to import object_info.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import object_info
+
+NODES = {
+    "CheckpointLoaderSimple": {
+        "input": {"required": {"ckpt_name": [["sd_xl_turbo_1.0_fp16.safetensors"]]}},
+        "output": ["MODEL", "CLIP", "VAE"],
+    },
+    "CLIPTextEncode": {
+        "input": {"required": {"text": ["STRING", {"multiline": True}], "clip": ["CLIP"]}},
+        "output": ["CONDITIONING"],
+    },
+    "KSampler": {
+        "input": {
+            "required": {
+                "model": ["MODEL"],
+                "seed": ["INT", {"default": 0}],
+                "cfg": ["FLOAT", {"default": 8.0}],
+                "positive": ["CONDITIONING"],
+            },
+            "optional": {"add_noise": ["BOOLEAN"]},
+        },
+        "output": ["LATENT"],
+    },
+}
+
+
+def workflow():
+    return {
+        "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "new_model.safetensors"}},
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat", "clip": ["4", 1]}},
+        "3": {"class_type": "KSampler", "inputs": {"model": ["4", 0], "seed": 1, "cfg": 2, "positive": ["6", 0]}},
+    }
+
+
+class TestObjectInfoSchema(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.folder.name, "object_info.json")
+        self.custom_nodes = os.path.join(self.folder.name, "custom_nodes")
+        os.makedirs(os.path.join(self.custom_nodes, "some_node"))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def schema(self):
+        return object_info.ObjectInfoSchema("http://127.0.0.1:8188", self.cache_path, self.custom_nodes)
+
+    def loaded_schema(self):
+        schema = self.schema()
+        schema.nodes = NODES
+        return schema
+
+    def test_valid_workflow(self):
+        self.assertIsNone(self.loaded_schema().validate(workflow()))
+
+    def test_nothing_is_validated_before_loading(self):
+        self.assertIsNone(self.schema().validate({"1": {"class_type": "Unknown"}}))
+
+    def test_problems_are_reported(self):
+        schema = self.loaded_schema()
+        cases = [
+            ("3", {"class_type": "Unknown", "inputs": {}}, "unknown class_type 'Unknown'"),
+            ("3", {"class_type": "KSampler", "inputs": {"model": ["4", 0], "seed": 1, "cfg": 2}}, "missing the required input 'positive'"),
+            ("6", {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat", "clip": ["5", 1]}}, "missing node 5"),
+            ("6", {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat", "clip": ["4", 3]}}, "missing output 3"),
+            ("6", {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat", "clip": ["4", 0]}}, "of type MODEL"),
+            ("3", {"class_type": "KSampler", "inputs": {"model": ["4", 0], "seed": "4.2", "cfg": 2, "positive": ["6", 0]}}, "input 'seed' of type INT"),
+            ("3", {"class_type": "KSampler", "inputs": {"model": ["4", 0], "seed": None, "cfg": 2, "positive": ["6", 0]}}, "input 'seed'"),
+            ("3", {"class_type": "KSampler", "inputs": {"model": ["4", 0], "seed": 1, "cfg": "fast", "positive": ["6", 0]}}, "input 'cfg' of type FLOAT"),
+        ]
+        for node_id, node, problem in cases:
+            broken = workflow()
+            broken[node_id] = node
+            with self.subTest(problem=problem):
+                self.assertIn(problem, schema.validate(broken))
+
+    def test_only_the_given_nodes_are_validated(self):
+        schema = self.loaded_schema()
+        broken = workflow()
+        broken["6"] = {"class_type": "Unknown", "inputs": {}}
+        broken["3"]["inputs"]["seed"] = "4.2"
+
+        self.assertIn("input 'seed'", schema.validate(broken, ["3"]))
+        self.assertIsNone(schema.validate(broken, ["4"]))
+
+    def test_image_inputs(self):
+        schema = self.schema()
+        self.assertIsNone(schema.image_inputs())
+
+        schema.nodes = {
+            **NODES,
+            "LoadImage": {"input": {"required": {"image": [["a.png"], {"image_upload": True}]}}, "output": ["IMAGE", "MASK"]},
+        }
+        self.assertEqual(schema.image_inputs(), {("LoadImage", "image")})
+
+    def test_values_comfyui_converts_are_accepted(self):
+        schema = self.loaded_schema()
+        valid = workflow()
+        valid["6"]["inputs"]["text"] = 123
+        valid["3"]["inputs"].update({"seed": "42", "cfg": "7.5", "add_noise": 1})
+        self.assertIsNone(schema.validate(valid))
+
+        valid["3"]["inputs"]["seed"] = 42.0
+        self.assertIsNone(schema.validate(valid))
+
+    @patch("object_info.requests.get")
+    def test_definitions_are_cached_until_custom_nodes_change(self, mock_get):
+        mock_get.return_value = MagicMock(status_code=200, json=MagicMock(return_value=NODES))
+
+        self.assertTrue(self.schema().load())
+        self.assertTrue(self.schema().load())
+        self.assertEqual(mock_get.call_count, 1)
+        with open(self.cache_path) as f:
+            self.assertEqual(json.load(f)["nodes"], NODES)
+
+        os.makedirs(os.path.join(self.custom_nodes, "another_node"))
+        schema = self.schema()
+        self.assertTrue(schema.load())
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(schema.nodes, NODES)
+
+    @patch("object_info.requests.get")
+    def test_failed_fetch_disables_validation(self, mock_get):
+        mock_get.side_effect = object_info.requests.ConnectionError()
+        schema = self.schema()
+
+        self.assertFalse(schema.load())
+        self.assertIsNone(schema.validate({"1": {"class_type": "Unknown"}}))
+
+    @patch("object_info.requests.get")
+    def test_background_retries_back_off(self, mock_get):
+        mock_get.side_effect = object_info.requests.ConnectionError()
+        schema = self.schema()
+        self.assertFalse(schema.load())
+
+        # Within the backoff no retry is started
+        schema.load_in_background()
+        self.assertIsNone(schema.loader)
+        self.assertEqual(mock_get.call_count, 1)
+
+        mock_get.side_effect = None
+        mock_get.return_value = MagicMock(status_code=200, json=MagicMock(return_value=NODES))
+        schema.next_attempt = 0
+        schema.load_in_background()
+        schema.loader.join()
+        self.assertEqual(schema.nodes, NODES)
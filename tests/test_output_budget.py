@@ -0,0 +1,21 @@
+import unittest
+import sys
+import os
+
+# Make sure that "src" is known and can be used to import output_budget.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import output_budget
+
+
+class TestInlineBudget(unittest.TestCase):
+    def test_base64_size(self):
+        self.assertEqual([output_budget.base64_size(size) for size in [0, 1, 3, 4]], [0, 4, 4, 8])
+
+    def test_budget_stays_exhausted(self):
+        budget = output_budget.InlineBudget(12)
+
+        self.assertTrue(budget.reserve(6))
+        self.assertFalse(budget.reserve(6))
+        # Would still fit, but the images after a spilled one are spilled as well
+        self.assertFalse(budget.reserve(3))
+        self.assertEqual(budget.used, 8)
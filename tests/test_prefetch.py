@@ -0,0 +1,109 @@
+import unittest
+from unittest.mock import Mock, patch
+import sys
+import os
+import tempfile
+
+# Make sure that "src" is known and can be used to import prefetch.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import prefetch
+
+
+def write_file(path, data=b"model"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+class TestModelPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.root = self.folder.name
+        self.models_dir = os.path.join(self.root, "models")
+        self.config = os.path.join(self.root, "extra_model_paths.yaml")
+        with open(self.config, "w") as f:
+            f.write(
+                "cache:\n"
+                f"  base_path: {self.root}/cache\n"
+                "  is_default: true\n"
+                "  checkpoints: checkpoints/\n"
+                "volume:\n"
+                f"  base_path: {self.root}/volume\n"
+                "  loras: |\n"
+                "    loras/\n"
+                "    more_loras/\n"
+            )
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def prefetcher(self, max_bytes=1024):
+        return prefetch.ModelPrefetcher(self.models_dir, [self.config, os.path.join(self.root, "missing.yaml")], max_bytes)
+
+    def test_resolve_follows_the_search_order_of_comfyui(self):
+        write_file(os.path.join(self.models_dir, "checkpoints", "sd.safetensors"))
+        write_file(os.path.join(self.root, "volume", "more_loras", "style.safetensors"))
+        write_file(os.path.join(self.models_dir, "diffusion_models", "flux.safetensors"))
+        prefetcher = self.prefetcher()
+
+        self.assertEqual(
+            prefetcher.resolve("checkpoints", "sd.safetensors"),
+            os.path.join(self.models_dir, "checkpoints", "sd.safetensors"),
+        )
+        write_file(os.path.join(self.root, "cache", "checkpoints", "sd.safetensors"))
+        self.assertEqual(
+            prefetcher.resolve("checkpoints", "sd.safetensors"),
+            os.path.join(self.root, "cache", "checkpoints", "sd.safetensors"),
+        )
+        self.assertEqual(
+            prefetcher.resolve("loras", "style.safetensors"),
+            os.path.join(self.root, "volume", "more_loras", "style.safetensors"),
+        )
+        self.assertEqual(
+            prefetcher.resolve("unet", "flux.safetensors"),
+            os.path.join(self.models_dir, "diffusion_models", "flux.safetensors"),
+        )
+        self.assertIsNone(prefetcher.resolve("vae", "ae.safetensors"))
+
+    def test_prefetch_asks_the_kernel_to_read_models_within_the_budget(self):
+        write_file(os.path.join(self.models_dir, "checkpoints", "sd.safetensors"), b"m" * 100)
+        write_file(os.path.join(self.models_dir, "vae", "ae.safetensors"), b"v" * 2000)
+        prefetcher = self.prefetcher()
+        workflow = {
+            "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd.safetensors"}},
+            "5": {"class_type": "VAELoader", "inputs": {"vae_name": "ae.safetensors"}},
+        }
+
+        with patch.object(prefetch, "available_memory", return_value=10**9), \
+                patch("os.posix_fadvise", create=True) as fadvise:
+            scheduled = prefetcher.prefetch(workflow)
+            prefetcher.wait()
+            # The VAE is larger than the budget
+            self.assertEqual(scheduled, [os.path.join(self.models_dir, "checkpoints", "sd.safetensors")])
+            self.assertEqual(fadvise.call_args.args[1:], (0, 0, os.POSIX_FADV_WILLNEED))
+            # Resident pages are not read again by the kernel, so there is no need to remember the model
+            self.assertEqual(prefetcher.prefetch(workflow), scheduled)
+            prefetcher.wait()
+
+    def test_prefetch_skips_models_the_model_cache_holds(self):
+        write_file(os.path.join(self.models_dir, "checkpoints", "sd.safetensors"), b"m" * 100)
+        model_cache = Mock()
+        model_cache.holds.return_value = True
+        prefetcher = prefetch.ModelPrefetcher(self.models_dir, [self.config], 1024, model_cache=model_cache)
+
+        with patch.object(prefetch, "available_memory", return_value=10**9):
+            self.assertEqual(
+                prefetcher.prefetch({"4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd.safetensors"}}}),
+                [],
+            )
+        model_cache.holds.assert_called_once_with("checkpoints", "sd.safetensors")
+
+    def test_prefetch_is_capped_at_the_available_memory(self):
+        write_file(os.path.join(self.models_dir, "checkpoints", "sd.safetensors"), b"m" * 100)
+        prefetcher = self.prefetcher()
+
+        with patch.object(prefetch, "available_memory", return_value=50):
+            self.assertEqual(
+                prefetcher.prefetch({"4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "sd.safetensors"}}}),
+                [],
+            )
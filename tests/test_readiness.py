@@ -0,0 +1,50 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import sys
+import os
+import threading
+
+# Make sure that "src" is known and can be used to import readiness.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import readiness
+
+
+class TestComfyReadiness(unittest.TestCase):
+    @patch("readiness.time.sleep")
+    @patch("readiness.requests.get")
+    def test_wait_until_ready_backs_off_exponentially(self, mock_get, mock_sleep):
+        mock_get.side_effect = [
+            readiness.requests.ConnectionError(),
+            readiness.requests.ConnectionError(),
+            readiness.requests.ConnectionError(),
+            MagicMock(status_code=200),
+        ]
+        state = readiness.ComfyReadiness("http://127.0.0.1:8188")
+
+        self.assertTrue(state.wait_until_ready(timeout=60, initial_delay=0.05))
+
+        self.assertEqual([c.args[0] for c in mock_sleep.call_args_list], [0.05, 0.1, 0.2])
+        self.assertTrue(state.is_ready())
+
+    @patch("readiness.requests.get")
+    def test_wait_until_ready_gives_up(self, mock_get):
+        mock_get.side_effect = readiness.requests.ConnectionError()
+        state = readiness.ComfyReadiness("http://127.0.0.1:8188")
+
+        self.assertFalse(state.wait_until_ready(timeout=0.01, initial_delay=0.001))
+        self.assertTrue(state.checked)
+        self.assertFalse(state.is_ready())
+
+    @patch("readiness.requests.get")
+    def test_monitor_trusts_connected_event_stream(self, mock_get):
+        stream = MagicMock()
+        stream.connected = threading.Event()
+        stream.connected.set()
+        state = readiness.ComfyReadiness("http://127.0.0.1:8188", event_stream=stream, refresh_interval=0.001)
+
+        state.start_monitor()
+        state.monitor.join(0.05)
+        state.stop_monitor()
+
+        self.assertTrue(state.is_ready())
+        mock_get.assert_not_called()
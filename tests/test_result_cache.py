@@ -0,0 +1,75 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+import tempfile
+
+# Make sure that "src" is known and can be used to import result_cache.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import result_cache
+
+
+WORKFLOW = {
+    "3": {"class_type": "KSampler", "inputs": {"seed": 42, "steps": 1}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "a cat"}},
+}
+
+
+class TestWorkflowKey(unittest.TestCase):
+    def test_key_ignores_key_order(self):
+        reordered = {"6": WORKFLOW["6"], "3": {"inputs": {"steps": 1, "seed": 42}, "class_type": "KSampler"}}
+        self.assertEqual(result_cache.workflow_key(WORKFLOW, None), result_cache.workflow_key(reordered, None))
+
+    def test_key_depends_on_inputs(self):
+        changed = {**WORKFLOW, "3": {"class_type": "KSampler", "inputs": {"seed": 43, "steps": 1}}}
+        images = [{"name": "a.png", "image": "YQ=="}]
+        other_images = [{"name": "a.png", "image": "Yg=="}]
+
+        keys = {
+            result_cache.workflow_key(WORKFLOW, None),
+            result_cache.workflow_key(changed, None),
+            result_cache.workflow_key(WORKFLOW, images),
+            result_cache.workflow_key(WORKFLOW, other_images),
+        }
+
+        self.assertEqual(len(keys), 4)
+
+    def test_excluded_nodes_and_url_images_are_not_cacheable(self):
+        self.assertTrue(result_cache.is_cacheable(WORKFLOW, None, set()))
+        self.assertFalse(result_cache.is_cacheable(WORKFLOW, None, {"KSampler"}))
+        self.assertFalse(result_cache.is_cacheable(WORKFLOW, [{"name": "a.png", "url": "https://example.com/a.png"}], set()))
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_put_and_get_survive_restart(self):
+        cache = result_cache.ResultCache(self.tmp.name, max_bytes=10000, ttl=60)
+        cache.put("key", {"status": "success", "images": ["aW1n"]})
+
+        restarted = result_cache.ResultCache(self.tmp.name, max_bytes=10000, ttl=60)
+
+        self.assertEqual(restarted.get("key"), {"status": "success", "images": ["aW1n"]})
+        self.assertIsNone(restarted.get("other"))
+        self.assertEqual((restarted.hits, restarted.misses), (1, 1))
+
+    def test_expired_results_are_dropped(self):
+        cache = result_cache.ResultCache(self.tmp.name, max_bytes=10000, ttl=60)
+        cache.put("key", {"status": "success"})
+
+        with patch("result_cache.time.time", return_value=cache.entries["key"]["created"] + 61):
+            self.assertIsNone(cache.get("key"))
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_least_recently_used_results_are_evicted(self):
+        cache = result_cache.ResultCache(self.tmp.name, max_bytes=80, ttl=60)
+        cache.put("a", {"images": ["x" * 20]})
+        cache.put("b", {"images": ["y" * 20]})
+        cache.get("a")
+        cache.put("c", {"images": ["z" * 20]})
+
+        self.assertEqual(list(cache.entries), ["a", "c"])
@@ -4,6 +4,7 @@ import sys
 import os
 import json
 import base64
+import tempfile
 
 # Make sure that "src" is known and can be used to import rp_handler.py
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
@@ -13,12 +14,20 @@ from src import rp_handler
 RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES = "./test_resources/images"
 
 
+def fake_comfy(outputs, websocket_images=None):
+    """A stand-in for a finished ComfyClient holding the given outputs."""
+    comfy = MagicMock()
+    comfy.outputs = list(outputs.values())
+    comfy.websocket_images = websocket_images or {}
+    return comfy
+
+
 class TestRunpodWorkerComfy(unittest.TestCase):
     def test_valid_input_with_workflow_only(self):
         input_data = {"workflow": {"key": "value"}}
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNone(error)
-        self.assertEqual(validated_data, {"workflow": {"key": "value"}, "images": None})
+        self.assertEqual(validated_data, {"workflow": {"key": "value"}, "images": None, "callback": None, "status_callback": None, "trace": False, "template_id": None, "template_key": None, "output_format": None})
 
     def test_valid_input_with_workflow_and_images(self):
         input_data = {
@@ -27,7 +36,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         }
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNone(error)
-        self.assertEqual(validated_data, input_data)
+        self.assertEqual(validated_data, {**input_data, "callback": None, "status_callback": None, "trace": False, "template_id": None, "template_key": None, "output_format": None})
 
     def test_input_missing_workflow(self):
         input_data = {"images": [{"name": "image1.png", "image": "base64string"}]}
@@ -43,9 +52,18 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNotNone(error)
         self.assertEqual(
-            error, "'images' must be a list of objects with 'name' and 'image' keys"
+            error, "'images' must be a list of objects with 'name' and 'image' or 'url' keys"
         )
 
+    def test_valid_input_with_image_url(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [{"name": "image1.png", "url": "https://example.com/image1.png"}],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNone(error)
+        self.assertEqual(validated_data["images"], input_data["images"])
+
     def test_invalid_json_string_input(self):
         input_data = "invalid json"
         validated_data, error = rp_handler.validate_input(input_data)
@@ -56,7 +74,43 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         input_data = '{"workflow": {"key": "value"}}'
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNone(error)
-        self.assertEqual(validated_data, {"workflow": {"key": "value"}, "images": None})
+        self.assertEqual(validated_data, {"workflow": {"key": "value"}, "images": None, "callback": None, "status_callback": None, "trace": False, "template_id": None, "template_key": None, "output_format": None})
+
+    def test_valid_input_with_template(self):
+        registry = rp_handler.templates.TemplateRegistry(None)
+        registry.templates["sdxl"] = rp_handler.templates.Template(
+            "sdxl", {"3": {"class_type": "KSampler", "inputs": {"seed": 1}}}
+        )
+        with patch.object(rp_handler, "TEMPLATES", registry):
+            validated_data, error = rp_handler.validate_input({"template_id": "sdxl", "overrides": {"3": {"seed": 2}}})
+            _, unknown_error = rp_handler.validate_input({"template_id": "sd3"})
+
+        self.assertIsNone(error)
+        self.assertEqual(validated_data["workflow"], {"3": {"class_type": "KSampler", "inputs": {"seed": 2}}})
+        self.assertEqual(validated_data["template_id"], "sdxl")
+        self.assertEqual(validated_data["template_key"], registry.get("sdxl").key({"3": {"seed": 2}}))
+        self.assertEqual(unknown_error, "Unknown template 'sd3'")
+
+    def test_template_input_only_validates_the_overridden_nodes(self):
+        registry = rp_handler.templates.TemplateRegistry(None)
+        registry.templates["sdxl"] = rp_handler.templates.Template(
+            "sdxl", {"3": {"class_type": "KSampler", "inputs": {"seed": 1}}, "4": {"class_type": "Unknown"}}
+        )
+        nodes = {"KSampler": {"input": {"required": {"seed": ["INT"]}}, "output": ["LATENT"]}}
+        with patch.object(rp_handler, "TEMPLATES", registry), patch.object(rp_handler.OBJECT_INFO, "nodes", nodes):
+            registry.templates["sdxl"].checked_nodes = nodes
+            _, error = rp_handler.validate_input({"template_id": "sdxl", "overrides": {"3": {"seed": 2}}})
+            _, override_error = rp_handler.validate_input({"template_id": "sdxl", "overrides": {3: {"seed": "x"}}})
+
+        self.assertIsNone(error)
+        self.assertEqual(override_error, "Invalid workflow: Node 3 (KSampler) has an invalid value for input 'seed' of type INT: 'x'")
+
+    def test_input_with_invalid_workflow(self):
+        with patch.object(rp_handler.OBJECT_INFO, "nodes", {"KSampler": {"input": {}, "output": ["LATENT"]}}):
+            validated_data, error = rp_handler.validate_input({"workflow": {"3": {"class_type": "Unknown"}}})
+
+        self.assertIsNone(validated_data)
+        self.assertEqual(error, "Invalid workflow: Node 3 has an unknown class_type 'Unknown'")
 
     def test_empty_input(self):
         input_data = None
@@ -64,21 +118,6 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIsNotNone(error)
         self.assertEqual(error, "Please provide input")
 
-    @patch("rp_handler.requests.get")
-    def test_check_server_server_up(self, mock_requests):
-        mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_requests.return_value = mock_response
-
-        result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
-        self.assertTrue(result)
-
-    @patch("rp_handler.requests.get")
-    def test_check_server_server_down(self, mock_requests):
-        mock_requests.get.side_effect = rp_handler.requests.RequestException()
-        result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
-        self.assertFalse(result)
-
     @patch("rp_handler.urllib.request.urlopen")
     def test_queue_prompt(self, mock_urlopen):
         mock_response = MagicMock()
@@ -136,7 +175,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         }
         job_id = "123"
 
-        result = rp_handler.process_output_images(outputs, job_id)
+        result = rp_handler.process_output_images(fake_comfy(outputs), job_id)
 
         self.assertEqual(result["status"], "success")
 
@@ -161,11 +200,11 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         job_id = "123"
 
         # Call the function under test
-        result = rp_handler.process_output_images(outputs, job_id)
+        result = rp_handler.process_output_images(fake_comfy(outputs), job_id)
 
         # Assertions
         self.assertEqual(result["status"], "success")
-        self.assertEqual(result["message"], "http://example.com/uploaded/image.png")
+        self.assertEqual(result["images"][0]["url"], "http://example.com/uploaded/image.png")
         mock_upload_image.assert_called_once_with(
             job_id, "./test_resources/images/test/ComfyUI_00001_.png"
         )
@@ -195,13 +234,13 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         }
         job_id = "123"
 
-        result = rp_handler.process_output_images(outputs, job_id)
+        result = rp_handler.process_output_images(fake_comfy(outputs), job_id)
 
         # Check if the image was saved to the 'simulated_uploaded' directory
-        self.assertIn("simulated_uploaded", result["message"])
+        self.assertIn("simulated_uploaded", result["images"][0]["url"])
         self.assertEqual(result["status"], "success")
 
-    @patch("rp_handler.requests.post")
+    @patch("rp_handler.requests.Session.post")
     def test_upload_images_successful(self, mock_post):
         mock_response = unittest.mock.Mock()
         mock_response.status_code = 200
@@ -214,10 +253,10 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         responses = rp_handler.upload_images(images)
 
-        self.assertEqual(len(responses), 3)
+        self.assertEqual(len(responses), 6)
         self.assertEqual(responses["status"], "success")
 
-    @patch("rp_handler.requests.post")
+    @patch("rp_handler.requests.Session.post")
     def test_upload_images_failed(self, mock_post):
         mock_response = unittest.mock.Mock()
         mock_response.status_code = 400
@@ -230,5 +269,252 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         responses = rp_handler.upload_images(images)
 
-        self.assertEqual(len(responses), 3)
+        self.assertEqual(len(responses), 6)
         self.assertEqual(responses["status"], "error")
+
+    @patch.object(rp_handler, "COMFY_MAX_CONCURRENCY", 3)
+    def test_concurrency_modifier_returns_configured_value(self):
+        self.assertEqual(rp_handler.concurrency_modifier(1), 3)
+
+    def test_async_handler_runs_handler(self):
+        with patch.object(rp_handler, "handler", return_value={"status": "success"}) as mock_handler:
+            result = rp_handler.asyncio.run(rp_handler.async_handler({"id": "123"}))
+
+        self.assertEqual(result, {"status": "success"})
+        mock_handler.assert_called_once_with({"id": "123"})
+
+    def test_status_error_result_uses_execution_error(self):
+        status = {
+            "status": "error",
+            "data": {"error": {"message": "model not found", "details": {"node_id": "4"}}},
+        }
+        result = rp_handler.status_error_result(status)
+        self.assertEqual(
+            result,
+            {"status": "error", "message": "model not found", "details": {"node_id": "4"}},
+        )
+
+    def test_status_error_result_timed_out(self):
+        result = rp_handler.status_error_result({"status": "timed out", "data": None})
+        self.assertEqual(result["status"], "error")
+        self.assertEqual(result["message"], "Timed out waiting for ComfyUI")
+
+    @patch("rp_handler.rp_upload.upload_image")
+    @patch.dict(
+        os.environ,
+        {
+            "COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES,
+            "BUCKET_ENDPOINT_URL": "http://example.com",
+        },
+    )
+    def test_process_output_images_keeps_order(self, mock_upload_image):
+        mock_upload_image.side_effect = lambda job_id, path: f"http://example.com/{os.path.basename(os.path.dirname(path))}"
+
+        outputs = {
+            str(i): {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": subfolder, "type": "output"}]}
+            for i, subfolder in enumerate(["", "test", "", "test"])
+        }
+        outputs["temp"] = {"images": [{"filename": "preview.png", "subfolder": "", "type": "temp"}]}
+
+        result = rp_handler.process_output_images(fake_comfy(outputs), "123")
+
+        self.assertEqual(
+            [image["url"] for image in result["images"]],
+            ["http://example.com/images", "http://example.com/test", "http://example.com/images", "http://example.com/test"],
+        )
+        self.assertIn("output_time_ms", result)
+
+    @patch.dict(os.environ, {"COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES})
+    def test_websocket_images_are_encoded_from_memory(self):
+        comfy = fake_comfy({}, {"12": [{"format": "png", "image": b"frame"}]})
+
+        result = rp_handler.process_output_images(comfy, "123")
+
+        self.assertEqual(result["images"], [base64.b64encode(b"frame").decode("utf-8")])
+        comfy.get_image.assert_not_called()
+
+    @patch.dict(
+        os.environ,
+        {
+            "COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES,
+            "BUCKET_ENDPOINT_URL": "http://example.com",
+        },
+    )
+    def test_images_beyond_the_inline_budget_are_spilled_to_the_bucket(self):
+        frames = [{"format": "png", "image": b"x" * 30} for _ in range(2)] + [{"format": "png", "image": b"y" * 30}]
+
+        simulated = tempfile.TemporaryDirectory()
+        self.addCleanup(simulated.cleanup)
+
+        with patch.object(rp_handler, "OUTPUT_INLINE_MAX_BYTES", 100), \
+                patch.object(rp_handler, "COMFY_OUTPUT_WORKERS", 1), \
+                patch.object(rp_handler, "SIMULATED_UPLOAD_PATH", simulated.name):
+            result = rp_handler.process_output_images(fake_comfy({}, {"12": frames}), "123")
+
+        inline = base64.b64encode(b"x" * 30).decode("utf-8")
+        self.assertEqual(result["images"][:2], [inline, inline])
+        self.assertEqual(result["spilled_images"], 1)
+        # Without bucket credentials the image is stored in the simulated upload folder
+        url = result["images"][2]["url"]
+        self.assertTrue(url.startswith(simulated.name + "/") and url.endswith(".png"))
+        with open(url, "rb") as f:
+            self.assertEqual(f.read(), b"y" * 30)
+
+    @patch.dict(
+        os.environ,
+        {
+            "COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES,
+            "BUCKET_ENDPOINT_URL": "http://example.com",
+        },
+    )
+    def test_uploader_streams_missing_images_from_memory(self):
+        outputs = {"9": {"images": [{"filename": "missing.png", "subfolder": "", "type": "output"}]}}
+        comfy = fake_comfy(outputs)
+        comfy.get_image.return_value = b"image"
+        uploader = MagicMock(configured=True)
+        uploader.upload_image.return_value = ("http://example.com/123/abc.png", True)
+
+        with patch.object(rp_handler, "UPLOADER", uploader):
+            result = rp_handler.process_output_images(comfy, "123")
+
+        self.assertEqual(result["images"][0]["url"], "http://example.com/123/abc.png")
+        uploader.upload_image.assert_called_once_with("123", "missing.png", data=b"image")
+        self.assertFalse(os.path.exists(os.path.join(RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES, "missing.png")))
+
+    @patch.dict(
+        os.environ,
+        {
+            "COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES,
+            "BUCKET_ENDPOINT_URL": "http://example.com",
+        },
+    )
+    def test_process_output_images_counts_deduplicated_images(self):
+        outputs = {
+            "9": {"images": [{"filename": "first.png", "subfolder": "", "type": "output"}]},
+            "10": {"images": [{"filename": "second.png", "subfolder": "", "type": "output"}]},
+        }
+        comfy = fake_comfy(outputs)
+        comfy.get_image.return_value = b"image"
+        uploader = MagicMock(configured=True)
+        uploader.upload_image.side_effect = [("http://example.com/a.png", True), ("http://example.com/a.png", False)]
+
+        with patch.object(rp_handler, "COMFY_OUTPUT_WORKERS", 1), patch.object(rp_handler, "UPLOADER", uploader):
+            result = rp_handler.process_output_images(comfy, "123")
+
+        self.assertNotIn("deduplicated", result["images"][0])
+        self.assertTrue(result["images"][1]["deduplicated"])
+        self.assertEqual(result["deduplicated_images"], 1)
+
+    @patch.dict(os.environ, {"COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES})
+    def test_process_output_images_transcodes_to_the_output_format(self):
+        outputs = {"9": {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}]}}
+        output_format = rp_handler.transcode.OutputFormat("webp")
+
+        with patch.object(rp_handler, "TRANSCODER", rp_handler.transcode.Transcoder(0)):
+            result = rp_handler.process_output_images(fake_comfy(outputs), "123", output_format=output_format)
+
+        self.assertTrue(base64.b64decode(result["images"][0]).startswith(b"RIFF"))
+        self.assertEqual(output_format.summary()["images"], 1)
+
+    @patch("rp_handler.requests.Session.post")
+    def test_upload_images_sends_decoded_bytes_for_each_image(self, mock_post):
+        mock_post.return_value = Mock(status_code=200, text="ok")
+
+        images = [
+            {"name": f"image{i}.jpg", "image": base64.b64encode(f"Image {i}".encode()).decode("utf-8")}
+            for i in range(3)
+        ]
+
+        with patch.object(rp_handler.INPUT_CACHE, "max_bytes", 0):
+            responses = rp_handler.upload_images(images)
+
+        self.assertEqual(responses["status"], "success")
+        self.assertEqual(len(responses["details"]), 3)
+        sent = sorted(call.kwargs["files"]["image"] for call in mock_post.call_args_list)
+        self.assertEqual(
+            sent,
+            [(f"image{i}.jpg", f"Image {i}".encode(), "image/jpeg") for i in range(3)],
+        )
+
+    def test_handler_attaches_trace_when_requested(self):
+        class FakeClient:
+            def __init__(self, *args, **kwargs):
+                self.outputs = []
+                self.websocket_images = {}
+                self.node_timings = [{"node": "3", "class_type": "KSampler", "ms": 12.5, "cached": False}]
+                self.status_change_callback = None
+
+            def submit(self, workflow, job_id, prompt_json=None):
+                return "prompt"
+
+            def getStatus(self):
+                return {"status": "pending", "data": None}
+
+            def iter_statuses(self):
+                for status in [
+                    {"status": "processing", "data": {"type": "executing"}},
+                    {"status": "processing", "data": {"type": "progress"}},
+                    {"status": "completed", "data": {"type": "execution_success"}, "outputs": []},
+                ]:
+                    self.status_change_callback(status)
+                    yield status
+
+        job = {"id": "123", "input": {"workflow": {"3": {"class_type": "KSampler", "inputs": {}}}, "trace": True}}
+        with patch.object(rp_handler, "comfy_is_ready", return_value=True), \
+                patch.object(rp_handler.comfyclient, "ComfyClient", FakeClient):
+            result = rp_handler.handler(job)
+
+        self.assertEqual(result["status"], "success")
+        trace = result["trace"]
+        self.assertEqual(trace["job_id"], "123")
+        self.assertIn("upload", trace["phases_ms"])
+        self.assertIn("output_encoding", trace["phases_ms"])
+        self.assertEqual(trace["nodes"], [{"node": "3", "class_type": "KSampler", "ms": 12.5, "cached": False}])
+        self.assertEqual(
+            set(trace["derived_ms"]),
+            {"queue_wait", "execution", "time_to_first_progress", "success_to_return"},
+        )
+
+    @patch.dict(os.environ, {"COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES})
+    def test_generator_handler_streams_images_before_completion(self):
+        image = {"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}
+        events = []
+
+        class FakeClient:
+            def __init__(self, *args, **kwargs):
+                self.outputs = []
+                self.websocket_images = {}
+                self.node_timings = []
+                self.status_change_callback = None
+
+            def submit(self, workflow, job_id, prompt_json=None):
+                return "prompt"
+
+            def getStatus(self):
+                return {"status": "pending", "data": None}
+
+            def iter_statuses(self):
+                yield {"status": "processing", "data": {"type": "progress", "data": {"node": "3", "value": 1, "max": 2}}}
+                self.outputs.append({"images": [image]})
+                yield {"status": "processing", "data": {"type": "executed", "data": {"node": "9", "output": {"images": [image]}}}}
+                # The workflow is only done after the first image was handed out
+                self.assert_streamed()
+                yield {"status": "completed", "data": {"type": "execution_success"}, "outputs": self.outputs}
+
+            def assert_streamed(self):
+                assert [event["type"] for event in events][-1] == "image"
+
+        job = {"id": "123", "input": {"workflow": {"9": {"class_type": "SaveImage", "inputs": {}}}}}
+        with patch.object(rp_handler, "comfy_is_ready", return_value=True), \
+                patch.object(rp_handler.comfyclient, "ComfyClient", FakeClient):
+            for event in rp_handler.generator_handler(job):
+                events.append(event)
+
+        self.assertEqual([event["type"] for event in events], ["status", "status", "image", "result"])
+        self.assertEqual(events[0]["progress"], {"value": 1, "max": 2})
+        self.assertEqual(events[2]["node"], "9")
+        with open(os.path.join(RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES, "ComfyUI_00001_.png"), "rb") as f:
+            self.assertEqual(events[2]["image"], base64.b64encode(f.read()).decode("utf-8"))
+        self.assertEqual(events[3]["status"], "success")
+        self.assertEqual(events[3]["images"], [])
+        self.assertEqual(events[3]["streamed_images"], 1)
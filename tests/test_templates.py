@@ -0,0 +1,80 @@
+import unittest
+from unittest.mock import Mock
+import sys
+import os
+import json
+import shutil
+import tempfile
+
+# Make sure that "src" is known and can be used to import templates.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import templates
+
+# Local folder for test resources
+RUNPOD_WORKER_COMFY_TEST_RESOURCES_WORKFLOWS = "./test_resources/workflows"
+
+
+class TestTemplateRegistry(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        shutil.copy(os.path.join(RUNPOD_WORKER_COMFY_TEST_RESOURCES_WORKFLOWS, "workflow_sdxl_turbo.json"), self.folder.name)
+        with open(os.path.join(self.folder.name, "broken.json"), "w") as f:
+            json.dump({"1": {"inputs": {}}}, f)
+        self.registry = templates.TemplateRegistry(self.folder.name)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_invalid_templates_are_skipped(self):
+        self.assertEqual(list(self.registry.templates), ["workflow_sdxl_turbo"])
+
+    def test_render_applies_overrides_without_touching_the_template(self):
+        template = self.registry.get("workflow_sdxl_turbo")
+
+        workflow, error = self.registry.render("workflow_sdxl_turbo", {"3": {"seed": 42}, 6: {"text": "a cat"}})
+
+        self.assertIsNone(error)
+        self.assertEqual(workflow["3"]["inputs"]["seed"], 42)
+        self.assertEqual(workflow["3"]["inputs"]["steps"], 3)
+        self.assertEqual(workflow["6"]["inputs"]["text"], "a cat")
+        self.assertIs(workflow["4"], template.workflow["4"])
+        self.assertEqual(template.workflow["3"]["inputs"]["seed"], 457699577674669)
+
+    def test_render_reports_bad_requests(self):
+        self.assertEqual(self.registry.render("missing")[1], "Unknown template 'missing'")
+        self.assertEqual(
+            self.registry.render("workflow_sdxl_turbo", {"99": {"seed": 1}})[1],
+            "Template 'workflow_sdxl_turbo' has no node 99",
+        )
+        self.assertIsNotNone(self.registry.render("workflow_sdxl_turbo", {"3": 1})[1])
+        self.assertIsNotNone(self.registry.render("workflow_sdxl_turbo", ["3"])[1])
+
+    def test_serialize_reuses_the_json_of_unchanged_nodes(self):
+        template = self.registry.get("workflow_sdxl_turbo")
+        workflow, _ = template.apply({"3": {"seed": 42}})
+        template.node_json["4"] = template.node_json["4"].replace("sd_xl_turbo", "cached")
+
+        serialized = json.loads(template.serialize(workflow))
+
+        self.assertEqual(serialized["3"], workflow["3"])
+        self.assertEqual(serialized["4"]["inputs"]["ckpt_name"], "cached_1.0_fp16.safetensors")
+        self.assertEqual(list(serialized), list(workflow))
+
+    def test_templates_are_checked_once_per_set_of_definitions(self):
+        template = self.registry.get("workflow_sdxl_turbo")
+        schema = Mock(nodes={"KSampler": {}})
+        schema.validate.return_value = "Node 3 is broken"
+
+        self.assertEqual(template.check(schema), "Node 3 is broken")
+        self.assertEqual(template.check(schema), "Node 3 is broken")
+        schema.nodes = {}
+        template.check(schema)
+
+        self.assertEqual(schema.validate.call_count, 2)
+
+    def test_key_depends_on_overrides_only(self):
+        template = self.registry.get("workflow_sdxl_turbo")
+
+        self.assertEqual(template.key({"3": {"seed": 1}}), template.key({"3": {"seed": 1}}))
+        self.assertNotEqual(template.key({"3": {"seed": 1}}), template.key({"3": {"seed": 2}}))
+        self.assertEqual(template.key(None), template.key({}))
@@ -0,0 +1,52 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+
+# Make sure that "src" is known and can be used to import tracing.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import tracing
+
+
+class TestJobTrace(unittest.TestCase):
+    def test_phases_accumulate(self):
+        trace = tracing.JobTrace("123")
+        with patch("tracing.time.perf_counter", side_effect=[1.0, 1.5, 2.0, 2.25]):
+            with trace.phase("callbacks"):
+                pass
+            with trace.phase("callbacks"):
+                pass
+
+        self.assertEqual(trace.phases, {"callbacks": 750.0})
+
+    def test_only_first_mark_is_kept(self):
+        trace = tracing.JobTrace("123")
+        trace.start_time = 0.0
+        with patch("tracing.time.perf_counter", side_effect=[1.0, 2.0]):
+            trace.mark("first_progress")
+            trace.mark("first_progress")
+
+        self.assertEqual(trace.marks, {"first_progress": 1000.0})
+
+    def test_derived_durations(self):
+        trace = tracing.JobTrace("123")
+        trace.marks = {
+            "submitted": 10.0,
+            "execution_started": 40.0,
+            "first_progress": 55.0,
+            "execution_success": 500.0,
+            "returned": 620.0,
+        }
+
+        derived = trace.to_dict()["derived_ms"]
+
+        self.assertEqual(
+            derived,
+            {"queue_wait": 30.0, "execution": 460.0, "time_to_first_progress": 45.0, "success_to_return": 120.0},
+        )
+
+    def test_missing_marks_are_left_out(self):
+        trace = tracing.JobTrace("123")
+        trace.marks = {"submitted": 10.0}
+
+        self.assertEqual(trace.to_dict()["derived_ms"], {})
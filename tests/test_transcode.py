@@ -0,0 +1,96 @@
+import unittest
+import sys
+import os
+import io
+import runpy
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import Mock, patch
+
+from PIL import Image
+
+# Make sure that "src" is known and can be used to import transcode.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import transcode
+
+# Local folder for test resources
+RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES = "./test_resources/images"
+
+
+def read_test_image():
+    with open(os.path.join(RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES, "ComfyUI_00001_.png"), "rb") as f:
+        return f.read()
+
+
+class TestTranscode(unittest.TestCase):
+    def test_from_input(self):
+        output_format, error = transcode.OutputFormat.from_input({"output_format": "WebP", "quality": 80})
+        self.assertIsNone(error)
+        self.assertEqual((output_format.output_format, output_format.quality, output_format.lossless), ("webp", 80, False))
+
+        self.assertEqual(transcode.OutputFormat.from_input({}), (None, None))
+        self.assertIsNotNone(transcode.OutputFormat.from_input({"output_format": "gif"})[1])
+        self.assertIsNotNone(transcode.OutputFormat.from_input({"output_format": "jpeg", "quality": 0})[1])
+        self.assertIsNotNone(transcode.OutputFormat.from_input({"output_format": "jpeg", "quality": True})[1])
+
+    def test_formats_pillow_cannot_encode_are_rejected(self):
+        with patch.object(transcode.features, "check", side_effect=lambda feature: feature != "avif"):
+            self.assertIsNotNone(transcode.OutputFormat.from_input({"output_format": "avif"})[1])
+            self.assertIsNone(transcode.OutputFormat.from_input({"output_format": "webp"})[1])
+
+    def test_images_that_fail_to_transcode_are_returned_as_saved(self):
+        output_format = transcode.OutputFormat("webp")
+
+        result = transcode.Transcoder(0).transcode("broken.png", b"not an image", output_format)
+
+        self.assertEqual(result, ("broken.png", b"not an image"))
+        self.assertEqual(output_format.summary()["images"], 0)
+
+    def test_broken_pool_is_replaced(self):
+        transcoder = transcode.Transcoder(1)
+        broken = Mock()
+        broken.submit.return_value.result.side_effect = BrokenProcessPool("a worker died")
+        transcoder.executor = broken
+
+        result = transcoder.transcode("image.png", b"image", transcode.OutputFormat("webp"))
+
+        self.assertEqual(result, ("image.png", b"image"))
+        self.assertIsNone(transcoder.executor)
+        broken.shutdown.assert_called_once_with(wait=False)
+
+    def test_transcode_records_the_bytes_saved(self):
+        data = read_test_image()
+        output_format = transcode.OutputFormat("jpeg", quality=70)
+
+        filename, transcoded = transcode.Transcoder(0).transcode("ComfyUI_00001_.png", data, output_format)
+
+        self.assertEqual(filename, "ComfyUI_00001_.jpg")
+        self.assertEqual(Image.open(io.BytesIO(transcoded)).format, "JPEG")
+        summary = output_format.summary()
+        self.assertEqual((summary["images"], summary["bytes_in"], summary["bytes_out"]), (1, len(data), len(transcoded)))
+        self.assertEqual(summary["bytes_saved"], len(data) - len(transcoded))
+
+    def test_lossless_keeps_the_original(self):
+        data = read_test_image()
+        output_format = transcode.OutputFormat("webp", lossless=True)
+
+        self.assertEqual(transcode.Transcoder(0).transcode("ComfyUI_00001_.png", data, output_format), ("ComfyUI_00001_.png", data))
+        self.assertEqual(output_format.summary()["images"], 0)
+
+    def test_transcode_in_worker_processes(self):
+        transcoder = transcode.Transcoder(1)
+        transcoder.start()
+        try:
+            filename, transcoded = transcoder.transcode("image.png", read_test_image(), transcode.OutputFormat("webp"))
+        finally:
+            transcoder.executor.shutdown()
+
+        self.assertEqual(filename, "image.webp")
+        self.assertEqual(Image.open(io.BytesIO(transcoded)).format, "WEBP")
+
+    def test_entry_point_has_no_side_effects_in_spawned_processes(self):
+        # Spawned worker processes run the main script of the worker as __mp_main__
+        entry_point = os.path.join(os.path.dirname(__file__), "..", "src", "handler.py")
+
+        namespace = runpy.run_path(entry_point, run_name="__mp_main__")
+
+        self.assertNotIn("rp_handler", namespace)
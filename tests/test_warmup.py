@@ -0,0 +1,67 @@
+import unittest
+from unittest.mock import patch
+import sys
+import os
+import json
+import tempfile
+
+# Make sure that "src" is known and can be used to import warmup.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import warmup
+
+# Local folder for test resources
+RUNPOD_WORKER_COMFY_TEST_RESOURCES_WORKFLOWS = "./test_resources/workflows"
+
+
+class FakeClient:
+    submitted = []
+
+    def __init__(self, server_address, timeout=600):
+        self.node_timings = []
+
+    def submit(self, workflow, job_id=None):
+        FakeClient.submitted.append(workflow)
+        self.node_timings = [{"node": "4", "class_type": "CheckpointLoaderSimple", "ms": 100.0, "cached": False}]
+        return "prompt"
+
+    def wait_until_finished(self):
+        return {"status": "completed"}
+
+
+class TestWarmup(unittest.TestCase):
+    def setUp(self):
+        FakeClient.submitted = []
+
+    def test_warmup_files_expands_folders(self):
+        paths = warmup.warmup_files(f" {RUNPOD_WORKER_COMFY_TEST_RESOURCES_WORKFLOWS}, extra.json,")
+
+        self.assertEqual(paths[-1], "extra.json")
+        self.assertIn(os.path.join(RUNPOD_WORKER_COMFY_TEST_RESOURCES_WORKFLOWS, "workflow_sdxl_turbo.json"), paths)
+        self.assertEqual(paths[:-1], sorted(paths[:-1]))
+        self.assertEqual(warmup.warmup_files(""), [])
+
+    def test_load_workflow_accepts_request_bodies(self):
+        workflow = warmup.load_workflow(os.path.join(RUNPOD_WORKER_COMFY_TEST_RESOURCES_WORKFLOWS, "workflow_sdxl_turbo.json"))
+
+        self.assertEqual(workflow["4"]["class_type"], "CheckpointLoaderSimple")
+
+    def test_run_warmups_reports_each_workflow(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "warmup.json")
+            with open(path, "w") as f:
+                json.dump({"4": {"class_type": "CheckpointLoaderSimple", "inputs": {}}}, f)
+
+            not_a_workflow = os.path.join(folder, "list.json")
+            with open(not_a_workflow, "w") as f:
+                json.dump([{"class_type": "CheckpointLoaderSimple"}], f)
+
+            with patch.object(warmup.comfyclient, "ComfyClient", FakeClient):
+                results = warmup.run_warmups(
+                    "127.0.0.1:8188", [path, os.path.join(folder, "missing.json"), not_a_workflow]
+                )
+
+        self.assertEqual(FakeClient.submitted, [{"4": {"class_type": "CheckpointLoaderSimple", "inputs": {}}}])
+        self.assertEqual([result["status"] for result in results], ["completed", "error", "error"])
+        self.assertEqual(results[0]["nodes"][0]["class_type"], "CheckpointLoaderSimple")
+        self.assertGreaterEqual(results[0]["ms"], 0)
+